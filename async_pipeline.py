@@ -0,0 +1,408 @@
+import asyncio
+import logging
+import os
+
+import async_utils
+from early_exit import EarlyExit
+from config import MAX_CONCURRENCY, MAX_CONCURRENT_DOCUMENTS, MAX_IN_FLIGHT_PAGES, COMBINE_MODE
+from metrics import timed_document
+from page_filter import page_signature
+from pipeline_options import PipelineOptions
+from rasterizer import count_pdf_pages, iter_pdf_pages
+from streaming import MarkdownStream, is_early_extraction_valid
+from text_layer import read_text_layer, text_layer_to_page_json
+from utils import parse_page_results, parse_combined_markdown, log_extracted_info, build_record, is_valid_json, \
+    resolve_icd10_code_locally, split_combine_windows, stitch_combined_chunks, should_chunk_combine, \
+    validate_icd10_candidates, markdown_output_path, save_markdown, encode_page
+
+
+@timed_document
+async def process_pdf_file(pdf_path, options=None, api_slots=None):
+    """Process a single PDF file and generate the markdown summary on the event loop.
+
+    `api_slots` is a semaphore shared by every document in the run; each API
+    call holds one slot, which bounds the number of requests in flight.
+    """
+    if options is None:
+        options = PipelineOptions()
+    if api_slots is None:
+        api_slots = asyncio.Semaphore(MAX_CONCURRENCY)
+    journal = options.journal
+    pdf_file = os.path.basename(pdf_path)
+    document_name = os.path.splitext(pdf_file)
+    logging.info(f"Processing '{pdf_file}'...")
+
+    if journal is not None:
+        await asyncio.to_thread(journal.begin_document, pdf_path)
+        record = await asyncio.to_thread(journal.completed_record, pdf_path)
+        if record is not None:
+            logging.info(f"'{pdf_file}' was already processed; using the journaled record.")
+            return record
+
+    async def extract_info(markdown):
+        async with api_slots:
+            if options.fast_icd:
+                return await async_utils.code_diagnosis(markdown, document_name)
+            return await async_utils.generate_search_query(markdown, document_name)
+
+    async def speculate_record(markdown):
+        try:
+            extracted_info = await extract_info(markdown)
+            if not extracted_info:
+                return None
+            icd10_code = await resolve_icd10_code(extracted_info, options, api_slots, pdf_file)
+        except Exception as e:
+            logging.error(f"Error extracting the early record of '{pdf_file}': {e}")
+            return None
+        return (extracted_info, icd10_code) if icd10_code else None
+
+    stream = None
+    # (extracted_info, icd10_code) speculated from the leading and diagnosis pages with --early-exit
+    early_record = None
+
+    combined_markdown = None
+    if journal is not None:
+        combined_markdown = await asyncio.to_thread(journal.load_stage, pdf_path, "combined_markdown")
+    if combined_markdown is None:
+        early_exit = None
+        if options.early_exit:
+            early_exit = EarlyExit(lambda markdown: asyncio.create_task(speculate_record(markdown)), pdf_file)
+        page_results = await extract_pdf_pages(pdf_path, options, api_slots, early_exit)
+        if not page_results:
+            logging.warning(f"No valid content extracted from '{pdf_file}'.")
+            return
+
+        page_contents = parse_page_results(page_results, pdf_file)
+        if not page_contents:
+            logging.warning(f"No valid JSON content to combine for '{pdf_file}'.")
+            return
+
+        if early_exit is not None:
+            early_record = await early_exit_record(early_exit, page_contents, pdf_file)
+
+        # With an early record, the pages are only combined if the markdown is saved
+        if early_record is None or options.markdown_dir is not None:
+            logging.info(f"Combining pages of '{pdf_file}'...")
+            markdown_path = markdown_output_path(options.markdown_dir, pdf_file)
+            if options.stream and not should_chunk_combine(page_contents, options.combine_mode):
+                # Unless there is an early record, the visit details are extracted as soon as the
+                # diagnosis section has been generated
+                def on_diagnosis_section(prefix):
+                    return asyncio.create_task(extract_info(prefix))
+                stream = MarkdownStream(markdown_path, None if early_record else on_diagnosis_section)
+                async with api_slots:
+                    combined_message = await async_utils.combine_page_contents(page_contents, stream=stream)
+            else:
+                combined_message = await combine_pages(page_contents, api_slots, options.combine_mode)
+            combined_markdown = parse_combined_markdown(combined_message, pdf_file)
+            if combined_markdown is None:
+                if stream is not None:
+                    stream.discard()
+                    if stream.early_result is not None:
+                        stream.early_result.cancel()
+                if early_record is None:
+                    return
+            elif stream is not None:
+                await asyncio.to_thread(stream.finish, combined_markdown)
+            elif markdown_path is not None:
+                await asyncio.to_thread(save_markdown, markdown_path, combined_markdown)
+            if journal is not None and combined_markdown is not None:
+                await asyncio.to_thread(journal.save_stage, pdf_path, "combined_markdown", combined_markdown)
+
+    extracted_info, icd10_code = early_record or (None, None)
+    if extracted_info is None and journal is not None:
+        extracted_info = await asyncio.to_thread(journal.load_stage, pdf_path, "extracted_info")
+    if extracted_info is None:
+        extracted_info = await early_extracted_info(stream, combined_markdown, pdf_file)
+        if extracted_info is None:
+            extracted_info = await extract_info(combined_markdown)
+        if not extracted_info:
+            logging.error(f"Failed to generate search query and extract information for '{pdf_file}'.")
+            return
+        if journal is not None:
+            await asyncio.to_thread(journal.save_stage, pdf_path, "extracted_info", extracted_info)
+
+    log_extracted_info(extracted_info)
+
+    if icd10_code is None and journal is not None:
+        icd10_code = await asyncio.to_thread(journal.load_stage, pdf_path, "icd10_code")
+    if icd10_code is None:
+        icd10_code = await resolve_icd10_code(extracted_info, options, api_slots, pdf_file)
+        if not icd10_code:
+            logging.error(f"Failed to extract ICD-10 code for '{pdf_file}'.")
+            return
+        if journal is not None:
+            await asyncio.to_thread(journal.save_stage, pdf_path, "icd10_code", icd10_code)
+
+    logging.info(f"Extracted ICD-10 code: {icd10_code}")
+
+    record = build_record(extracted_info, icd10_code)
+    if journal is not None:
+        await asyncio.to_thread(journal.finish_document, pdf_path, record)
+    return record
+
+
+async def extract_pdf_pages(pdf_path, options, api_slots, early_exit=None):
+    """Extract every page of a PDF, returning a list of (page_number, assistant_message) tuples.
+
+    With an `early_exit`, its priority pages are started first and every
+    extracted page is reported to it.
+    """
+    page_cache = options.page_cache
+    journal = options.journal
+    pdf_file = os.path.basename(pdf_path)
+
+    try:
+        page_count = await asyncio.to_thread(count_pdf_pages, pdf_path)
+    except Exception as e:
+        logging.error(f"Error reading PDF info for '{pdf_file}': {e}")
+        return
+
+    # Pages finished by an earlier, interrupted run are not extracted again
+    journaled_pages = {}
+    if journal is not None:
+        journaled_pages = await asyncio.to_thread(journal.load_pages, pdf_path)
+    if journaled_pages:
+        logging.info(f"Resuming '{pdf_file}' with {len(journaled_pages)} of {page_count} pages already extracted.")
+    remaining_pages = [page_number for page_number in range(page_count) if page_number not in journaled_pages]
+
+    # Pages with a usable embedded text layer skip rasterization and vision
+    text_pages = {}
+    if options.text_layer_mode != "off" and remaining_pages:
+        text_pages = await asyncio.to_thread(read_text_layer, pdf_path, page_count)
+        logging.info(f"{len(text_pages)} of {page_count} pages of '{pdf_file}' have an embedded text layer.")
+        text_pages = {page_number: text_pages[page_number] for page_number in remaining_pages
+                      if page_number in text_pages}
+    scanned_pages = [page_number for page_number in remaining_pages if page_number not in text_pages]
+
+    priority_pages = set()
+    if early_exit is not None:
+        priority_pages = early_exit.prioritize(page_count, text_pages, journaled_pages)
+
+    # The page cache and the journal do file and SQLite I/O, so they run off the event loop
+    async def record_page(page_number, assistant_message):
+        if journal is not None and is_valid_json(assistant_message):
+            await asyncio.to_thread(journal.save_page, pdf_path, page_number, assistant_message)
+        if early_exit is not None:
+            early_exit.add_page(page_number, assistant_message)
+        return page_number, assistant_message
+
+    async def process_text_page(page_number, page_text):
+        if options.text_layer_mode == "direct":
+            return await record_page(page_number, text_layer_to_page_json(page_text))
+
+        cache_key = None
+        if page_cache is not None:
+            cache_key = page_cache.key_for_text(page_text)
+            cached_message = await asyncio.to_thread(page_cache.get, cache_key)
+            if cached_message is not None:
+                logging.info(f"Using cached result for page {page_number + 1} of '{pdf_file}'.")
+                return await record_page(page_number, cached_message)
+
+        logging.info(f"Processing text layer of page {page_number + 1} of '{pdf_file}'...")
+        async with api_slots:
+            assistant_message = await async_utils.extract_text_from_text_layer(page_text, page_number=page_number + 1)
+        if cache_key is not None and is_valid_json(assistant_message):
+            await asyncio.to_thread(page_cache.put, cache_key, assistant_message)
+        return await record_page(page_number, assistant_message)
+
+    # Bound the number of rendered pages held in memory, as in the threaded pipeline
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT_PAGES)
+
+    async def process_page(page_number, image):
+        # The rendered image is released as soon as the page is encoded, so
+        # only the encoded page is held while it waits for an API slot
+        try:
+            cache_key = None
+            if page_cache is not None:
+                cache_key = await asyncio.to_thread(
+                    page_cache.key_for_image, image, options.dpi, options.image_settings.cache_tag()
+                )
+                cached_message = await asyncio.to_thread(page_cache.get, cache_key)
+                if cached_message is not None:
+                    logging.info(f"Using cached result for page {page_number + 1} of '{pdf_file}'.")
+                    return await record_page(page_number, cached_message)
+            # Preprocessing and encoding are CPU bound, so keep them off the event loop
+            page = await asyncio.to_thread(encode_page, image, options.image_settings, page_number + 1)
+        finally:
+            image.close()
+            in_flight.release()
+
+        logging.info(f"Processing page {page_number + 1} of '{pdf_file}'...")
+        async with api_slots:
+            assistant_message = await async_utils.extract_text_from_image(page, page_number=page_number + 1)
+        if cache_key is not None and is_valid_json(assistant_message):
+            await asyncio.to_thread(page_cache.put, cache_key, assistant_message)
+        return await record_page(page_number, assistant_message)
+
+    # Tasks queue for API slots in creation order, so priority pages are created first
+    tasks = [
+        asyncio.create_task(process_text_page(page_number, page_text))
+        for page_number, page_text in sorted(text_pages.items(), key=lambda item: item[0] not in priority_pages)
+    ]
+    # Pages are rendered in parallel on the shared render pool; the iterator
+    # is advanced in a worker thread so waiting for a page never blocks the loop
+    pages = iter_pdf_pages(pdf_path, scanned_pages, dpi=options.dpi)
+    # Blank pages are skipped and exact repeats reuse the task of the page they repeat
+    page_filter = options.page_filter
+    blank_pages = 0
+    duplicates = {}
+    try:
+        while True:
+            await in_flight.acquire()
+            try:
+                page = await asyncio.to_thread(next, pages, None)
+            except Exception:
+                in_flight.release()
+                raise
+            if page is None:
+                in_flight.release()
+                break
+            page_number, image = page
+            if page_filter is not None:
+                signature = await asyncio.to_thread(page_signature, image)
+                verdict, original = await asyncio.to_thread(page_filter.check, signature)
+                if verdict != "new":
+                    image.close()
+                    in_flight.release()
+                    if verdict == "blank":
+                        blank_pages += 1
+                        if early_exit is not None:
+                            early_exit.skip_page(page_number)
+                    else:
+                        duplicates[page_number] = original
+                        if early_exit is not None:
+                            early_exit.add_duplicate(page_number, original)
+                    continue
+            task = asyncio.create_task(process_page(page_number, image))
+            if page_filter is not None:
+                await asyncio.to_thread(page_filter.register, signature, task)
+            tasks.append(task)
+    except Exception as e:
+        logging.error(f"Error converting PDF to images '{pdf_file}': {e}")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return
+    finally:
+        await asyncio.to_thread(pages.close)
+
+    page_results = list(journaled_pages.items())
+    for page_number, assistant_message in await asyncio.gather(*tasks):
+        if assistant_message:
+            page_results.append((page_number, assistant_message))
+        else:
+            logging.error(f"Text extraction failed for page {page_number + 1} of '{pdf_file}'.")
+
+    for page_number, original in duplicates.items():
+        try:
+            _, assistant_message = await original
+        except (Exception, asyncio.CancelledError):
+            assistant_message = None
+        if assistant_message:
+            page_results.append(await record_page(page_number, assistant_message))
+        else:
+            logging.error(f"Text extraction failed for page {page_number + 1} of '{pdf_file}' "
+                          f"(a duplicate of a page that failed).")
+
+    if blank_pages or duplicates:
+        logging.info(f"Skipped {blank_pages} blank and {len(duplicates)} duplicate pages of '{pdf_file}'.")
+
+    return page_results
+
+
+async def early_exit_record(early_exit, page_contents, pdf_file):
+    """Return the (extracted_info, icd10_code) speculated by `early_exit` if it holds for every page, or None."""
+    handle = early_exit.reconcile(page_contents)
+    early_record = await handle if handle is not None else None
+    if early_record:
+        logging.info(f"Using the record extracted early from the leading and diagnosis pages of '{pdf_file}'.")
+    return early_record
+
+
+async def early_extracted_info(stream, combined_markdown, pdf_file):
+    """Return the information extracted while the markdown was streaming, if it holds for the complete markdown."""
+    if stream is None or stream.early_result is None:
+        return None
+    if not is_early_extraction_valid(stream.early_prefix, combined_markdown):
+        logging.info(f"The diagnosis of '{pdf_file}' changed after it was first extracted; extracting it again.")
+        stream.early_result.cancel()
+        return None
+    extracted_info = await stream.early_result
+    if extracted_info:
+        logging.info(f"Using the visit details extracted from '{pdf_file}' while it was being combined.")
+    return extracted_info
+
+
+async def resolve_icd10_code(extracted_info, options, api_slots, pdf_file):
+    """Resolve the ICD-10 code for a document's diagnosis, sharing lookups through the diagnosis cache."""
+    async def lookup_icd10_code():
+        # Use the model's own candidate code (--fast-icd) when it passes the local checks
+        code = await asyncio.to_thread(validate_icd10_candidates, options.icd10_index, extracted_info)
+        if code:
+            return code
+
+        # Resolve the code from the local ICD-10-CM index when it is confident enough
+        code = await asyncio.to_thread(resolve_icd10_code_locally, options.icd10_index, extracted_info)
+        if code:
+            return code
+
+        async with api_slots:
+            search_results = await async_utils.search_icd10_code(extracted_info["query"])
+        if not search_results:
+            logging.error(f"Failed to retrieve search results for '{pdf_file}'.")
+            return None
+
+        async with api_slots:
+            return await async_utils.extract_icd10_code_from_results(search_results)
+
+    if options.diagnosis_cache is not None:
+        return await options.diagnosis_cache.get_or_resolve_async(
+            extracted_info["diagnosis"], extracted_info["query"], lookup_icd10_code
+        )
+    return await lookup_icd10_code()
+
+
+async def combine_pages(page_contents, api_slots, combine_mode=COMBINE_MODE):
+    """Combine page contents, in parallel windows for long documents."""
+    async def combine(pages):
+        async with api_slots:
+            return await async_utils.combine_page_contents(pages)
+
+    if not should_chunk_combine(page_contents, combine_mode):
+        return await combine(page_contents)
+
+    windows = split_combine_windows(page_contents)
+    logging.info(f"Combining {len(page_contents)} pages in {len(windows)} chunks...")
+    chunk_messages = await asyncio.gather(*(combine(window_pages) for window_pages, _ in windows))
+    return stitch_combined_chunks(chunk_messages, windows)
+
+
+async def process_pdf_files(pdf_files, options=None, max_concurrency=MAX_CONCURRENCY,
+                            max_documents=MAX_CONCURRENT_DOCUMENTS):
+    """Process PDFs concurrently, returning their results in input order."""
+    api_slots = asyncio.Semaphore(max_concurrency)
+    document_slots = asyncio.Semaphore(max_documents)
+
+    async def process_document(pdf_path):
+        async with document_slots:
+            try:
+                return await process_pdf_file(pdf_path, options=options, api_slots=api_slots)
+            except Exception as e:
+                logging.error(f"Unexpected error processing '{pdf_path}': {e}")
+                return None
+
+    try:
+        return await asyncio.gather(*(process_document(pdf_path) for pdf_path in pdf_files))
+    finally:
+        await async_utils.close_async_client()
+
+
+def run(pdf_files, options=None, max_concurrency=MAX_CONCURRENCY, max_documents=MAX_CONCURRENT_DOCUMENTS):
+    """Run the asyncio pipeline over `pdf_files` from synchronous code."""
+    return asyncio.run(process_pdf_files(
+        pdf_files,
+        options=options,
+        max_concurrency=max_concurrency,
+        max_documents=max_documents,
+    ))
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from config import ASYNC_MAX_CONNECTIONS
+from metrics import get_metrics, timed
+from streaming import StreamedCompletion
+from utils import (
+    ChatCompletionAttempts,
+    load_environment,
+    google_search,
+    build_extraction_request,
+    build_text_extraction_request,
+    build_combine_request,
+    build_query_request,
+    parse_query_result,
+    build_code_diagnosis_request,
+    parse_code_diagnosis_result,
+    build_search_params,
+    filter_search_results,
+    build_icd10_request,
+    parse_icd10_result,
+)
+
+# Async counterparts of the API helpers in utils.py. Request construction and
+# response parsing are shared with utils.py; only the transport differs.
+
+_async_client = None
+
+
+def get_async_client():
+    """Return the shared AsyncOpenAI client, creating it on first use.
+
+    All coroutines share one pooled HTTP client so hundreds of concurrent
+    requests reuse keep-alive connections instead of opening new ones.
+    """
+    global _async_client
+    if _async_client is None:
+        load_environment()
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_MAX_CONNECTIONS,
+            )
+        )
+        _async_client = AsyncOpenAI(http_client=http_client, max_retries=0)
+    return _async_client
+
+
+async def close_async_client():
+    """Close the shared AsyncOpenAI client and its connection pool."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+
+
+async def stream_chat_completion(request, consumer):
+    """Send a streaming chat completion request, feeding content deltas to `consumer` as they arrive."""
+    consumer.reset()
+    collected = StreamedCompletion(consumer)
+    chunks = await get_async_client().chat.completions.create(
+        **request, stream=True, stream_options={"include_usage": True}
+    )
+    async with chunks:
+        try:
+            async for chunk in chunks:
+                collected.add(chunk)
+        except httpx.TransportError as e:
+            raise openai.APIConnectionError(message=f"Stream interrupted: {e}", request=chunks.response.request) from e
+    return collected.completion()
+
+
+async def create_chat_completion(request, image_sizes=(), stream=None):
+    """Send a chat completion request through the shared rate limiter, retrying like utils.create_chat_completion."""
+    attempts = ChatCompletionAttempts(request, image_sizes)
+    while True:
+        await attempts.limiter.acquire_async(attempts.tokens)
+        try:
+            if stream is None:
+                response = await get_async_client().chat.completions.create(**request)
+            else:
+                response = await stream_chat_completion(request, stream)
+        except Exception as e:
+            delay = attempts.retry_delay(e)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            # A cancelled or interrupted attempt gives back its budget but is not an API error
+            attempts.limiter.release_failed()
+            raise
+        return attempts.succeeded(response)
+
+
+@timed("extract")
+async def extract_text_from_image(page, page_number=0):
+    """Extract text from an encoded page image (a PageBuffer) using the OpenAI API."""
+    request = build_extraction_request(page.data_url)
+
+    try:
+        response = await create_chat_completion(request, image_sizes=[page.size])
+        assistant_message = response.choices[0].message.content.strip()
+        return assistant_message
+    except openai.OpenAIError as e:
+        logging.error(f"OpenAI API error during text extraction of page {page_number}: {e}")
+        return None
+
+
+@timed("extract_text")
+async def extract_text_from_text_layer(page_text, page_number=0):
+    """Structure a page's embedded text into the page JSON shape without sending an image."""
+    request = build_text_extraction_request(page_text)
+
+    try:
+        response = await create_chat_completion(request)
+        assistant_message = response.choices[0].message.content.strip()
+        return assistant_message
+    except openai.OpenAIError as e:
+        logging.error(f"OpenAI API error during text layer extraction of page {page_number}: {e}")
+        return None
+
+
+@timed("combine")
+async def combine_page_contents(page_contents, stream=None):
+    """Combine extracted page contents into a single markdown output, optionally streaming it into `stream`."""
+    request = build_combine_request(page_contents)
+
+    try:
+        response = await create_chat_completion(request, stream=stream)
+        assistant_message = response.choices[0].message.content.strip()
+        return assistant_message
+    except openai.OpenAIError as e:
+        logging.error(f"OpenAI API error during content combination: {e}")
+        return None
+
+
+@timed("query")
+async def generate_search_query(markdown_content, document_name):
+    """Generate search query and extract information from markdown content using OpenAI GPT-4o."""
+    request = build_query_request(markdown_content, document_name)
+
+    try:
+        response = await create_chat_completion(request)
+        assistant_message = response.choices[0].message.content.strip()
+        return parse_query_result(assistant_message)
+    except openai.OpenAIError as e:
+        logging.error(f"OpenAI API error during query generation: {e}")
+    except json.JSONDecodeError as e:
+        logging.error(f"Error parsing JSON in query generation: {e}")
+    return None
+
+
+@timed("code_diagnosis")
+async def code_diagnosis(markdown_content, document_name):
+    """Extract the visit details, search query and candidate ICD-10 codes of a document in one call."""
+    request = build_code_diagnosis_request(markdown_content, document_name)
+
+    try:
+        response = await create_chat_completion(request)
+        assistant_message = response.choices[0].message.content.strip()
+        return parse_code_diagnosis_result(assistant_message)
+    except openai.OpenAIError as e:
+        logging.error(f"OpenAI API error during diagnosis coding: {e}")
+    except json.JSONDecodeError as e:
+        logging.error(f"Error parsing JSON in diagnosis coding: {e}")
+    return None
+
+
+@timed("search")
+async def search_icd10_code(query):
+    """Search for ICD-10 code using SerpAPI."""
+    params = build_search_params(query)
+    get_metrics().record_search()
+
+    try:
+        # The SerpAPI client is synchronous, so run it in a worker thread
+        results = await asyncio.to_thread(google_search, params)
+        return filter_search_results(results)
+    except Exception as e:
+        logging.error(f"Error during SerpAPI search: {e}")
+        return None
+
+
+@timed("icd10")
+async def extract_icd10_code_from_results(results):
+    """Extract ICD-10 code from search results using OpenAI GPT-4o."""
+    request = build_icd10_request(results)
+
+    try:
+        response = await create_chat_completion(request)
+        assistant_message = response.choices[0].message.content.strip()
+        return parse_icd10_result(assistant_message)
+    except openai.OpenAIError as e:
+        logging.error(f"OpenAI API error during ICD-10 code extraction: {e}")
+    except json.JSONDecodeError as e:
+        logging.error(f"Error parsing JSON in ICD-10 code extraction: {e}")
+    return None
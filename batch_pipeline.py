@@ -0,0 +1,514 @@
+import concurrent.futures
+import contextvars
+import json
+import logging
+import os
+import time
+
+import openai
+
+import utils
+from config import BATCH_COMPLETION_WINDOW, BATCH_POLL_INTERVAL_SECONDS, BATCH_MAX_REQUESTS_PER_FILE, \
+    BATCH_MAX_FILE_BYTES, MAX_CONCURRENCY
+from diagnosis_cache import normalize_diagnosis
+from metrics import get_metrics, timed_stage
+from page_filter import page_signature
+from pipeline_options import PipelineOptions
+from rasterizer import count_pdf_pages, iter_pdf_pages
+from run_journal import file_fingerprint
+from text_layer import read_text_layer, text_layer_to_page_json
+from utils import build_extraction_request, build_text_extraction_request, build_combine_request, \
+    build_query_request, build_icd10_request, encode_page, parse_page_results, parse_combined_markdown, \
+    parse_query_result, parse_icd10_result, log_extracted_info, build_record, is_valid_json, \
+    resolve_icd10_code_locally, search_icd10_code, split_combine_windows, stitch_combined_chunks, \
+    should_chunk_combine, build_code_diagnosis_request, parse_code_diagnosis_result, validate_icd10_candidates
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+class OpenAIBatchBackend:
+    """Submits batch input files to the OpenAI Batch API and polls until they finish."""
+
+    def __init__(self, poll_interval=BATCH_POLL_INTERVAL_SECONDS, completion_window=BATCH_COMPLETION_WINDOW):
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+
+    def submit(self, input_path):
+        """Upload a JSONL input file and create a batch for it, returning the batch id."""
+        with open(input_path, 'rb') as f:
+            input_file = utils.get_client().files.create(file=f, purpose="batch")
+        batch = utils.get_client().batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=self.completion_window,
+        )
+        logging.info(f"Submitted batch {batch.id} for '{os.path.basename(input_path)}'.")
+        return batch.id
+
+    def wait(self, batch_id):
+        """Wait for a batch to reach a final state and return the text of its output file."""
+        while True:
+            batch = utils.get_client().batches.retrieve(batch_id)
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                break
+            counts = batch.request_counts
+            if counts is not None:
+                logging.info(f"Batch {batch_id} is {batch.status}: {counts.completed + counts.failed} "
+                             f"of {counts.total} requests done.")
+            time.sleep(self.poll_interval)
+
+        if batch.status != "completed":
+            logging.error(f"Batch {batch_id} ended with status '{batch.status}'.")
+        if batch.error_file_id:
+            logging.error(f"Batch {batch_id} has failed requests; see file {batch.error_file_id}.")
+        if not batch.output_file_id:
+            return ""
+        output_text = utils.get_client().files.content(batch.output_file_id).text
+        record_batch_usage(output_text)
+        return output_text
+
+
+class LocalBatchBackend:
+    """Stand-in for the Batch API that runs each request of an input file locally.
+
+    Requests are sent one by one through create_chat_completion (and so
+    through the shared rate limiter) and written to an output file in the
+    Batch API format. This exercises the whole batch pipeline against any
+    chat completions endpoint, including a mock server.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+
+    def _run_request(self, line):
+        item = json.loads(line)
+        try:
+            response = utils.create_chat_completion(item["body"])
+        except openai.OpenAIError as e:
+            return {"custom_id": item["custom_id"], "response": None, "error": {"message": str(e)}}
+        return {
+            "custom_id": item["custom_id"],
+            "response": {"status_code": 200, "body": response.model_dump()},
+            "error": None,
+        }
+
+    def submit(self, input_path):
+        output_path = f"{os.path.splitext(input_path)[0]}_output.jsonl"
+        with open(input_path, 'r', encoding='utf-8') as f:
+            lines = [line for line in f if line.strip()]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            # Each request runs in a copy of the caller's context so its API call is attributed to the batch stage
+            futures = [executor.submit(contextvars.copy_context().run, self._run_request, line) for line in lines]
+            results = [future.result() for future in futures]
+        with open(output_path, 'w', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+        return output_path
+
+    def wait(self, batch_id):
+        with open(batch_id, 'r', encoding='utf-8') as f:
+            return f.read()
+
+
+def write_batch_files(requests, work_dir, name):
+    """Write (custom_id, request) pairs to one or more Batch API JSONL input files.
+
+    A new file is started whenever the request count or size limit of a
+    single batch would be exceeded. Returns the list of file paths.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    paths = []
+    f = None
+    count = size = 0
+    try:
+        for custom_id, request in requests:
+            line = json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": request})
+            line_size = len(line.encode('utf-8')) + 1
+            if f is None or count >= BATCH_MAX_REQUESTS_PER_FILE or size + line_size > BATCH_MAX_FILE_BYTES:
+                if f is not None:
+                    f.close()
+                paths.append(os.path.join(work_dir, f"{name}_{len(paths) + 1}.jsonl"))
+                f = open(paths[-1], 'w', encoding='utf-8')
+                count = size = 0
+            f.write(line + "\n")
+            count += 1
+            size += line_size
+    finally:
+        if f is not None:
+            f.close()
+    return paths
+
+
+def parse_batch_output(output_text):
+    """Return {custom_id: assistant message or None} from a Batch API output file."""
+    results = {}
+    for line in output_text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        custom_id = item["custom_id"]
+        response = item.get("response")
+        if item.get("error") or not response or response.get("status_code") != 200:
+            logging.error(f"Batch request '{custom_id}' failed: {item.get('error') or response}")
+            results[custom_id] = None
+            continue
+        results[custom_id] = response["body"]["choices"][0]["message"]["content"].strip()
+    return results
+
+
+def record_batch_usage(output_text):
+    """Record the tokens and (discounted) cost of every completed request of a batch output file."""
+    for line in output_text.splitlines():
+        if not line.strip():
+            continue
+        response = json.loads(line).get("response")
+        if not response or response.get("status_code") != 200:
+            continue
+        body = response["body"]
+        usage = body.get("usage") or {}
+        get_metrics().record_api_call(
+            body.get("model", ""),
+            usage.get("prompt_tokens", 0),
+            usage.get("completion_tokens", 0),
+            cached_tokens=(usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+            batch=True,
+        )
+
+
+def run_batch(backend, requests, work_dir, name, journal=None):
+    """Write, submit and wait for a batch of requests, returning {custom_id: assistant message}.
+
+    With a journal, each batch id is saved as soon as it is submitted. A
+    rerun whose input file has the same contents waits for the journaled
+    batch instead of submitting it again. Once a batch's output is read,
+    its id is forgotten; the caller journals the stage outputs next.
+    """
+    with timed_stage(f"batch_{name}"):
+        paths = write_batch_files(requests, work_dir, name)
+        if not paths:
+            return {}
+        logging.info(f"Running {name} batch in {len(paths)} file(s)...")
+        batch_ids = []
+        for path in paths:
+            fingerprint = file_fingerprint(path) if journal is not None else None
+            batch_id = journal.load_batch(path, fingerprint) if journal is not None else None
+            if batch_id is not None:
+                logging.info(f"Resuming batch {batch_id} for '{os.path.basename(path)}'.")
+            else:
+                batch_id = backend.submit(path)
+                if journal is not None:
+                    journal.save_batch(path, fingerprint, batch_id)
+            batch_ids.append(batch_id)
+        results = {}
+        for path, batch_id in zip(paths, batch_ids):
+            results.update(parse_batch_output(backend.wait(batch_id)))
+            if journal is not None:
+                journal.forget_batch(path)
+        return results
+
+
+def extraction_requests(documents, options):
+    """Yield (custom_id, request) pairs for every page that still needs extraction.
+
+    Pages answered by the journal, the page cache or the text layer in
+    "direct" mode are stored in each document's page results instead. Blank
+    pages are skipped, and exact repeats of pages already in the batch are
+    mapped to the original page's request.
+    Scanned pages are rendered and encoded one at a time as the batch input
+    file is written, so only one page image is held in memory.
+    """
+    page_cache = options.page_cache
+    journal = options.journal
+    page_filter = options.page_filter
+
+    for index, document in enumerate(documents):
+        pdf_path = document["pdf_path"]
+        pdf_file = os.path.basename(pdf_path)
+        if document["skip_extraction"]:
+            continue
+
+        try:
+            page_count = count_pdf_pages(pdf_path)
+        except Exception as e:
+            logging.error(f"Error reading PDF info for '{pdf_file}': {e}")
+            continue
+
+        page_results = document["page_results"]
+        page_results.update(journal.load_pages(pdf_path) if journal else {})
+        remaining_pages = [page_number for page_number in range(page_count) if page_number not in page_results]
+
+        text_pages = {}
+        if options.text_layer_mode != "off" and remaining_pages:
+            text_pages = read_text_layer(pdf_path, page_count)
+            logging.info(f"{len(text_pages)} of {page_count} pages of '{pdf_file}' have an embedded text layer.")
+
+        for page_number in remaining_pages:
+            if page_number not in text_pages:
+                continue
+            page_text = text_pages[page_number]
+            if options.text_layer_mode == "direct":
+                page_results[page_number] = text_layer_to_page_json(page_text)
+                continue
+            cache_key = page_cache.key_for_text(page_text) if page_cache is not None else None
+            cached_message = page_cache.get(cache_key) if cache_key else None
+            if cached_message is not None:
+                page_results[page_number] = cached_message
+                continue
+            document["cache_keys"][page_number] = cache_key
+            yield f"{index}:page:{page_number}", build_text_extraction_request(page_text)
+
+        scanned_pages = [page_number for page_number in remaining_pages if page_number not in text_pages]
+        try:
+            for page_number, image in iter_pdf_pages(pdf_path, scanned_pages, dpi=options.dpi):
+                custom_id = f"{index}:page:{page_number}"
+                try:
+                    if page_filter is not None:
+                        signature = page_signature(image)
+                        verdict, original = page_filter.check(signature)
+                        if verdict == "blank":
+                            document["blank_pages"] += 1
+                            continue
+                        if verdict == "duplicate":
+                            document["duplicates"][page_number] = original
+                            continue
+                    cache_key = None
+                    if page_cache is not None:
+                        cache_key = page_cache.key_for_image(image, options.dpi, options.image_settings.cache_tag())
+                        cached_message = page_cache.get(cache_key)
+                        if cached_message is not None:
+                            page_results[page_number] = cached_message
+                            continue
+                    document["cache_keys"][page_number] = cache_key
+                    page = encode_page(image, options.image_settings, page_number=page_number + 1)
+                    if page_filter is not None:
+                        page_filter.register(signature, custom_id)
+                finally:
+                    image.close()
+                yield custom_id, build_extraction_request(page.data_url)
+        except Exception as e:
+            logging.error(f"Error converting PDF to images '{pdf_file}': {e}")
+            document["failed"] = True
+
+
+def extract_pages(documents, options, backend, work_dir):
+    """Extract the pages of every document with one batch, filling in their page results."""
+    results = run_batch(backend, extraction_requests(documents, options), work_dir, "extraction", options.journal)
+
+    for custom_id, assistant_message in results.items():
+        index, _, page_number = custom_id.split(":")
+        document = documents[int(index)]
+        page_number = int(page_number)
+        if not assistant_message:
+            logging.error(f"Text extraction failed for page {page_number + 1} of '{document['pdf_file']}'.")
+            continue
+        document["page_results"][page_number] = assistant_message
+        cache_key = document["cache_keys"].get(page_number)
+        if cache_key is not None and is_valid_json(assistant_message):
+            options.page_cache.put(cache_key, assistant_message)
+
+    for document in documents:
+        for page_number, original in document["duplicates"].items():
+            if results.get(original):
+                document["page_results"][page_number] = results[original]
+            else:
+                logging.error(f"Text extraction failed for page {page_number + 1} of '{document['pdf_file']}' "
+                              f"(a duplicate of a page that failed).")
+        if document["blank_pages"] or document["duplicates"]:
+            logging.info(f"Skipped {document['blank_pages']} blank and {len(document['duplicates'])} duplicate "
+                         f"pages of '{document['pdf_file']}'.")
+
+    if options.journal is not None:
+        for document in documents:
+            for page_number, assistant_message in document["page_results"].items():
+                if is_valid_json(assistant_message):
+                    options.journal.save_page(document["pdf_path"], page_number, assistant_message)
+
+
+def combine_documents(documents, options, backend, work_dir):
+    """Combine the extracted pages of every document with one batch."""
+    windows = {}
+    requests = []
+    for index, document in enumerate(documents):
+        if document["skip_extraction"] or document["failed"]:
+            continue
+        if not document["page_results"]:
+            logging.warning(f"No valid content extracted from '{document['pdf_file']}'.")
+            continue
+        page_contents = parse_page_results(list(document["page_results"].items()), document["pdf_file"])
+        if not page_contents:
+            logging.warning(f"No valid JSON content to combine for '{document['pdf_file']}'.")
+            continue
+        if should_chunk_combine(page_contents, options.combine_mode):
+            windows[index] = split_combine_windows(page_contents)
+            for chunk_index, (window_pages, _) in enumerate(windows[index]):
+                requests.append((f"{index}:combine:{chunk_index}", build_combine_request(window_pages)))
+        else:
+            requests.append((f"{index}:combine", build_combine_request(page_contents)))
+
+    results = run_batch(backend, requests, work_dir, "combine", options.journal)
+
+    for index, document in enumerate(documents):
+        if index in windows:
+            chunk_messages = [
+                results.get(f"{index}:combine:{chunk_index}") for chunk_index in range(len(windows[index]))
+            ]
+            combined_message = stitch_combined_chunks(chunk_messages, windows[index])
+        elif f"{index}:combine" in results:
+            combined_message = results[f"{index}:combine"]
+        else:
+            continue
+        document["combined_markdown"] = parse_combined_markdown(combined_message, document["pdf_file"])
+        if document["combined_markdown"] is not None and options.journal is not None:
+            options.journal.save_stage(document["pdf_path"], "combined_markdown", document["combined_markdown"])
+
+
+def generate_queries(documents, options, backend, work_dir):
+    """Generate the search query and extract information for every document with one batch.
+
+    With --fast-icd, the same requests also ask for candidate ICD-10 codes.
+    """
+    build_request = build_code_diagnosis_request if options.fast_icd else build_query_request
+    parse_result = parse_code_diagnosis_result if options.fast_icd else parse_query_result
+    requests = [
+        (f"{index}:query", build_request(document["combined_markdown"], document["document_name"]))
+        for index, document in enumerate(documents)
+        if document["combined_markdown"] is not None and document["extracted_info"] is None
+    ]
+    results = run_batch(backend, requests, work_dir, "query", options.journal)
+
+    for custom_id, assistant_message in results.items():
+        document = documents[int(custom_id.split(":")[0])]
+        try:
+            extracted_info = parse_result(assistant_message) if assistant_message else None
+        except json.JSONDecodeError as e:
+            logging.error(f"Error parsing JSON in query generation for '{document['pdf_file']}': {e}")
+            extracted_info = None
+        if not extracted_info:
+            logging.error(f"Failed to generate search query and extract information for '{document['pdf_file']}'.")
+            continue
+        document["extracted_info"] = extracted_info
+        if options.journal is not None:
+            options.journal.save_stage(document["pdf_path"], "extracted_info", extracted_info)
+
+
+def resolve_icd10_codes(documents, options, backend, work_dir):
+    """Resolve ICD-10 codes for every document, batching the lookups that need web results.
+
+    Each distinct normalized diagnosis is resolved once. The diagnosis cache,
+    the model's candidate codes (--fast-icd) and the local index are tried
+    first; the remaining diagnoses are searched with SerpAPI in parallel and
+    their codes picked from the results in one batch.
+    """
+    pending = {}
+    # Keys that are normalized diagnoses; a document whose diagnosis does not
+    # normalize is resolved on its own under its path, which is never cached
+    diagnosis_keys = set()
+    for document in documents:
+        extracted_info = document["extracted_info"]
+        if extracted_info is None or document["icd10_code"]:
+            continue
+        key = normalize_diagnosis(extracted_info["diagnosis"]) or normalize_diagnosis(extracted_info["query"])
+        if key:
+            diagnosis_keys.add(key)
+        pending.setdefault(key or document["pdf_path"], []).append(document)
+
+    def resolve_locally(extracted_info):
+        return validate_icd10_candidates(options.icd10_index, extracted_info) or \
+            resolve_icd10_code_locally(options.icd10_index, extracted_info)
+
+    codes = {}
+    for key, group in pending.items():
+        extracted_info = group[0]["extracted_info"]
+        if options.diagnosis_cache is not None:
+            codes[key] = options.diagnosis_cache.get_or_resolve(
+                extracted_info["diagnosis"], extracted_info["query"], lambda: resolve_locally(extracted_info)
+            )
+        else:
+            codes[key] = resolve_locally(extracted_info)
+
+    unresolved = [key for key in pending if not codes[key]]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+        search_results = dict(zip(unresolved, executor.map(
+            lambda key: search_icd10_code(pending[key][0]["extracted_info"]["query"]), unresolved
+        )))
+
+    requests = []
+    for request_index, key in enumerate(unresolved):
+        if not search_results[key]:
+            logging.error(f"Failed to retrieve search results for '{pending[key][0]['pdf_file']}'.")
+            continue
+        requests.append((f"{request_index}:icd10", build_icd10_request(search_results[key])))
+    results = run_batch(backend, requests, work_dir, "icd10", options.journal)
+
+    for custom_id, assistant_message in results.items():
+        key = unresolved[int(custom_id.split(":")[0])]
+        try:
+            codes[key] = parse_icd10_result(assistant_message) if assistant_message else None
+        except json.JSONDecodeError as e:
+            logging.error(f"Error parsing JSON in ICD-10 code extraction: {e}")
+            continue
+        if codes[key] and options.diagnosis_cache is not None and key in diagnosis_keys:
+            options.diagnosis_cache.put(key, codes[key], pending[key][0]["extracted_info"]["diagnosis"])
+
+    for key, group in pending.items():
+        for document in group:
+            if not codes[key]:
+                logging.error(f"Failed to extract ICD-10 code for '{document['pdf_file']}'.")
+                continue
+            document["icd10_code"] = codes[key]
+            if options.journal is not None:
+                options.journal.save_stage(document["pdf_path"], "icd10_code", codes[key])
+
+
+def process_pdf_files(pdf_files, work_dir, options=None, backend=None):
+    """Process PDFs with the Batch API, one batch per stage, returning their results in input order.
+
+    Every stage (page extraction, combine, query generation and ICD-10 code
+    extraction) is sent as a single batch for the whole folder, so a run
+    costs half the interactive price and is not bound by the per-minute
+    rate limits, at the cost of latency. Batch input and output files are
+    kept in `work_dir`.
+    """
+    if options is None:
+        options = PipelineOptions()
+    if backend is None:
+        backend = OpenAIBatchBackend()
+    journal = options.journal
+
+    documents = []
+    records = [None] * len(pdf_files)
+    for index, pdf_path in enumerate(pdf_files):
+        pdf_file = os.path.basename(pdf_path)
+        if journal is not None:
+            journal.begin_document(pdf_path)
+            records[index] = journal.completed_record(pdf_path)
+        combined_markdown = journal.load_stage(pdf_path, "combined_markdown") if journal else None
+        documents.append({
+            "pdf_path": pdf_path,
+            "pdf_file": pdf_file,
+            "document_name": os.path.splitext(pdf_file),
+            "skip_extraction": records[index] is not None or combined_markdown is not None,
+            "failed": False,
+            "page_results": {},
+            "cache_keys": {},
+            "blank_pages": 0,
+            "duplicates": {},
+            "combined_markdown": combined_markdown,
+            "extracted_info": journal.load_stage(pdf_path, "extracted_info") if journal else None,
+            "icd10_code": journal.load_stage(pdf_path, "icd10_code") if journal else None,
+        })
+
+    extract_pages(documents, options, backend, work_dir)
+    combine_documents(documents, options, backend, work_dir)
+    generate_queries(documents, options, backend, work_dir)
+    resolve_icd10_codes([document for index, document in enumerate(documents) if records[index] is None],
+                        options, backend, work_dir)
+
+    for index, document in enumerate(documents):
+        if records[index] is not None or not document["icd10_code"]:
+            continue
+        log_extracted_info(document["extracted_info"])
+        records[index] = build_record(document["extracted_info"], document["icd10_code"])
+        if journal is not None:
+            journal.finish_document(document["pdf_path"], records[index])
+    return records
@@ -0,0 +1,112 @@
+"""Memory benchmark of turning rendered pages into extraction request bodies.
+
+Builds each page of a synthetic scan the way pdftoppm delivers it (an RGB
+image at --dpi) and turns it into a serialized extraction request twice:
+the way pages were handled before page buffers (base64 bytes, their decoded
+string and a formatted data URL, with the rendered image open until the
+request completes) and through utils.encode_page, which closes the image
+once the page is encoded. Reports per-page Python allocations traced by
+tracemalloc, at their peak and still held while the request is in flight.
+PIL allocates image memory outside tracemalloc, so the rendered image is
+counted separately in the held column.
+
+    python benchmarks/encode_memory_benchmark.py --pages 10 --dpi 200
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from PIL import Image
+
+from config import MAX_IN_FLIGHT_PAGES, RENDER_DPI
+from image_preprocessing import ImageSettings, encode_page_image
+from synthetic_pdfs import render_page
+from utils import build_extraction_request, encode_page
+
+# Resolution render_page draws at
+SYNTHETIC_DPI = 100
+
+
+def rendered_page(page_number, dpi, rng):
+    """Return a synthetic page as pdftoppm renders it: an RGB image at `dpi`."""
+    with render_page(page_number, rng) as page:
+        size = (page.width * dpi // SYNTHETIC_DPI, page.height * dpi // SYNTHETIC_DPI)
+        with page.resize(size, Image.BICUBIC) as scaled:
+            return scaled.convert("RGB")
+
+
+def image_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+def legacy_request(image, settings):
+    """Build the request as before page buffers; return it with everything held until the request completes."""
+    encoded = encode_page_image(image, settings)
+    base64_image = base64.b64encode(encoded.data).decode('utf-8')
+    request = build_extraction_request(f"data:{encoded.mime_type};base64,{base64_image}")
+    return request, (base64_image, image), image_bytes(image)
+
+
+def page_buffer_request(image, settings):
+    """Build the request from a page buffer, closing the image once it is encoded."""
+    page = encode_page(image, settings)
+    image.close()
+    return build_extraction_request(page.data_url), (), 0
+
+
+def measure(build, image, settings):
+    """Return (peak, held) traced bytes of building and serializing one request, plus untraced image bytes held."""
+    tracemalloc.start()
+    try:
+        request, held, untraced = build(image, settings)
+        body = json.dumps(request).encode('utf-8')  # what the HTTP client sends
+        in_flight, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del request, held, body
+    return peak, in_flight, untraced
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure per-page allocations of encoding extraction requests.")
+    parser.add_argument("--pages", type=int, default=5, help="Number of synthetic pages.")
+    parser.add_argument("--dpi", type=int, default=RENDER_DPI)
+    parser.add_argument("--image-format", choices=["auto", "jpeg", "png"], default="auto")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    settings = ImageSettings(image_format=args.image_format)
+    rng = random.Random(args.seed)
+    # Warm up both paths so one-time allocations (imports, encoder state) are not counted for page 1
+    with rendered_page(0, args.dpi, random.Random(args.seed)) as image:
+        measure(legacy_request, image.copy(), settings)
+        measure(page_buffer_request, image.copy(), settings)
+    print(f"{args.pages} pages at {args.dpi} DPI, {args.image_format} encoding (KB per page)\n")
+    print(f"{'page':>6}{'before peak':>14}{'after peak':>13}{'before held':>14}{'after held':>13}")
+    totals = [0, 0, 0, 0]
+    for page_number in range(1, args.pages + 1):
+        image = rendered_page(page_number, args.dpi, rng)
+        before_peak, before_held, before_image = measure(legacy_request, image.copy(), settings)
+        after_peak, after_held, after_image = measure(page_buffer_request, image, settings)
+        row = [before_peak, after_peak, before_held + before_image, after_held + after_image]
+        totals = [total + value for total, value in zip(totals, row)]
+        print(f"{page_number:>6}" + "".join(f"{value / 1024:>{width}.0f}"
+                                            for value, width in zip(row, (14, 13, 14, 13))))
+
+    before_held, after_held = totals[2] / args.pages, totals[3] / args.pages
+    print(f"\n{'mean':>6}" + "".join(f"{total / args.pages / 1024:>{width}.0f}"
+                                     for total, width in zip(totals, (14, 13, 14, 13))))
+    print(f"\nHeld for {MAX_IN_FLIGHT_PAGES} pages in flight: {before_held * MAX_IN_FLIGHT_PAGES / 2 ** 20:.1f} MB "
+          f"before, {after_held * MAX_IN_FLIGHT_PAGES / 2 ** 20:.1f} MB after")
+
+
+if __name__ == "__main__":
+    main()
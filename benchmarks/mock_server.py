@@ -0,0 +1,302 @@
+"""Local stand-in for the OpenAI chat completions endpoint used by the benchmarks.
+
+The server answers every pipeline request with a canned but well-formed
+response, adds configurable latency, injects 429 responses with a
+Retry-After header, simulates prompt caching of repeated request prefixes,
+streams responses as server-sent events when asked to, and keeps token
+accounting that can be read back from GET /stats.
+"""
+import base64
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from prompts import EXTRACTION_SYSTEM_PROMPT, TEXT_EXTRACTION_SYSTEM_PROMPT, COMBINE_SYSTEM_PROMPT, \
+    GENERATE_QUERY_SYSTEM_PROMPT, PARSE_WEB_RESULTS_SYSTEM_PROMPT, CODE_DIAGNOSIS_SYSTEM_PROMPT
+from rate_limiter import CHARS_PER_TOKEN, estimate_image_tokens
+
+PAGE_RESPONSE = {
+    "header": "Springfield Orthopedics - Progress Note",
+    "content": "Chief Complaint: neck pain after motor vehicle collision.\n"
+               "Assessment: cervicalgia, cervical strain.\nPlan: physical therapy twice weekly.",
+    "footer": "Confidential patient record",
+}
+QUERY_RESPONSE = {
+    "date_of_visit": "03/15/2023",
+    "diagnosis": "Cervicalgia",
+    "reference": "Springfield Orthopedics progress note",
+    "query": "ICD-10 code for cervicalgia",
+}
+CODE_DIAGNOSIS_RESPONSE = dict(QUERY_RESPONSE, icd10_candidates=[{"code": "M54.2", "description": "Cervicalgia"}])
+ICD10_RESPONSE = {"code": "M54.2"}
+
+# OpenAI caches prompt prefixes of at least 1024 tokens, in 128 token increments
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_INCREMENT = 128
+
+# Characters of content sent per chunk of a streamed response (about four tokens)
+STREAM_CHUNK_CHARS = 4 * CHARS_PER_TOKEN
+
+
+class MockState:
+    """Configuration and counters shared by the request handlers."""
+
+    def __init__(self, latency, latency_per_1k_tokens, jitter, rate_limit_probability, retry_after, seed):
+        self.latency = latency
+        self.latency_per_1k_tokens = latency_per_1k_tokens
+        self.jitter = jitter
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "rate_limited": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "image_tokens": 0,
+            "cached_tokens": 0,
+            "requests_by_kind": {},
+        }
+        self.seen_prefixes = set()
+
+
+def count_prompt_tokens(messages):
+    """Return (total prompt tokens, image tokens) for a list of chat messages."""
+    text_chars = 0
+    image_tokens = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            text_chars += len(content)
+            continue
+        for part in content:
+            if part["type"] == "text":
+                text_chars += len(part["text"])
+            elif part["type"] == "image_url":
+                data = part["image_url"]["url"].split(",", 1)[1]
+                with Image.open(io.BytesIO(base64.b64decode(data))) as image:
+                    image_tokens += estimate_image_tokens(*image.size)
+    return text_chars // CHARS_PER_TOKEN + image_tokens, image_tokens
+
+
+def cached_prefix_tokens(state, messages):
+    """Return the prompt tokens OpenAI's prompt cache would serve for a request.
+
+    Like the real cache, only prefixes of at least PROMPT_CACHE_MIN_TOKENS
+    are cached, in PROMPT_CACHE_INCREMENT token steps. The prefix is taken
+    to be every message before the last one plus the leading text parts of
+    the last message.
+    """
+    *leading, last = messages
+    prefix = [message["content"] for message in leading]
+    if not isinstance(last["content"], str):
+        for part in last["content"]:
+            if part["type"] != "text":
+                break
+            prefix.append(part["text"])
+    prefix_tokens = sum(len(text) for text in prefix) // CHARS_PER_TOKEN
+    if prefix_tokens < PROMPT_CACHE_MIN_TOKENS:
+        return 0
+    key = hash(tuple(prefix))
+    with state.lock:
+        seen = key in state.seen_prefixes
+        state.seen_prefixes.add(key)
+    if not seen:
+        return 0
+    return prefix_tokens - (prefix_tokens - PROMPT_CACHE_MIN_TOKENS) % PROMPT_CACHE_INCREMENT
+
+
+def combine_response(messages):
+    """Return combined markdown with a page indicator for every page sent."""
+    page_contents = json.loads(messages[-1]["content"])
+    sections = [
+        f"<!-- BEGIN PAGE: p. {page['page_number']} -->\n### {page.get('header', '')}\n{page.get('content', '')}"
+        for page in page_contents
+    ]
+    return {"markdown": "\n\n".join(sections)}
+
+
+def answer(messages):
+    """Return (request kind, response content) for a pipeline request."""
+    system_prompt = messages[0]["content"]
+    if system_prompt == EXTRACTION_SYSTEM_PROMPT:
+        return "extract", PAGE_RESPONSE
+    if system_prompt == TEXT_EXTRACTION_SYSTEM_PROMPT:
+        return "extract_text", PAGE_RESPONSE
+    if system_prompt == COMBINE_SYSTEM_PROMPT:
+        return "combine", combine_response(messages)
+    if system_prompt == GENERATE_QUERY_SYSTEM_PROMPT:
+        return "query", QUERY_RESPONSE
+    if system_prompt == CODE_DIAGNOSIS_SYSTEM_PROMPT:
+        return "code_diagnosis", CODE_DIAGNOSIS_RESPONSE
+    if system_prompt == PARSE_WEB_RESULTS_SYSTEM_PROMPT:
+        return "icd10", ICD10_RESPONSE
+    return "other", {}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        state = self.server.state
+        if self.path.rstrip("/") == "/stats":
+            with state.lock:
+                self._send_json(200, state.stats)
+            return
+        self._send_json(404, {"error": {"message": "Not found"}})
+
+    def _send_stream(self, model, content_text, usage, generation_seconds):
+        """Send a response as server-sent chat completion chunks spread over `generation_seconds`."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        completion = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+        }
+
+        def send(**fields):
+            self.wfile.write(f"data: {json.dumps({**completion, **fields})}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        pieces = [content_text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(content_text), STREAM_CHUNK_CHARS)]
+        for index, piece in enumerate(pieces):
+            if index:
+                time.sleep(generation_seconds / len(pieces))
+            send(choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+        send(choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        send(choices=[], usage=usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def do_POST(self):
+        state = self.server.state
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        with state.lock:
+            state.stats["requests"] += 1
+            rate_limited = state.random.random() < state.rate_limit_probability
+            if rate_limited:
+                state.stats["rate_limited"] += 1
+        if rate_limited:
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                headers={"Retry-After": f"{state.retry_after:g}"},
+            )
+            return
+
+        messages = request["messages"]
+        kind, content = answer(messages)
+        prompt_tokens, image_tokens = count_prompt_tokens(messages)
+        cached_tokens = cached_prefix_tokens(state, messages)
+        content_text = json.dumps(content)
+        completion_tokens = len(content_text) // CHARS_PER_TOKEN
+
+        # Streamed responses start after the base latency and spread the per-token latency over their chunks
+        generation_seconds = state.latency_per_1k_tokens * completion_tokens / 1000
+        delay = state.latency + (0.0 if request.get("stream") else generation_seconds)
+        time.sleep(max(0.0, delay + state.random.uniform(-state.jitter, state.jitter)))
+
+        with state.lock:
+            state.stats["prompt_tokens"] += prompt_tokens
+            state.stats["completion_tokens"] += completion_tokens
+            state.stats["image_tokens"] += image_tokens
+            state.stats["cached_tokens"] += cached_tokens
+            state.stats["requests_by_kind"][kind] = state.stats["requests_by_kind"].get(kind, 0) + 1
+
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        if request.get("stream"):
+            self._send_stream(request.get("model", "mock"), content_text, usage, generation_seconds)
+            return
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content_text},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }],
+            "usage": usage,
+        })
+
+
+def serve(port, ready=None, latency=0.2, latency_per_1k_tokens=0.0, jitter=0.0, rate_limit_probability=0.0,
+          retry_after=1.0, seed=0):
+    """Serve the mock API on 127.0.0.1:`port` until the process is terminated."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(latency, latency_per_1k_tokens, jitter, rate_limit_probability, retry_after, seed)
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
+
+
+class FakeGoogleSearch:
+    """Drop-in replacement for serpapi.GoogleSearch that answers after a fixed latency."""
+
+    latency = 0.3
+
+    def __init__(self, params):
+        self.params = params
+
+    def get_dict(self):
+        time.sleep(self.latency)
+        return {
+            "organic_results": [{
+                "position": 1,
+                "title": "2025 ICD-10-CM Diagnosis Code M54.2: Cervicalgia",
+                "link": "https://www.icd10data.com/ICD10CM/Codes/M00-M99/M50-M54/M54-/M54.2",
+                "snippet": "M54.2 is a billable/specific ICD-10-CM code that can be used to indicate a diagnosis "
+                           "for reimbursement purposes.",
+            }],
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the mock OpenAI chat completions server.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0)
+    args = parser.parse_args()
+    serve(args.port, latency=args.latency, rate_limit_probability=args.rate_limit_probability)
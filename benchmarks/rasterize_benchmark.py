@@ -0,0 +1,74 @@
+"""Benchmark of parallel PDF rasterization versus the number of render workers.
+
+Renders every page of a synthetic scanned PDF through rasterizer.iter_pdf_pages
+with 1, 2, 4, ... workers up to the number of cores, and reports pages/s and
+the speedup over a single worker.
+
+    python benchmarks/rasterize_benchmark.py --pages 200 --dpi 200
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from config import RENDER_DPI, RENDER_CHUNK_PAGES
+from rasterizer import PageBudget, iter_pdf_pages
+from synthetic_pdfs import write_pdf
+
+
+def worker_counts(max_workers):
+    """Return 1, 2, 4, ... up to and including `max_workers`."""
+    counts = []
+    count = 1
+    while count < max_workers:
+        counts.append(count)
+        count *= 2
+    return counts + [max_workers]
+
+
+def time_rendering(pdf_path, page_count, workers, dpi, chunk_pages):
+    """Return the seconds taken to render and load every page with `workers` render threads."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        start = time.perf_counter()
+        rendered = 0
+        # A budget of its own lets every worker render ahead, so only the worker count limits the speedup
+        budget = PageBudget(workers * chunk_pages)
+        for _, image in iter_pdf_pages(pdf_path, range(page_count), dpi=dpi, executor=executor, workers=workers,
+                                       chunk_pages=chunk_pages, budget=budget):
+            image.close()
+            rendered += 1
+        elapsed = time.perf_counter() - start
+    if rendered != page_count:
+        raise RuntimeError(f"Rendered {rendered} of {page_count} pages.")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parallel rasterization against the number of workers.")
+    parser.add_argument("--pages", type=int, default=96, help="Pages in the synthetic PDF.")
+    parser.add_argument("--dpi", type=int, default=RENDER_DPI)
+    parser.add_argument("--chunk-pages", type=int, default=RENDER_CHUNK_PAGES,
+                        help="Pages rendered per pdftoppm call.")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="soi_rasterize_") as work_dir:
+        pdf_path = os.path.join(work_dir, "record.pdf")
+        write_pdf(pdf_path, args.pages)
+
+        print(f"{args.pages} pages at {args.dpi} DPI, {args.chunk_pages} pages per pdftoppm call\n")
+        print(f"{'workers':>8}{'seconds':>10}{'pages/s':>10}{'speedup':>10}")
+        baseline = None
+        for workers in worker_counts(args.max_workers):
+            elapsed = time_rendering(pdf_path, args.pages, workers, args.dpi, args.chunk_pages)
+            baseline = baseline or elapsed
+            print(f"{workers:>8}{elapsed:>10.2f}{args.pages / elapsed:>10.1f}{baseline / elapsed:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""End-to-end benchmark of generate_summary_of_injuries.py against a local mock API.
+
+Generates synthetic scanned PDFs, starts the mock chat completions server in
+a separate process, runs the real pipeline (threaded, --async or --batch
+local) in this process with a fake SerpAPI client, and reports throughput,
+per-stage latency percentiles and peak RSS. Throughput counts only the
+documents that reached the summary, and the benchmark exits non-zero if any
+document failed or no page reached the mock server. With --baseline, the
+run is compared against an earlier JSON report and exits non-zero on a
+regression.
+
+    python benchmarks/run_benchmark.py --documents 20 --pages 1,5,20 --latency 0.2 -- --async
+"""
+import argparse
+import functools
+import inspect
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import mock_server
+from synthetic_pdfs import generate_corpus
+
+# Pipeline functions timed as stages, by module
+SYNC_STAGES = {
+    "extract": "extract_text_from_image",
+    "extract_text": "extract_text_from_text_layer",
+    "combine": "combine_page_contents",
+    "query": "generate_search_query",
+    "search": "search_icd10_code",
+    "icd10": "extract_icd10_code_from_results",
+}
+
+
+class StageTimer:
+    """Collects wall-clock durations of wrapped pipeline functions by stage."""
+
+    def __init__(self):
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    def wrap(self, module, name, stage):
+        function = getattr(module, name)
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+        else:
+            @functools.wraps(function)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+        setattr(module, name, timed)
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of a list of values."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock_server(args):
+    port = free_port()
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(
+        target=mock_server.serve,
+        args=(port, ready),
+        kwargs={
+            "latency": args.latency,
+            "latency_per_1k_tokens": args.latency_per_1k_tokens,
+            "jitter": args.jitter,
+            "rate_limit_probability": args.rate_limit_probability,
+            "retry_after": args.retry_after,
+            "seed": args.seed,
+        },
+        daemon=True,
+    )
+    process.start()
+    ready.wait(10)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def install_timers(timer):
+    """Wrap the pipeline's stage functions in every module that calls them."""
+    import async_utils
+    import batch_pipeline
+    import generate_summary_of_injuries
+    import rasterizer
+    import utils
+
+    for stage, name in SYNC_STAGES.items():
+        timer.wrap(generate_summary_of_injuries, name, stage)
+        timer.wrap(async_utils, name, stage)
+    timer.wrap(batch_pipeline, "search_icd10_code", "search")
+    timer.wrap(rasterizer, "render_page_range", "render")
+
+    def fake_google_search(params):
+        return mock_server.FakeGoogleSearch(params).get_dict()
+
+    utils.google_search = fake_google_search
+    async_utils.google_search = fake_google_search
+
+
+def run(args, pipeline_args):
+    work_dir = tempfile.mkdtemp(prefix="soi_benchmark_")
+    input_folder = os.path.join(work_dir, "input")
+    output_folder = os.path.join(work_dir, "output")
+    page_counts = [int(count) for count in args.pages.split(",")]
+    corpus = generate_corpus(input_folder, args.documents, page_counts)
+
+    server, base_url = start_mock_server(args)
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["SERPAPI_API_KEY"] = "benchmark"
+    os.environ["HOME"] = work_dir  # keeps the default caches out of the user's home folder
+    mock_server.FakeGoogleSearch.latency = args.search_latency
+
+    import generate_summary_of_injuries
+    from config import SUMMARY_STORE_FILENAME
+    from summary_store import SummaryStore
+    from utils import prompt_prefix_tokens
+
+    timer = StageTimer()
+    install_timers(timer)
+
+    sys.argv = [
+        "generate_summary_of_injuries.py", input_folder, output_folder,
+        "--no-cache", "--no-diagnosis-cache", "--no-icd10-index",
+    ] + pipeline_args
+    start = time.perf_counter()
+    try:
+        generate_summary_of_injuries.main()
+    finally:
+        elapsed = time.perf_counter() - start
+        with urllib.request.urlopen(f"{base_url}/stats") as response:
+            server_stats = json.load(response)
+        server.terminate()
+
+    # Only documents that reached the summary count towards throughput
+    summarized = SummaryStore(os.path.join(output_folder, SUMMARY_STORE_FILENAME)).paths()
+    completed = [path for path in map(os.path.abspath, summarized) if path in corpus]
+    completed_pages = sum(corpus[path] for path in completed)
+    return {
+        "documents": args.documents,
+        "pages": sum(corpus.values()),
+        "completed_documents": len(completed),
+        "completed_pages": completed_pages,
+        "pipeline_args": pipeline_args,
+        "elapsed_seconds": elapsed,
+        "pages_per_second": completed_pages / elapsed,
+        "documents_per_second": len(completed) / elapsed,
+        # ru_maxrss is reported in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": {
+            stage: {
+                "count": len(durations),
+                "p50_ms": percentile(durations, 0.50) * 1000,
+                "p95_ms": percentile(durations, 0.95) * 1000,
+            }
+            for stage, durations in sorted(timer.durations.items())
+        },
+        "server": server_stats,
+        "prompt_prefix_tokens": prompt_prefix_tokens(),
+    }
+
+
+def print_report(report):
+    print(f"\n{report['completed_documents']} of {report['documents']} documents "
+          f"({report['completed_pages']} of {report['pages']} pages) completed in {report['elapsed_seconds']:.2f}s")
+    print(f"  {report['pages_per_second']:.2f} pages/s, {report['documents_per_second']:.2f} documents/s, "
+          f"peak RSS {report['peak_rss_mb']:.1f} MB")
+    server = report["server"]
+    print(f"  {server['requests']} API requests ({server['rate_limited']} rate limited), "
+          f"{server['prompt_tokens']} prompt tokens ({server['image_tokens']} image, "
+          f"{server['cached_tokens']} cached), "
+          f"{server['completion_tokens']} completion tokens")
+    prefixes = ", ".join(f"{kind} {tokens}" for kind, tokens in report["prompt_prefix_tokens"].items())
+    print(f"  Cacheable prompt prefixes (tokens, at least {mock_server.PROMPT_CACHE_MIN_TOKENS} to be cached): "
+          f"{prefixes}")
+    print(f"\n  {'stage':<14}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}")
+    for stage, stats in report["stages"].items():
+        print(f"  {stage:<14}{stats['count']:>8}{stats['p50_ms']:>12.1f}{stats['p95_ms']:>12.1f}")
+
+
+def find_failures(report):
+    """Return descriptions of what makes a run unusable as a measurement."""
+    failures = []
+    if report["completed_documents"] < report["documents"]:
+        failures.append(f"{report['documents'] - report['completed_documents']} of {report['documents']} "
+                        f"documents failed; see the log above")
+    extract_requests = sum(report["server"]["requests_by_kind"].get(kind, 0) for kind in ("extract", "extract_text"))
+    if not extract_requests:
+        failures.append("no page extraction requests reached the mock server")
+    return failures
+
+
+def find_regressions(report, baseline, tolerance):
+    """Return descriptions of metrics that are worse than the baseline by more than `tolerance`."""
+    regressions = []
+    for metric in ("pages_per_second", "documents_per_second"):
+        if report[metric] < baseline[metric] * (1 - tolerance):
+            regressions.append(f"{metric}: {report[metric]:.2f} < baseline {baseline[metric]:.2f}")
+    if report["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(f"peak_rss_mb: {report['peak_rss_mb']:.1f} > baseline {baseline['peak_rss_mb']:.1f}")
+    for stage, stats in report["stages"].items():
+        baseline_stats = baseline["stages"].get(stage)
+        if baseline_stats and stats["p95_ms"] > baseline_stats["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{stage} p95: {stats['p95_ms']:.1f}ms > baseline {baseline_stats['p95_ms']:.1f}ms")
+    return regressions
+
+
+def main():
+    argv = sys.argv[1:]
+    pipeline_args = []
+    if "--" in argv:
+        pipeline_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the summary pipeline against a local mock API. "
+                    "Arguments after -- are passed to generate_summary_of_injuries.py."
+    )
+    parser.add_argument("--documents", type=int, default=10, help="Number of synthetic PDFs.")
+    parser.add_argument("--pages", default="1,5,20", help="Comma-separated page counts, cycled over documents.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Base latency of each API response (seconds).")
+    parser.add_argument("--latency-per-1k-tokens", type=float, default=0.0,
+                        help="Extra latency per 1,000 completion tokens (seconds).")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Uniform latency jitter (seconds).")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.02,
+                        help="Fraction of requests answered with a 429.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After sent with 429s (seconds).")
+    parser.add_argument("--search-latency", type=float, default=0.3, help="Latency of the fake SerpAPI client.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this file.")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative regression against the baseline (default: 0.2).")
+    args = parser.parse_args(argv)
+
+    report = run(args, pipeline_args)
+    print_report(report)
+
+    # A failed run would read as a speedup, so it is never written or compared
+    failures = find_failures(report)
+    for failure in failures:
+        print(f"FAILED {failure}")
+    if failures:
+        sys.exit(1)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = find_regressions(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Benchmark of CLI startup: import times and runs handed to a warm worker.
+
+Times fresh interpreters importing the pipeline modules and creating the
+OpenAI client, then compares a short CLI run (an empty input folder) started
+cold with the same run handed to a warm worker through warm_worker.py. With
+--importtime, also lists the slowest imports of the CLI module as reported
+by python -X importtime.
+
+    python benchmarks/startup_benchmark.py --runs 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Python snippets timed in a fresh interpreter
+IMPORT_CASES = {
+    "interpreter": "pass",
+    "import utils": "import utils",
+    "import CLI": "import generate_summary_of_injuries",
+    "OpenAI client": "import utils; utils.get_client()",
+}
+
+
+def time_command(command, env, runs):
+    """Return the median wall-clock seconds of running `command` `runs` times."""
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def slowest_imports(env, count):
+    """Return (cumulative microseconds, module) of the slowest top-level imports of the CLI module."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import generate_summary_of_injuries"],
+                            cwd=REPO_DIR, env=env, capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            name = parts[2].rstrip()
+            # Modules imported directly by the CLI module are indented by three spaces
+            if len(name) - len(name.lstrip()) <= 3:
+                imports.append((int(parts[1]), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def wait_for_socket(path, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"The warm worker did not start listening on '{path}'.")
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CLI startup and warm worker handoff.")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per case; the median is reported.")
+    parser.add_argument("--importtime", type=int, nargs="?", const=10, default=0, metavar="N",
+                        help="Also list the N slowest imports of the CLI module (default: 10).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="soi_startup_") as work_dir:
+        # The API key only has to be present; nothing is sent
+        env = {**os.environ, "OPENAI_API_KEY": "benchmark", "HOME": work_dir}
+        input_folder = os.path.join(work_dir, "input")
+        output_folder = os.path.join(work_dir, "output")
+        os.makedirs(input_folder)
+        socket_path = os.path.join(work_dir, "warm_worker.sock")
+
+        print(f"Median of {args.runs} runs\n")
+        print(f"  {'case':<28}{'ms':>8}")
+        for case, code in IMPORT_CASES.items():
+            seconds = time_command([sys.executable, "-c", code], env, args.runs)
+            print(f"  {case:<28}{seconds * 1000:>8.0f}")
+
+        cold = time_command([sys.executable, "generate_summary_of_injuries.py", input_folder, output_folder],
+                            env, args.runs)
+        server = subprocess.Popen([sys.executable, "generate_summary_of_injuries.py", "--serve", socket_path],
+                                  cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_socket(socket_path)
+            warm = time_command([sys.executable, "warm_worker.py", "--socket", socket_path, input_folder,
+                                 output_folder], env, args.runs)
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"  {'run, cold CLI':<28}{cold * 1000:>8.0f}")
+        print(f"  {'run, handed to warm worker':<28}{warm * 1000:>8.0f}")
+
+        if args.importtime:
+            print("\nSlowest imports of generate_summary_of_injuries (cumulative ms):")
+            for microseconds, module in slowest_imports(env, args.importtime):
+                print(f"  {module:<28}{microseconds / 1000:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Generates synthetic scanned medical record PDFs for the benchmarks."""
+import os
+import random
+
+from PIL import Image, ImageDraw
+
+PAGE_SIZE = (850, 1100)  # US Letter at 100 DPI
+
+NOTE_LINES = [
+    "SPRINGFIELD ORTHOPEDICS - PROGRESS NOTE",
+    "Patient: DOE, JANE    DOB: 01/02/1980    MRN: 0000000",
+    "Date of Service: 03/15/2023",
+    "Chief Complaint: Neck pain following motor vehicle collision.",
+    "History of Present Illness: Patient reports constant neck pain radiating",
+    "to the right shoulder since the collision. Pain is 6/10.",
+    "Physical Exam: Tenderness over C4-C6 paraspinal muscles. Reduced ROM.",
+    "Assessment: Cervicalgia. Cervical strain.",
+    "Plan: Physical therapy twice weekly for 6 weeks. Follow up in 4 weeks.",
+]
+
+
+def render_page(page_number, rng):
+    """Draw one page of a typed progress note with some scanning noise."""
+    image = Image.new("L", PAGE_SIZE, 255)
+    draw = ImageDraw.Draw(image)
+    y = 80
+    while y < PAGE_SIZE[1] - 120:
+        for line in NOTE_LINES:
+            draw.text((70 + rng.randint(-2, 2), y), line, fill=rng.randint(0, 40))
+            y += 22
+        y += 30
+    draw.text((PAGE_SIZE[0] // 2 - 20, PAGE_SIZE[1] - 60), f"Page {page_number}", fill=0)
+    for _ in range(200):
+        draw.point((rng.randrange(PAGE_SIZE[0]), rng.randrange(PAGE_SIZE[1])), fill=rng.randint(120, 220))
+    return image
+
+
+def write_pdf(path, page_count, seed=0):
+    """Write a synthetic scanned PDF with `page_count` pages."""
+    rng = random.Random(seed)
+    pages = [render_page(page_number + 1, rng) for page_number in range(page_count)]
+    pages[0].save(path, "PDF", resolution=100.0, save_all=True, append_images=pages[1:])
+    for page in pages:
+        page.close()
+
+
+def generate_corpus(folder, documents, page_counts):
+    """Write `documents` PDFs to `folder`, cycling through `page_counts`; returns {path: page count}."""
+    os.makedirs(folder, exist_ok=True)
+    corpus = {}
+    for index in range(documents):
+        path = os.path.join(folder, f"record_{index:04d}.pdf")
+        corpus[path] = page_counts[index % len(page_counts)]
+        write_pdf(path, corpus[path], seed=index)
+    return corpus
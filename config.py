@@ -1,3 +1,5 @@
+import os
+
 # Maximum tokens for GPT-4o model outputs
 GPT4O_MAX_OUTPUT_TOKENS = 16384
 
@@ -9,4 +11,184 @@ COMBINATION_MODEL = "gpt-4o"
 TEMPERATURE = 0
 
 # Response format for OpenAI API
-RESPONSE_FORMAT = {"type": "json_object"}
\ No newline at end of file
+RESPONSE_FORMAT = {"type": "json_object"}
+
+# Resolution used when rasterizing PDF pages (pdf2image default)
+RENDER_DPI = 200
+
+# Maximum number of API requests in flight across all documents
+MAX_CONCURRENCY = 10
+
+# Maximum number of documents processed concurrently
+MAX_CONCURRENT_DOCUMENTS = 4
+
+# Maximum number of rendered pages held in memory per document at once
+MAX_IN_FLIGHT_PAGES = 10
+
+# On-disk cache of per-page extraction results
+PAGE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "summary_of_injuries", "pages")
+PAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Maximum pooled HTTP connections used by the asyncio pipeline
+ASYNC_MAX_CONNECTIONS = 500
+
+# OpenAI rate limit budgets shared by every API call in the process
+RATE_LIMIT_REQUESTS_PER_MINUTE = 5000
+RATE_LIMIT_TOKENS_PER_MINUTE = 2000000
+
+# Retry policy for rate limited or transient API failures
+MAX_API_RETRIES = 6
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+# Local ICD-10-CM code index built from the CMS code description file
+ICD10_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".cache", "summary_of_injuries", "icd10cm.sqlite3")
+
+# Minimum match confidence (0-1) for using the local index instead of web search
+ICD10_MIN_CONFIDENCE = 0.75
+
+# --fast-icd: structured output of the single call that extracts the visit
+# details and candidate ICD-10 codes, and the minimum match (0-1) between a
+# candidate's description and the index's description of its code for the
+# candidate to be accepted without a web search
+CODE_DIAGNOSIS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "coded_diagnosis",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "date_of_visit": {"type": "string"},
+                "diagnosis": {"type": "string"},
+                "reference": {"type": "string"},
+                "query": {"type": "string"},
+                "icd10_candidates": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "code": {"type": "string"},
+                            "description": {"type": "string"},
+                        },
+                        "required": ["code", "description"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["date_of_visit", "diagnosis", "reference", "query", "icd10_candidates"],
+            "additionalProperties": False,
+        },
+    },
+}
+ICD10_CANDIDATE_MIN_CONFIDENCE = 0.6
+
+# Persistent diagnosis -> ICD-10 code cache shared across documents and runs
+DIAGNOSIS_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "summary_of_injuries", "diagnoses.sqlite3")
+DIAGNOSIS_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Combine mode: "single" sends all pages in one request, "chunked" combines
+# windows of pages in parallel and stitches them, "auto" chunks long documents
+COMBINE_MODE = "auto"
+COMBINE_CHUNK_PAGES = 10
+COMBINE_CHUNK_OVERLAP = 1
+
+# Pages with an embedded text layer skip rasterization: "llm" sends the text to a
+# text-only extraction request, "direct" uses the text as-is, "off" always uses vision
+TEXT_LAYER_MODE = "llm"
+
+# Minimum non-whitespace characters and alphanumeric ratio for a usable text layer
+TEXT_LAYER_MIN_CHARS = 200
+TEXT_LAYER_MIN_ALNUM_RATIO = 0.6
+
+# With --text-layer direct, every this many columns of indentation is one
+# level of dashes, up to the maximum level; lines indented further are centered
+# or right-aligned text and are kept unindented
+TEXT_LAYER_INDENT_COLUMNS = 4
+TEXT_LAYER_MAX_INDENT_LEVEL = 2
+
+# Page image preprocessing before vision extraction
+IMAGE_GRAYSCALE = True
+IMAGE_CROP_MARGINS = True
+# Downscale to the size the model would resize the image to anyway
+IMAGE_FIT_TILE_GRID = True
+# "jpeg", "png", or "auto" to pick the smallest encoding meeting the quality target
+IMAGE_FORMAT = "auto"
+IMAGE_JPEG_QUALITY = 85
+IMAGE_JPEG_QUALITY_CANDIDATES = (40, 55, 70, 85)
+# Minimum PSNR (dB) of a lossy encoding against the preprocessed page in "auto" mode
+IMAGE_QUALITY_TARGET_PSNR = 30.0
+
+# File name of the run journal kept in the output folder for --resume
+RUN_JOURNAL_FILENAME = "run_journal.sqlite3"
+
+# File name of the date-indexed record store the summary is written from,
+# kept in the output folder, and rows read from it at a time while writing
+SUMMARY_STORE_FILENAME = "summary_records.sqlite3"
+SUMMARY_STORE_FETCH_ROWS = 500
+
+# Coordinator/worker mode: file name of the work queue kept in the output folder,
+# how long a worker's lease on a document lasts without being renewed (workers
+# renew every third of it), how often idle workers and the coordinator poll the
+# queue, and how many times a document is attempted before it is given up on
+QUEUE_FILENAME = "work_queue.sqlite3"
+QUEUE_LEASE_SECONDS = 120
+QUEUE_POLL_INTERVAL_SECONDS = 2.0
+QUEUE_MAX_ATTEMPTS = 3
+
+# OpenAI Batch API settings used with --batch
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_POLL_INTERVAL_SECONDS = 60
+# Per-batch input limits of the Batch API (50,000 requests, 200 MB), with headroom on size
+BATCH_MAX_REQUESTS_PER_FILE = 50000
+BATCH_MAX_FILE_BYTES = 190 * 1024 * 1024
+# Folder in the output folder where batch input and output files are kept
+BATCH_WORK_DIRNAME = "batches"
+
+# USD prices per million (input, cached input, output) tokens, used to estimate
+# run cost; cached input tokens are prompt tokens served from the prompt cache
+MODEL_PRICING = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+# Batch API requests are billed at half price
+BATCH_PRICE_MULTIPLIER = 0.5
+# USD cost of one SerpAPI search on the plan in use
+SERPAPI_COST_PER_SEARCH = 0.015
+
+# --early-exit: number of leading pages (visit date, provider) extracted first,
+# together with text layer pages that mention a diagnosis, to speculate the record
+EARLY_EXIT_LEADING_PAGES = 2
+
+# Folder in the output folder where --stream writes each document's combined
+# markdown as it is generated
+MARKDOWN_DIRNAME = "markdown"
+
+# Unix socket a warm worker (--serve) listens on for runs handed over by warm_worker.py
+WARM_WORKER_SOCKET = os.path.join(os.path.expanduser("~"), ".cache", "summary_of_injuries", "warm_worker.sock")
+
+# File name of the JSON run report written to the output folder
+RUN_REPORT_FILENAME = "run_report.json"
+
+# Parallel rasterization: threads in the shared render pool (each runs a
+# pdftoppm process), pages rendered per pdftoppm call, and where rendered
+# pages are written (shared memory when available, else the system temp dir)
+RENDER_WORKERS = os.cpu_count() or 1
+RENDER_CHUNK_PAGES = 4
+RENDER_TEMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+# Rendered pages waiting to be loaded, across all documents. They are kept as
+# uncompressed files, in RAM when in /dev/shm: about 11 MB per RGB page at
+# 200 DPI, so 24 pages hold about 270 MB
+RENDER_AHEAD_MAX_PAGES = 24
+
+# Page filter: pages where no character-sized block has more than this fraction
+# of ink are skipped as blank (duplicates must match an earlier page exactly)
+BLANK_PAGE_MAX_BLOCK_INK = 0.02
+# Number of pages the duplicate filter remembers per run
+PAGE_FILTER_MAX_PAGES = 5000
+
+# Watch mode: events are gathered for this long after the first one so a burst
+# of copied PDFs is processed as one batch; the polling fallback (where inotify
+# is unavailable) rescans the input folder at this interval
+WATCH_SETTLE_SECONDS = 1.0
+WATCH_POLL_INTERVAL_SECONDS = 2.0
@@ -0,0 +1,159 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from config import DIAGNOSIS_CACHE_TTL_SECONDS
+from icd10_index import tokenize
+
+
+def normalize_diagnosis(text):
+    """Normalize a diagnosis or query so equivalent wordings share a cache key.
+
+    Case, punctuation and filler words such as "ICD-10 code for" are ignored,
+    so "Cervicalgia." and "ICD-10 code for cervicalgia" match. Word order is
+    kept, since it ties each side and body part to its injury.
+    """
+    return " ".join(tokenize(text or ""))
+
+
+class DiagnosisCache:
+    """Persistent diagnosis -> ICD-10 code cache with TTL and in-flight request coalescing.
+
+    Concurrent documents asking for the same normalized diagnosis share a
+    single lookup: the first caller resolves it and the others wait for its
+    result instead of starting their own.
+    """
+
+    def __init__(self, path, ttl_seconds=DIAGNOSIS_CACHE_TTL_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS diagnosis_codes (
+                key TEXT PRIMARY KEY,
+                code TEXT NOT NULL,
+                diagnosis TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._connection.commit()
+
+    def get(self, key):
+        """Return the cached code for a normalized key, or None if missing or expired."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT code, created_at FROM diagnosis_codes WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        code, created_at = row
+        if time.time() - created_at > self.ttl_seconds:
+            with self._lock:
+                self.expired += 1
+            return None
+        return code
+
+    def put(self, key, code, diagnosis):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO diagnosis_codes (key, code, diagnosis, created_at) VALUES (?, ?, ?, ?)",
+                (key, code, diagnosis, time.time()),
+            )
+            self._connection.commit()
+
+    def _claim(self, key):
+        """Return (future, is_owner) for a key, registering a new in-flight lookup if needed."""
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self._in_flight[key] = future
+            self.misses += 1
+            return future, True
+
+    def _finish(self, key, future, diagnosis, code=None, error=None):
+        if code:
+            self.put(key, code, diagnosis)
+        with self._lock:
+            del self._in_flight[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(code)
+
+    def _lookup(self, diagnosis, query):
+        key = normalize_diagnosis(diagnosis) or normalize_diagnosis(query)
+        code = self.get(key) if key else None
+        if code:
+            with self._lock:
+                self.hits += 1
+        return key, code
+
+    def get_or_resolve(self, diagnosis, query, resolver):
+        """Return the code for a diagnosis, calling `resolver()` at most once per key at a time."""
+        key, code = self._lookup(diagnosis, query)
+        if not key:
+            return resolver()
+        if code:
+            logging.info(f"Using cached ICD-10 code {code} for '{diagnosis}'.")
+            return code
+
+        future, is_owner = self._claim(key)
+        if not is_owner:
+            logging.info(f"Waiting for in-flight ICD-10 lookup of '{diagnosis}'.")
+            return future.result()
+        try:
+            code = resolver()
+        except BaseException as e:
+            self._finish(key, future, diagnosis, error=e)
+            raise
+        self._finish(key, future, diagnosis, code=code)
+        return code
+
+    async def get_or_resolve_async(self, diagnosis, query, resolver):
+        """Async version of get_or_resolve; `resolver` is a coroutine function."""
+        key, code = self._lookup(diagnosis, query)
+        if not key:
+            return await resolver()
+        if code:
+            logging.info(f"Using cached ICD-10 code {code} for '{diagnosis}'.")
+            return code
+
+        future, is_owner = self._claim(key)
+        if not is_owner:
+            logging.info(f"Waiting for in-flight ICD-10 lookup of '{diagnosis}'.")
+            return await asyncio.wrap_future(future)
+        try:
+            code = await resolver()
+        except BaseException as e:
+            self._finish(key, future, diagnosis, error=e)
+            raise
+        self._finish(key, future, diagnosis, code=code)
+        return code
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM diagnosis_codes")
+            self._connection.commit()
+        logging.info(f"Cleared diagnosis cache '{self.path}'.")
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "coalesced": self.coalesced,
+        }
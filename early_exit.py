@@ -0,0 +1,136 @@
+import json
+import logging
+import re
+import threading
+
+from config import EARLY_EXIT_LEADING_PAGES
+
+# A line of page content that opens the assessment of a visit, e.g. "Assessment: ..." or "-- Final Diagnosis"
+DIAGNOSIS_LINE_RE = re.compile(
+    r"^[\s>*#-]*(?:[A-Za-z]+\s+){0,2}(?:assessment|diagnos[ie]s|impression)\b", re.IGNORECASE | re.MULTILINE
+)
+
+
+def has_diagnosis(text):
+    """Return True if page text has a line that opens an assessment, diagnosis or impression."""
+    return DIAGNOSIS_LINE_RE.search(text or "") is not None
+
+
+def diagnosis_items(content):
+    """Return the normalized diagnosis items of a page's content.
+
+    An item is a diagnosis line together with the lines nested under it
+    (those with more leading dashes), so "- Diagnosis" followed by
+    "-- acute bronchitis" is one item.
+    """
+    items = set()
+    lines = (content or "").splitlines()
+    for index, line in enumerate(lines):
+        if not DIAGNOSIS_LINE_RE.match(line):
+            continue
+        depth = len(line.strip()) - len(line.strip().lstrip("-"))
+        item = [line]
+        for nested in lines[index + 1:]:
+            if len(nested.strip()) - len(nested.strip().lstrip("-")) <= depth:
+                break
+            item.append(nested)
+        items.add(" ".join(" ".join(item).split()).lower())
+    return items
+
+
+def pages_to_markdown(pages):
+    """Render extracted page JSON objects as markdown with the combine stage's page indicators."""
+    sections = []
+    for page in pages:
+        parts = [page.get("header"), page.get("content"), page.get("footer")]
+        sections.append(f"<!-- BEGIN PAGE: p. {page['page_number']} -->\n" + "\n\n".join(part for part in parts if part))
+    return "\n\n".join(sections)
+
+
+class EarlyExit:
+    """Speculative extraction of a document's record from its leading and diagnosis pages.
+
+    The leading pages (for the visit date and provider) and the text layer
+    pages that mention a diagnosis are extracted first. Once they are all
+    in and a page extracted so far has a diagnosis, `start` is called with
+    markdown built from the leading and diagnosis pages, and returns a
+    future or task that generates the query and resolves the ICD-10 code
+    while the rest of the document is still being extracted.
+    """
+
+    def __init__(self, start, pdf_file, leading_pages=EARLY_EXIT_LEADING_PAGES):
+        self.start = start
+        self.pdf_file = pdf_file
+        self.leading_pages = leading_pages
+        self.handle = None
+        self.pages_used = None
+        self._lock = threading.Lock()
+        self._awaited = set()
+        self._leading = set()
+        self._pages = {}
+        self._items = {}
+
+    def prioritize(self, page_count, text_pages, journaled_pages):
+        """Return the pages to extract first, given the text layer pages and the pages journaled earlier."""
+        self._leading = set(range(min(self.leading_pages, page_count)))
+        priority_pages = self._leading | {
+            page_number for page_number, page_text in text_pages.items() if has_diagnosis(page_text)
+        }
+        with self._lock:
+            self._awaited = priority_pages - set(journaled_pages)
+        for page_number, assistant_message in journaled_pages.items():
+            self.add_page(page_number, assistant_message)
+        return priority_pages
+
+    def add_page(self, page_number, assistant_message):
+        """Record an extracted page (None if its extraction failed); start the speculation when ready."""
+        try:
+            page = json.loads(assistant_message) if assistant_message else None
+        except json.JSONDecodeError:
+            page = None
+        with self._lock:
+            self._awaited.discard(page_number)
+            if isinstance(page, dict):
+                page["page_number"] = page_number + 1
+                self._pages[page_number] = page
+                self._items[page_number] = diagnosis_items(page.get("content"))
+            if self.handle is not None or self._awaited or not any(self._items.values()):
+                return
+            self.pages_used = sorted(page_number for page_number in self._pages
+                                     if page_number in self._leading or self._items[page_number])
+            markdown = pages_to_markdown([self._pages[page_number] for page_number in self.pages_used])
+            logging.info(f"Extracting the record of '{self.pdf_file}' early from pages "
+                         f"{', '.join(str(page_number + 1) for page_number in self.pages_used)}.")
+            self.handle = self.start(markdown)
+
+    def skip_page(self, page_number):
+        """Stop waiting for a page that will not be extracted, such as a blank page."""
+        self.add_page(page_number, None)
+
+    def add_duplicate(self, page_number, original):
+        """Record a duplicate page once the future or task of the page it repeats is done."""
+        def done(handle):
+            if handle.cancelled() or handle.exception() is not None:
+                self.skip_page(page_number)
+            else:
+                self.add_page(page_number, handle.result()[1])
+        original.add_done_callback(done)
+
+    def reconcile(self, page_contents):
+        """Return the speculation's future or task if it holds for the document's final pages, else None.
+
+        It holds if every diagnosis on a page it did not see repeats one it
+        did see, as copied-forward assessments on later pages do.
+        """
+        if self.handle is None:
+            return None
+        with self._lock:
+            seen = set().union(*(self._items[page_number] for page_number in self.pages_used))
+            used = {page_number + 1 for page_number in self.pages_used}
+        for page in page_contents:
+            if page["page_number"] not in used and diagnosis_items(page.get("content")) - seen:
+                logging.info(f"Page {page['page_number']} of '{self.pdf_file}' has a diagnosis the early record "
+                             f"did not see; extracting the record from the combined document.")
+                self.handle.cancel()
+                return None
+        return self.handle
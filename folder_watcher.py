@@ -0,0 +1,163 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+from config import WATCH_POLL_INTERVAL_SECONDS, WATCH_SETTLE_SECONDS
+
+# inotify event masks from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+# Events after which the watch is gone or events were dropped, so the folder has to be rescanned
+RESCAN_MASK = IN_Q_OVERFLOW | IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def list_pdf_files(folder):
+    """Return the paths of the PDF files in a folder, sorted by name."""
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.lower().endswith('.pdf')]
+
+
+class InotifyWatcher:
+    """Reports PDFs written, moved in, moved out or deleted in a folder, using Linux inotify.
+
+    Only IN_CLOSE_WRITE and moves are watched rather than every write, so a
+    PDF that is still being copied is not reported until its writer closes it.
+    """
+
+    def __init__(self, folder, settle_seconds=WATCH_SETTLE_SECONDS):
+        self.folder = folder
+        self.settle_seconds = settle_seconds
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+        if libc.inotify_add_watch(self._fd, os.fsencode(folder), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, f"inotify_add_watch failed for '{folder}': {os.strerror(error)}")
+
+    def _read_events(self, names):
+        """Add the PDF names of all pending events to `names`; return False if the folder must be rescanned."""
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return True
+        complete = True
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & RESCAN_MASK:
+                complete = False
+            elif name.lower().endswith('.pdf'):
+                names.add(name)
+        return complete
+
+    def wait(self, timeout=None):
+        """Block until PDFs change, then return their names, or None if events were lost.
+
+        Once the first event arrives, events are gathered for another
+        `settle_seconds` so a burst of copied files is handled as one batch.
+        Returns an empty set if `timeout` seconds pass without a change.
+        """
+        names = set()
+        complete = True
+        deadline = None
+        while True:
+            if deadline is None:
+                wait_seconds = timeout
+            else:
+                wait_seconds = max(0.0, deadline - time.monotonic())
+            readable, _, _ = select.select([self._fd], [], [], wait_seconds)
+            if readable:
+                complete = self._read_events(names) and complete
+                if deadline is None and (names or not complete):
+                    deadline = time.monotonic() + self.settle_seconds
+            elif deadline is not None or timeout is not None:
+                return names if complete else None
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """Reports PDFs added, changed or removed in a folder by comparing directory listings.
+
+    Used where inotify is not available, such as macOS or some network file
+    systems. A file is only reported once its size and modification time
+    have stayed the same for one poll, so partially copied PDFs are skipped.
+    """
+
+    def __init__(self, folder, poll_interval=WATCH_POLL_INTERVAL_SECONDS):
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self._reported = self._scan()
+        self._previous = self._reported
+
+    def _scan(self):
+        snapshot = {}
+        for path in list_pdf_files(self.folder):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            snapshot[os.path.basename(path)] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout=None):
+        """Block until PDFs change and have settled, then return their names, or None if the folder is gone.
+
+        Returns an empty set if `timeout` seconds pass without a change.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                current = self._scan()
+            except FileNotFoundError:
+                return None
+            changed = {
+                name for name in set(current) | set(self._reported)
+                if current.get(name) != self._reported.get(name) and current.get(name) == self._previous.get(name)
+            }
+            self._previous = current
+            if changed:
+                for name in changed:
+                    if name in current:
+                        self._reported[name] = current[name]
+                    else:
+                        self._reported.pop(name, None)
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            time.sleep(self.poll_interval)
+
+    def close(self):
+        pass
+
+
+def create_watcher(folder, poll_interval=WATCH_POLL_INTERVAL_SECONDS):
+    """Return an inotify watcher for `folder`, or a polling watcher where inotify is unavailable."""
+    try:
+        return InotifyWatcher(folder)
+    except (AttributeError, OSError) as e:
+        # AttributeError: the C library has no inotify functions (not Linux)
+        logging.info(f"inotify is not available ({e}); polling '{folder}' every {poll_interval}s instead.")
+        return PollingWatcher(folder, poll_interval)
@@ -1,181 +1,878 @@
 import sys
 import os
+import argparse
 import logging
-import json
+import signal
+import socket
+import tempfile
+import threading
+import time
 import concurrent.futures
-from pdf2image import convert_from_path
-
-from utils import extract_text_from_image, combine_page_contents, extract_icd10_code_from_results, \
-    search_icd10_code, generate_search_query
-
-
-def process_pdf_file(pdf_path):
+import multiprocessing
+
+from config import MAX_IN_FLIGHT_PAGES, PAGE_CACHE_DIR, PAGE_CACHE_MAX_BYTES, MAX_CONCURRENCY, \
+    MAX_CONCURRENT_DOCUMENTS, RATE_LIMIT_REQUESTS_PER_MINUTE, RATE_LIMIT_TOKENS_PER_MINUTE, ICD10_INDEX_PATH, \
+    DIAGNOSIS_CACHE_PATH, COMBINE_MODE, TEXT_LAYER_MODE, RENDER_DPI, IMAGE_FORMAT, RUN_JOURNAL_FILENAME, \
+    BATCH_WORK_DIRNAME, RUN_REPORT_FILENAME, WATCH_POLL_INTERVAL_SECONDS, QUEUE_FILENAME, QUEUE_POLL_INTERVAL_SECONDS, \
+    MARKDOWN_DIRNAME, SUMMARY_STORE_FILENAME, WARM_WORKER_SOCKET
+from diagnosis_cache import DiagnosisCache
+from early_exit import EarlyExit
+from folder_watcher import create_watcher, list_pdf_files
+from icd10_index import build_icd10_index, load_icd10_index
+from image_preprocessing import ImageSettings
+from metrics import reset_metrics, timed, timed_document, write_report, write_prometheus_textfile, \
+    export_opentelemetry
+from page_cache import PageCache
+from page_filter import PageFilter, page_signature
+from pipeline_options import PipelineOptions
+from scheduler import Scheduler, get_default_scheduler, PRIORITY_HIGH, PRIORITY_NORMAL
+from rate_limiter import configure_rate_limiter
+from rasterizer import count_pdf_pages, iter_pdf_pages
+from run_journal import RunJournal
+from streaming import MarkdownStream, is_early_extraction_valid
+from summary_store import SummaryStore, SUMMARY_WRITERS
+from text_layer import read_text_layer, text_layer_to_page_json
+from warm_worker import serve
+from work_queue import WorkQueue
+from utils import extract_text_from_image, extract_text_from_text_layer, combine_page_contents, \
+    extract_icd10_code_from_results, search_icd10_code, generate_search_query, parse_page_results, \
+    parse_combined_markdown, log_extracted_info, build_record, is_valid_json, resolve_icd10_code_locally, \
+    split_combine_windows, stitch_combined_chunks, should_chunk_combine, code_diagnosis, validate_icd10_candidates, \
+    markdown_output_path, save_markdown, encode_page, get_client
+
+
+@timed_document
+def process_pdf_file(pdf_path, options=None, scheduler=None):
     """Process a single PDF file and generate the markdown summary."""
+    if options is None:
+        options = PipelineOptions()
+    if scheduler is None:
+        scheduler = get_default_scheduler()
+    journal = options.journal
     pdf_file = os.path.basename(pdf_path)
     document_name = os.path.splitext(pdf_file)
     logging.info(f"Processing '{pdf_file}'...")
 
-    try:
-        images = convert_from_path(pdf_path)
-    except Exception as e:
-        logging.error(f"Error converting PDF to images '{pdf_file}': {e}")
-        return
-
-    def process_page(page_tuple):
-        page_number, image = page_tuple
-        logging.info(f"Processing page {page_number + 1} of '{pdf_file}'...")
-        assistant_message = extract_text_from_image(image, page_number=page_number + 1)
-        return page_number, assistant_message
-
-    # Initialize an empty list to store tuples of (page_number, assistant_message)
-    page_results = []
+    if journal is not None:
+        journal.begin_document(pdf_path)
+        record = journal.completed_record(pdf_path)
+        if record is not None:
+            logging.info(f"'{pdf_file}' was already processed; using the journaled record.")
+            return record
+
+    # Generate Search Query and Extract Information, with candidate codes in the same call for --fast-icd
+    extract_info = code_diagnosis if options.fast_icd else generate_search_query
+    stream = None
+    # (extracted_info, icd10_code) speculated from the leading and diagnosis pages with --early-exit
+    early_record = None
+
+    combined_markdown = journal.load_stage(pdf_path, "combined_markdown") if journal else None
+    if combined_markdown is None:
+        early_exit = None
+        if options.early_exit:
+            early_exit = EarlyExit(
+                lambda markdown: scheduler.submit_speculative(
+                    speculate_record, markdown, document_name, extract_info, options, scheduler, pdf_file
+                ),
+                pdf_file,
+            )
+        page_results = extract_pdf_pages(pdf_path, options, scheduler, early_exit)
+        if not page_results:
+            logging.warning(f"No valid content extracted from '{pdf_file}'.")
+            return
 
-    # Process pages in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        futures = []
-        for page_number, image in enumerate(images):
-            futures.append(executor.submit(process_page, (page_number, image)))
+        page_contents = parse_page_results(page_results, pdf_file)
+        if not page_contents:
+            logging.warning(f"No valid JSON content to combine for '{pdf_file}'.")
+            return
 
-        for future in concurrent.futures.as_completed(futures):
-            page_number, assistant_message = future.result()
-            if assistant_message:
-                # Store (page_number, assistant_message) as a tuple
-                page_results.append((page_number, assistant_message))
+        if early_exit is not None:
+            early_record = early_exit_record(early_exit, page_contents, pdf_file)
+
+        # With an early record, the pages are only combined if the markdown is saved
+        if early_record is None or options.markdown_dir is not None:
+            print("Combining pages...")
+            markdown_path = markdown_output_path(options.markdown_dir, pdf_file)
+            if options.stream and not should_chunk_combine(page_contents, options.combine_mode):
+                # Unless there is an early record, the visit details are extracted as soon as the
+                # diagnosis section has been generated
+                def on_diagnosis_section(prefix):
+                    return scheduler.submit_page(extract_info, prefix, document_name)
+                stream = MarkdownStream(markdown_path, None if early_record else on_diagnosis_section)
+                combined_message = scheduler.call(combine_page_contents, page_contents, stream=stream)
             else:
-                logging.error(f"Text extraction failed for page {page_number + 1} of '{pdf_file}'.")
-
-    # Ensure page_results is sorted by page_number
-    page_results.sort(key=lambda x: x[0])
+                combined_message = combine_pages(page_contents, scheduler, options.combine_mode)
+            combined_markdown = parse_combined_markdown(combined_message, pdf_file)
+            if combined_markdown is None:
+                if stream is not None:
+                    stream.discard()
+                    if stream.early_result is not None:
+                        stream.early_result.cancel()
+                if early_record is None:
+                    return
+            elif stream is not None:
+                stream.finish(combined_markdown)
+            elif markdown_path is not None:
+                save_markdown(markdown_path, combined_markdown)
+            if journal is not None and combined_markdown is not None:
+                journal.save_stage(pdf_path, "combined_markdown", combined_markdown)
+
+    extracted_info, icd10_code = early_record or (None, None)
+    if extracted_info is None and journal is not None:
+        extracted_info = journal.load_stage(pdf_path, "extracted_info")
+    if extracted_info is None:
+        extracted_info = early_extracted_info(stream, combined_markdown, pdf_file)
+        if extracted_info is None:
+            extracted_info = scheduler.call(extract_info, combined_markdown, document_name)
+        if not extracted_info:
+            logging.error(f"Failed to generate search query and extract information for '{pdf_file}'.")
+            return
+        if journal is not None:
+            journal.save_stage(pdf_path, "extracted_info", extracted_info)
 
-    if not page_results:
-        logging.warning(f"No valid content extracted from '{pdf_file}'.")
-        return
+    log_extracted_info(extracted_info)
 
-    # Now, process each page_result along with its page_number
-    page_contents = []
-    for page_number, page_result in page_results:
-        try:
-            page_json = json.loads(page_result)
-            page_json["page_number"] = page_number + 1  # Adjust for 1-based page numbers
-            page_contents.append(page_json)
-        except json.JSONDecodeError as e:
-            logging.error(f"Error parsing JSON on page {page_number + 1} of '{pdf_file}': {e}")
-            continue
-
-    if not page_contents:
-        logging.warning(f"No valid JSON content to combine for '{pdf_file}'.")
-        return
+    if icd10_code is None and journal is not None:
+        icd10_code = journal.load_stage(pdf_path, "icd10_code")
+    if icd10_code is None:
+        icd10_code = resolve_icd10_code(extracted_info, options, scheduler, pdf_file)
+        if not icd10_code:
+            logging.error(f"Failed to extract ICD-10 code for '{pdf_file}'.")
+            return
+        if journal is not None:
+            journal.save_stage(pdf_path, "icd10_code", icd10_code)
 
-    print("Combining pages...")
-    combined_message = combine_page_contents(page_contents)
+    logging.info(f"Extracted ICD-10 code: {icd10_code}")
 
-    if combined_message:
-        try:
-            combined_json = json.loads(combined_message)
-            if "markdown" in combined_json:
-                combined_markdown = combined_json["markdown"]
-
-                # Optional: Save the extracted markdown content to a file
-                # output_md_path = os.path.join(output_folder, f"{document_name}_summary.md")
-                # save_markdown(output_md_path, combined_markdown)
-
-                # Generate Search Query and Extract Information
-                extracted_info = generate_search_query(
-                    combined_markdown,
-                    document_name
-                )
-                if not extracted_info:
-                    logging.error(f"Failed to generate search query and extract information for '{pdf_file}'.")
-                    return
+    # Return the record to be added to the summary table
+    record = build_record(extracted_info, icd10_code)
+    if journal is not None:
+        journal.finish_document(pdf_path, record)
+    return record
 
-                date_of_visit = extracted_info["date_of_visit"]
-                diagnosis = extracted_info["diagnosis"]
-                reference = extracted_info["reference"]
-                query = extracted_info["query"]
 
-                logging.info(f"Extracted Date of Visit: {date_of_visit}")
-                logging.info(f"Extracted Diagnosis: {diagnosis}")
-                logging.info(f"Extracted Reference: {reference}")
-                logging.info(f"Generated Search Query: {query}")
+def extract_pdf_pages(pdf_path, options, scheduler, early_exit=None):
+    """Extract every page of a PDF, returning a list of (page_number, assistant_message) tuples.
 
-                # Perform Web Search
-                search_results = search_icd10_code(query)
-                if not search_results:
-                    logging.error(f"Failed to retrieve search results for '{pdf_file}'.")
-                    return
+    With an `early_exit`, its priority pages are extracted first and every
+    extracted page is reported to it.
+    """
+    page_cache = options.page_cache
+    journal = options.journal
+    pdf_file = os.path.basename(pdf_path)
 
-                # Extract ICD-10 Code from Results
-                icd10_code = extract_icd10_code_from_results(search_results)
-                if not icd10_code:
-                    logging.error(f"Failed to extract ICD-10 code for '{pdf_file}'.")
-                    return
+    try:
+        page_count = count_pdf_pages(pdf_path)
+    except Exception as e:
+        logging.error(f"Error reading PDF info for '{pdf_file}': {e}")
+        return
 
-                logging.info(f"Extracted ICD-10 code: {icd10_code}")
+    # Pages finished by an earlier, interrupted run are not extracted again
+    journaled_pages = journal.load_pages(pdf_path) if journal else {}
+    if journaled_pages:
+        logging.info(f"Resuming '{pdf_file}' with {len(journaled_pages)} of {page_count} pages already extracted.")
+    remaining_pages = [page_number for page_number in range(page_count) if page_number not in journaled_pages]
+
+    # Pages with a usable embedded text layer skip rasterization and vision
+    text_pages = {}
+    if options.text_layer_mode != "off" and remaining_pages:
+        text_pages = read_text_layer(pdf_path, page_count)
+        logging.info(f"{len(text_pages)} of {page_count} pages of '{pdf_file}' have an embedded text layer.")
+        text_pages = {page_number: text_pages[page_number] for page_number in remaining_pages
+                      if page_number in text_pages}
+    scanned_pages = [page_number for page_number in remaining_pages if page_number not in text_pages]
+
+    priority_pages = set()
+    if early_exit is not None:
+        priority_pages = early_exit.prioritize(page_count, text_pages, journaled_pages)
+
+    def priority(page_number):
+        return PRIORITY_HIGH if page_number in priority_pages else PRIORITY_NORMAL
+
+    def record_page(page_number, assistant_message):
+        if journal is not None and is_valid_json(assistant_message):
+            journal.save_page(pdf_path, page_number, assistant_message)
+        if early_exit is not None:
+            early_exit.add_page(page_number, assistant_message)
+        return page_number, assistant_message
 
-                # Collect the Record
-                record = {
-                    "date_of_visit": date_of_visit,
-                    "diagnosis": diagnosis,
-                    "icd10_code": icd10_code,
-                    "reference": reference,
-                }
+    def process_text_page(page_number, page_text):
+        if options.text_layer_mode == "direct":
+            return record_page(page_number, text_layer_to_page_json(page_text))
+
+        cache_key = None
+        if page_cache is not None:
+            cache_key = page_cache.key_for_text(page_text)
+            cached_message = page_cache.get(cache_key)
+            if cached_message is not None:
+                logging.info(f"Using cached result for page {page_number + 1} of '{pdf_file}'.")
+                return record_page(page_number, cached_message)
+
+        logging.info(f"Processing text layer of page {page_number + 1} of '{pdf_file}'...")
+        assistant_message = extract_text_from_text_layer(page_text, page_number=page_number + 1)
+        if cache_key is not None and is_valid_json(assistant_message):
+            page_cache.put(cache_key, assistant_message)
+        return record_page(page_number, assistant_message)
+
+    # Pages are rendered one at a time as slots free up, so at most
+    # MAX_IN_FLIGHT_PAGES rendered images are held in memory at once
+    in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT_PAGES)
+
+    def process_page(page_number, image):
+        # The rendered image is released as soon as the page is encoded, so
+        # only the encoded page is held while its request is in flight
+        try:
+            cache_key = None
+            if page_cache is not None:
+                cache_key = page_cache.key_for_image(image, options.dpi, options.image_settings.cache_tag())
+                cached_message = page_cache.get(cache_key)
+                if cached_message is not None:
+                    logging.info(f"Using cached result for page {page_number + 1} of '{pdf_file}'.")
+                    return record_page(page_number, cached_message)
+            page = encode_page(image, options.image_settings, page_number=page_number + 1)
+        finally:
+            image.close()
+            in_flight.release()
 
-                # Return the record to be added to the summary table
-                return record
-            else:
-                logging.error(f"No 'markdown' key found in combined response for '{pdf_file}'.")
-                return
-        except json.JSONDecodeError as e:
-            logging.error(f"Error parsing combined JSON for '{pdf_file}': {e}")
-            return
-    else:
-        logging.error(f"Content combination failed for '{pdf_file}'.")
+        logging.info(f"Processing page {page_number + 1} of '{pdf_file}'...")
+        assistant_message = extract_text_from_image(page, page_number=page_number + 1)
+        if cache_key is not None and is_valid_json(assistant_message):
+            page_cache.put(cache_key, assistant_message)
+        return record_page(page_number, assistant_message)
+
+    # Initialize the list of (page_number, assistant_message) tuples with journaled pages
+    page_results = list(journaled_pages.items())
+
+    # Process pages in parallel on the shared page pool as they are rendered
+    futures = [
+        scheduler.submit_page(process_text_page, page_number, page_text, priority=priority(page_number))
+        for page_number, page_text in text_pages.items()
+    ]
+    # Blank pages are skipped and exact repeats of pages seen earlier in the
+    # run (in any document) reuse that page's result instead of being sent
+    page_filter = options.page_filter
+    blank_pages = 0
+    duplicates = {}
+    try:
+        for page_number, image in iter_pdf_pages(pdf_path, scanned_pages, slots=in_flight, dpi=options.dpi):
+            if page_filter is not None:
+                signature = page_signature(image)
+                verdict, original = page_filter.check(signature)
+                if verdict != "new":
+                    image.close()
+                    in_flight.release()
+                    if verdict == "blank":
+                        blank_pages += 1
+                        if early_exit is not None:
+                            early_exit.skip_page(page_number)
+                    else:
+                        duplicates[page_number] = original
+                        if early_exit is not None:
+                            early_exit.add_duplicate(page_number, original)
+                    continue
+            future = scheduler.submit_page(process_page, page_number, image, priority=priority(page_number))
+            if page_filter is not None:
+                page_filter.register(signature, future)
+            futures.append(future)
+    except Exception as e:
+        logging.error(f"Error converting PDF to images '{pdf_file}': {e}")
+        for future in futures:
+            future.cancel()
+        return
 
+    for future in concurrent.futures.as_completed(futures):
+        page_number, assistant_message = future.result()
+        if assistant_message:
+            # Store (page_number, assistant_message) as a tuple
+            page_results.append((page_number, assistant_message))
+        else:
+            logging.error(f"Text extraction failed for page {page_number + 1} of '{pdf_file}'.")
 
-def generate_summary_table(records, output_folder):
-    """Generate the summary table as a PDF or acceptable text format."""
-    # Sort records in reverse chronological order (latest date first)
-    # For simplicity, dates are treated as strings; parsing may be needed for proper sorting
-    records_sorted = sorted(records, key=lambda x: x['date_of_visit'], reverse=True)
+    for page_number, original in duplicates.items():
+        try:
+            _, assistant_message = original.result()
+        except (Exception, concurrent.futures.CancelledError):
+            assistant_message = None
+        if assistant_message:
+            page_results.append(record_page(page_number, assistant_message))
+        else:
+            logging.error(f"Text extraction failed for page {page_number + 1} of '{pdf_file}' "
+                          f"(a duplicate of a page that failed).")
 
-    # Create a simple Markdown table
-    table_lines = [
-        "| Date of Visit | Diagnosis | ICD-10 Code | Reference |",
-        "|---------------|-----------|-------------|-----------|",
-    ]
+    if blank_pages or duplicates:
+        logging.info(f"Skipped {blank_pages} blank and {len(duplicates)} duplicate pages of '{pdf_file}'.")
 
-    for record in records_sorted:
-        line = f"| {record['date_of_visit']} | {record['diagnosis']} | {record['icd10_code']} | {record['reference']} |"
-        table_lines.append(line)
+    return page_results
 
-    summary_content = "\n".join(table_lines)
 
-    # Save the summary to a markdown file
-    output_summary_path = os.path.join(output_folder, "summary_of_injuries.md")
-    with open(output_summary_path, 'w', encoding='utf-8') as f:
-        f.write(summary_content)
+def speculate_record(markdown, document_name, extract_info, options, scheduler, pdf_file):
+    """Extract the visit details from part of a document and resolve their ICD-10 code; return both, or None."""
+    try:
+        extracted_info = scheduler.call(extract_info, markdown, document_name)
+        if not extracted_info:
+            return None
+        icd10_code = resolve_icd10_code(extracted_info, options, scheduler, pdf_file)
+    except Exception as e:
+        logging.error(f"Error extracting the early record of '{pdf_file}': {e}")
+        return None
+    return (extracted_info, icd10_code) if icd10_code else None
+
+
+def early_exit_record(early_exit, page_contents, pdf_file):
+    """Return the (extracted_info, icd10_code) speculated by `early_exit` if it holds for every page, or None."""
+    handle = early_exit.reconcile(page_contents)
+    early_record = handle.result() if handle is not None else None
+    if early_record:
+        logging.info(f"Using the record extracted early from the leading and diagnosis pages of '{pdf_file}'.")
+    return early_record
+
+
+def early_extracted_info(stream, combined_markdown, pdf_file):
+    """Return the information extracted while the markdown was streaming, if it holds for the complete markdown."""
+    if stream is None or stream.early_result is None:
+        return None
+    if not is_early_extraction_valid(stream.early_prefix, combined_markdown):
+        logging.info(f"The diagnosis of '{pdf_file}' changed after it was first extracted; extracting it again.")
+        stream.early_result.cancel()
+        return None
+    extracted_info = stream.early_result.result()
+    if extracted_info:
+        logging.info(f"Using the visit details extracted from '{pdf_file}' while it was being combined.")
+    return extracted_info
+
+
+def resolve_icd10_code(extracted_info, options, scheduler, pdf_file):
+    """Resolve the ICD-10 code for a document's diagnosis, sharing lookups through the diagnosis cache."""
+    def lookup_icd10_code():
+        # Use the model's own candidate code (--fast-icd) when it passes the local checks
+        code = validate_icd10_candidates(options.icd10_index, extracted_info)
+        if code:
+            return code
+
+        # Resolve the code from the local ICD-10-CM index when it is confident enough
+        code = resolve_icd10_code_locally(options.icd10_index, extracted_info)
+        if code:
+            return code
+
+        # Perform Web Search
+        search_results = scheduler.call(search_icd10_code, extracted_info["query"])
+        if not search_results:
+            logging.error(f"Failed to retrieve search results for '{pdf_file}'.")
+            return None
+
+        # Extract ICD-10 Code from Results
+        return scheduler.call(extract_icd10_code_from_results, search_results)
+
+    if options.diagnosis_cache is not None:
+        return options.diagnosis_cache.get_or_resolve(
+            extracted_info["diagnosis"], extracted_info["query"], lookup_icd10_code
+        )
+    return lookup_icd10_code()
+
+
+def combine_pages(page_contents, scheduler, combine_mode=COMBINE_MODE):
+    """Combine page contents, in parallel windows for long documents."""
+    if not should_chunk_combine(page_contents, combine_mode):
+        return scheduler.call(combine_page_contents, page_contents)
+
+    windows = split_combine_windows(page_contents)
+    logging.info(f"Combining {len(page_contents)} pages in {len(windows)} chunks...")
+    futures = [scheduler.submit_page(combine_page_contents, window_pages) for window_pages, _ in windows]
+    return stitch_combined_chunks([future.result() for future in futures], windows)
+
+
+def process_pdf_files(pdf_files, options=None, max_concurrency=MAX_CONCURRENCY,
+                      max_documents=MAX_CONCURRENT_DOCUMENTS):
+    """Process PDFs concurrently on a shared scheduler, returning their results in input order."""
+    scheduler = Scheduler(max_concurrency=max_concurrency, max_documents=max_documents)
+
+    # Documents run concurrently on the shared scheduler; results are collected
+    # in input order so the record list is deterministic
+    futures = [
+        scheduler.submit_document(process_pdf_file, pdf_file, options=options, scheduler=scheduler)
+        for pdf_file in pdf_files
+    ]
 
-    logging.info(f"Summary of Injuries saved to '{output_summary_path}'.")
+    results = []
+    for pdf_file, future in zip(pdf_files, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            logging.error(f"Unexpected error processing '{pdf_file}': {e}")
+            results.append(None)
+
+    scheduler.shutdown()
+    return results
+
+
+@timed("summary_table")
+def generate_summary_table(store, output_folder, export_formats=()):
+    """Write the summary table, and any requested exports, from the record store in date order."""
+    for extension in ("md", *export_formats):
+        # Replace each file atomically so readers never see a partial summary
+        output_path = os.path.join(output_folder, f"summary_of_injuries.{extension}")
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=output_folder, suffix=f".{extension}.tmp",
+                                         newline='' if extension == "csv" else None, delete=False) as f:
+            SUMMARY_WRITERS[extension](store.iter_records(), f)
+        os.replace(f.name, output_path)
+        logging.info(f"Summary of Injuries saved to '{output_path}'.")
 
     # Optionally, convert the markdown to PDF using a library like `pdfkit` or `weasyprint`
     # For now, we will keep it in markdown format as acceptable per instructions
 
 
-def main():
-    if len(sys.argv) != 3:
-        print("Usage: python generate_summary_of_injuries.py /path/to/input/folder /path/to/output/folder")
-        sys.exit(1)
-
-    input_folder = sys.argv[1]
-    output_folder = sys.argv[2]
-
-    # Configure logging
+def configure_logging():
     logging.basicConfig(
         level=logging.INFO,
         format='[%(asctime)s] %(levelname)s:%(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
 
+
+def clear_caches(args):
+    """Remove all cached page extraction results and diagnosis codes."""
+    PageCache(args.cache_dir, PAGE_CACHE_MAX_BYTES).clear()
+    DiagnosisCache(args.diagnosis_cache).clear()
+
+
+def build_pipeline_options(args, journal=None):
+    """Open the caches and index selected on the command line and collect the run-wide pipeline settings."""
+    page_cache = None if args.no_cache else PageCache(args.cache_dir, PAGE_CACHE_MAX_BYTES)
+    diagnosis_cache = None if args.no_diagnosis_cache else DiagnosisCache(args.diagnosis_cache)
+    icd10_index = None if args.no_icd10_index else load_icd10_index(args.icd10_index)
+    if args.fast_icd and icd10_index is None:
+        logging.warning("--fast-icd needs the local ICD-10-CM index to verify candidate codes; without it every "
+                        "code is looked up on the web. Build it with --build-icd10-index.")
+    page_filter = None if args.no_page_filter else PageFilter()
+
+    return PipelineOptions(
+        page_cache=page_cache,
+        icd10_index=icd10_index,
+        diagnosis_cache=diagnosis_cache,
+        journal=journal,
+        page_filter=page_filter,
+        combine_mode=args.combine_mode,
+        text_layer_mode=args.text_layer,
+        dpi=args.dpi,
+        image_settings=ImageSettings(
+            grayscale=not args.color,
+            crop_margins=not args.no_crop,
+            image_format=args.image_format,
+            report_savings=args.report_image_savings,
+        ),
+        fast_icd=args.fast_icd,
+        stream=args.stream,
+        early_exit=args.early_exit,
+        markdown_dir=(
+            os.path.join(args.output_folder, MARKDOWN_DIRNAME) if args.stream and args.output_folder else None
+        ),
+    )
+
+
+def run_pipeline(pdf_files, args, options):
+    """Process PDFs with the pipeline selected on the command line, returning their results in input order."""
+    if args.batch:
+        # Imported here so interactive runs do not pay for the batch pipeline
+        import batch_pipeline
+        backend = batch_pipeline.LocalBatchBackend(args.concurrency) if args.batch == "local" \
+            else batch_pipeline.OpenAIBatchBackend()
+        return batch_pipeline.process_pdf_files(
+            pdf_files,
+            os.path.join(args.output_folder, BATCH_WORK_DIRNAME),
+            options=options,
+            backend=backend,
+        )
+    if args.use_async:
+        # Imported here so the threaded pipeline does not pay for the async stack
+        import async_pipeline
+        return async_pipeline.run(
+            pdf_files,
+            options=options,
+            max_concurrency=args.concurrency,
+            max_documents=args.max_documents,
+        )
+    return process_pdf_files(
+        pdf_files,
+        options=options,
+        max_concurrency=args.concurrency,
+        max_documents=args.max_documents,
+    )
+
+
+def log_run_stats(options, rate_limiter):
+    """Log rate limiting, page filter and cache statistics."""
+    if rate_limiter.rate_limited_count:
+        logging.info(f"OpenAI rate limited {rate_limiter.rate_limited_count} requests; "
+                     f"final concurrency limit {rate_limiter.concurrency_limit}.")
+
+    if options.page_filter is not None:
+        logging.info(f"Page filter: skipped {options.page_filter.blank_pages} blank pages and reused results for "
+                     f"{options.page_filter.duplicate_pages} duplicate pages.")
+
+    if options.page_cache is not None:
+        logging.info(f"Page cache: {options.page_cache.hits} hits, {options.page_cache.misses} misses.")
+
+    if options.diagnosis_cache is not None:
+        stats = options.diagnosis_cache.stats()
+        logging.info(f"Diagnosis cache: {stats['hits']} hits, {stats['misses']} misses, "
+                     f"{stats['expired']} expired, {stats['coalesced']} coalesced.")
+
+
+def write_run_reports(metrics, args, report_path):
+    """Log the run totals and write the run report and any requested metrics exports."""
+    report = metrics.report()
+    totals = report["totals"]
+    logging.info(f"Run took {report['elapsed_seconds']:.1f}s: {totals['calls']} API calls, "
+                 f"{totals['prompt_tokens']} prompt ({totals['cached_tokens']} cached) and "
+                 f"{totals['completion_tokens']} completion tokens, "
+                 f"{totals['searches']} searches, estimated cost ${totals['cost_usd']:.2f}.")
+    write_report(report, report_path)
+    if args.prometheus_textfile:
+        write_prometheus_textfile(report, args.prometheus_textfile)
+    if args.otel:
+        export_opentelemetry(metrics, report)
+
+
+def update_summary(changed_files, removed_files, output_folder, args, options, rate_limiter, store):
+    """Process changed PDFs, drop the records of removed ones and rewrite the summary from the record store."""
+    metrics = reset_metrics()
+    journal = options.journal
+    for pdf_path in removed_files:
+        logging.info(f"'{os.path.basename(pdf_path)}' was removed; dropping its record.")
+        journal.forget(pdf_path)
+        store.put(os.path.abspath(pdf_path), None)
+    if changed_files:
+        run_pipeline(changed_files, args, options)
+        log_run_stats(options, rate_limiter)
+        # A changed document that no longer produces a record drops out of the summary
+        for pdf_path in changed_files:
+            store.put(os.path.abspath(pdf_path), journal.completed_record(pdf_path))
+
+    # The store holds the record of every document in the folder, not just this batch
+    generate_summary_table(store, output_folder, args.export)
+    if changed_files:
+        write_run_reports(metrics, args, args.metrics_report or os.path.join(output_folder, RUN_REPORT_FILENAME))
+
+
+def watch_input_folder(input_folder, output_folder, args, options, rate_limiter, store):
+    """Process new and changed PDFs as they appear in the input folder until interrupted.
+
+    Records are kept in the run journal, so unchanged documents are never
+    reprocessed, including after a restart. The record store is updated
+    with the changed documents only and the summary is rewritten from it
+    after every batch of changes.
+    """
+    journal = options.journal
+    # The watch starts before the initial scan so files added during the scan are not missed
+    watcher = create_watcher(input_folder, args.poll_interval)
+    # Stop cleanly when a service manager sends SIGTERM
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    def scan_folder():
+        pdf_files = list_pdf_files(input_folder)
+        present = {os.path.abspath(pdf_path) for pdf_path in pdf_files}
+        return pdf_files, [pdf_path for pdf_path in journal.paths() if pdf_path not in present]
+
+    changed_files, removed_files = scan_folder()
+    # The initial scan lists every PDF in the folder, so the store is rebuilt from it
+    store.clear()
+    try:
+        while True:
+            update_summary(changed_files, removed_files, output_folder, args, options, rate_limiter, store)
+            logging.info(f"Watching '{input_folder}' for new or changed PDFs...")
+            names = watcher.wait()
+            if names is None:
+                if not os.path.isdir(input_folder):
+                    logging.error(f"Input folder '{input_folder}' was removed or renamed; stopped watching it.")
+                    sys.exit(1)
+                logging.warning(f"File events for '{input_folder}' were lost; rescanning the folder.")
+                # The watch is gone if the folder was replaced or remounted, so it is set up again before the rescan
+                watcher.close()
+                watcher = create_watcher(input_folder, args.poll_interval)
+                changed_files, removed_files = scan_folder()
+                continue
+            pdf_paths = [os.path.join(input_folder, name) for name in sorted(names)]
+            changed_files = [pdf_path for pdf_path in pdf_paths if os.path.isfile(pdf_path)]
+            removed_files = [pdf_path for pdf_path in pdf_paths if not os.path.exists(pdf_path)]
+    except KeyboardInterrupt:
+        logging.info(f"Stopped watching '{input_folder}'.")
+    finally:
+        watcher.close()
+
+
+def run_worker(queue_path, args):
+    """Process documents leased from a coordinator's work queue until the queue is closed and drained.
+
+    Up to `--max-documents` documents are worked on at once, on one shared
+    scheduler, and their leases are renewed in the background. A document
+    whose lease was lost (e.g. after a long stall) has its result discarded,
+    since another worker has already taken it over.
+    """
+    metrics = reset_metrics()
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    queue = WorkQueue(queue_path)
+    options = build_pipeline_options(args)
+    rate_limiter = configure_rate_limiter(
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        max_concurrency=args.concurrency,
+    )
+    scheduler = Scheduler(max_concurrency=args.concurrency, max_documents=args.max_documents)
+    in_flight = {}  # future -> (job_id, pdf_path)
+    in_flight_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def renew_leases():
+        while not stopped.wait(queue.lease_seconds / 3):
+            with in_flight_lock:
+                job_ids = [job_id for job_id, _ in in_flight.values()]
+            if not job_ids:
+                continue
+            try:
+                queue.renew(job_ids, worker)
+            except Exception as e:
+                # Keep renewing: the leases only expire if every renewal within QUEUE_LEASE_SECONDS fails
+                logging.error(f"Could not renew the leases of worker {worker}: {e}")
+
+    threading.Thread(target=renew_leases, name="lease-renewal", daemon=True).start()
+    logging.info(f"Worker {worker} processing documents from '{queue_path}'.")
+    try:
+        while True:
+            while len(in_flight) < args.max_documents:
+                job = queue.lease(worker)
+                if job is None:
+                    break
+                job_id, pdf_path = job
+                future = scheduler.submit_document(process_pdf_file, pdf_path, options=options, scheduler=scheduler)
+                with in_flight_lock:
+                    in_flight[future] = job
+
+            if not in_flight:
+                if not queue.is_open():
+                    break
+                time.sleep(QUEUE_POLL_INTERVAL_SECONDS)
+                continue
+
+            done, _ = concurrent.futures.wait(
+                list(in_flight), timeout=QUEUE_POLL_INTERVAL_SECONDS, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                with in_flight_lock:
+                    job_id, pdf_path = in_flight.pop(future)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    logging.error(f"Unexpected error processing '{pdf_path}': {e}")
+                    queue.fail(job_id, worker, str(e))
+                    continue
+                if not queue.complete(job_id, worker, record):
+                    logging.warning(f"Lease on '{pdf_path}' was lost before it finished; discarding its result.")
+    finally:
+        stopped.set()
+        scheduler.shutdown()
+
+    log_run_stats(options, rate_limiter)
+    report_folder = os.path.dirname(os.path.abspath(queue_path))
+    write_run_reports(metrics, args, args.metrics_report or os.path.join(report_folder, f"run_report.{worker}.json"))
+
+
+def worker_process(queue_path, args):
+    """Entry point of worker processes started by the coordinator."""
+    configure_logging()
+    run_worker(queue_path, args)
+
+
+def start_local_workers(queue_path, args):
+    """Start `--workers` worker processes on this host, splitting the API budget evenly between them."""
+    count = args.workers
+    worker_args = argparse.Namespace(**{
+        **vars(args),
+        "concurrency": max(1, args.concurrency // count),
+        "rpm": max(1, args.rpm // count),
+        "tpm": max(1, args.tpm // count),
+        "metrics_report": None,
+    }) if count else None
+    # Spawned rather than forked, so workers do not inherit the coordinator's threads and connections
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for _ in range(count):
+        process = context.Process(target=worker_process, args=(queue_path, worker_args))
+        process.start()
+        workers.append(process)
+    return workers
+
+
+def run_coordinator(pdf_files, output_folder, args):
+    """Queue the PDFs for workers, wait until every document is finished and return (path, record) pairs."""
+    queue_path = args.queue or os.path.join(output_folder, QUEUE_FILENAME)
+    queue = WorkQueue(queue_path)
+    queue.open(pdf_files)
+    logging.info(f"Queued {len(pdf_files)} documents in '{queue_path}'.")
+    workers = start_local_workers(queue_path, args)
+
+    progress = None
+    try:
+        while True:
+            queue.expire_leases()
+            counts = queue.counts()
+            if counts != progress:
+                logging.info(f"Work queue: {counts['done']} done, {counts['leased']} in progress, "
+                             f"{counts['pending']} pending, {counts['failed']} failed.")
+                progress = counts
+            if not counts["pending"] and not counts["leased"]:
+                break
+            if workers and not any(process.is_alive() for process in workers):
+                logging.error("All worker processes exited before the queue was drained.")
+                break
+            time.sleep(QUEUE_POLL_INTERVAL_SECONDS)
+    finally:
+        queue.close()
+        for process in workers:
+            process.join()
+
+    for pdf_path, error in queue.failures():
+        logging.error(f"Gave up on '{os.path.basename(pdf_path)}': {error}")
+    return queue.path_records()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate a Summary of Injuries from a folder of medical record PDFs."
+    )
+    parser.add_argument("input_folder", nargs="?", help="Folder containing the medical records in PDF format.")
+    parser.add_argument("output_folder", nargs="?", help="Folder where summary_of_injuries.md will be saved.")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENCY,
+                        help=f"Maximum API requests in flight across all documents (default: {MAX_CONCURRENCY}).")
+    parser.add_argument("--max-documents", type=int, default=MAX_CONCURRENT_DOCUMENTS,
+                        help=f"Maximum documents processed concurrently (default: {MAX_CONCURRENT_DOCUMENTS}).")
+    parser.add_argument("--rpm", type=int, default=RATE_LIMIT_REQUESTS_PER_MINUTE,
+                        help=f"OpenAI requests-per-minute budget (default: {RATE_LIMIT_REQUESTS_PER_MINUTE}).")
+    parser.add_argument("--tpm", type=int, default=RATE_LIMIT_TOKENS_PER_MINUTE,
+                        help=f"OpenAI tokens-per-minute budget (default: {RATE_LIMIT_TOKENS_PER_MINUTE}).")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Run the pipeline on asyncio with AsyncOpenAI instead of worker threads.")
+    parser.add_argument("--batch", choices=["openai", "local"],
+                        help="Process the folder offline with one Batch API job per stage. 'local' runs the "
+                             "batch files against the chat completions endpoint instead, for testing.")
+    parser.add_argument("--combine-mode", choices=["auto", "single", "chunked"], default=COMBINE_MODE,
+                        help="How pages are combined: in one request, in parallel chunks that are stitched "
+                             f"together, or chunked only for long documents (default: {COMBINE_MODE}).")
+    parser.add_argument("--text-layer", choices=["llm", "direct", "off"], default=TEXT_LAYER_MODE,
+                        help="How pages with an embedded text layer are extracted: with a text-only model request, "
+                             f"directly from the text, or with vision like scanned pages (default: {TEXT_LAYER_MODE}).")
+    parser.add_argument("--dpi", type=int, default=RENDER_DPI,
+                        help=f"Resolution used to render scanned pages (default: {RENDER_DPI}).")
+    parser.add_argument("--image-format", choices=["auto", "jpeg", "png"], default=IMAGE_FORMAT,
+                        help="Page image encoding; 'auto' picks the smallest encoding that meets "
+                             f"IMAGE_QUALITY_TARGET_PSNR (default: {IMAGE_FORMAT}).")
+    parser.add_argument("--color", action="store_true",
+                        help="Send page images in color instead of grayscale.")
+    parser.add_argument("--no-crop", action="store_true",
+                        help="Do not crop blank page margins before encoding.")
+    parser.add_argument("--report-image-savings", action="store_true",
+                        help="Log bytes and estimated image tokens saved by preprocessing for each page.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume an interrupted run from the journal in the output folder, "
+                             "skipping pages and stages that already completed.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and process new or changed PDFs as they appear in the input folder, "
+                             "rewriting the summary after each batch.")
+    parser.add_argument("--poll-interval", type=float, default=WATCH_POLL_INTERVAL_SECONDS,
+                        help=f"Seconds between folder scans in --watch mode where inotify is not available "
+                             f"(default: {WATCH_POLL_INTERVAL_SECONDS}).")
+    parser.add_argument("--coordinator", action="store_true",
+                        help="Queue the input folder's PDFs for worker processes and build the summary from "
+                             "their results.")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Worker processes the coordinator starts on this host, sharing the --concurrency, "
+                             "--rpm and --tpm budgets (default: 0, for workers started separately with --worker).")
+    parser.add_argument("--queue", metavar="PATH",
+                        help=f"Work queue used by --coordinator (default: {QUEUE_FILENAME} in the output folder).")
+    parser.add_argument("--worker", metavar="QUEUE",
+                        help="Run as a worker, processing documents from a coordinator's work queue until it "
+                             "is finished.")
+    parser.add_argument("--export", action="append", choices=["csv", "json"], default=[],
+                        help="Also write the summary as summary_of_injuries.csv or summary_of_injuries.json "
+                             "(may be given more than once).")
+    parser.add_argument("--serve", nargs="?", const=WARM_WORKER_SOCKET, metavar="SOCKET",
+                        help="Run as a warm worker: keep the pipeline loaded and process the runs that "
+                             f"warm_worker.py hands over on a Unix socket (default: {WARM_WORKER_SOCKET}).")
+    parser.add_argument("--metrics-report", metavar="PATH",
+                        help=f"Where to write the JSON run report "
+                             f"(default: {RUN_REPORT_FILENAME} in the output folder).")
+    parser.add_argument("--prometheus-textfile", metavar="PATH",
+                        help="Also write the run metrics in the Prometheus text format, e.g. for the "
+                             "node_exporter textfile collector.")
+    parser.add_argument("--otel", action="store_true",
+                        help="Also export the run metrics through OpenTelemetry "
+                             "(requires the opentelemetry packages).")
+    parser.add_argument("--fast-icd", action="store_true",
+                        help="Ask for candidate ICD-10 codes in the same structured-output call that extracts the "
+                             "visit details, and search the web only if none is verified against the local ICD-10-CM index.")
+    parser.add_argument("--stream", action="store_true",
+                        help=f"Stream combine responses, writing each document's markdown to {MARKDOWN_DIRNAME}/ in "
+                             "the output folder as it is generated and extracting the visit details as soon as "
+                             "the diagnosis section is complete.")
+    parser.add_argument("--early-exit", action="store_true",
+                        help="Extract the leading pages and pages that mention a diagnosis first, and build the "
+                             "record from them while the rest of the document is extracted, keeping it if no "
+                             "other page has a different diagnosis.")
+    parser.add_argument("--no-page-filter", action="store_true",
+                        help="Send every scanned page to the model, including blank and duplicate pages.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Bypass the on-disk cache of per-page extraction results.")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="Remove all cached page extraction results and diagnosis codes before processing.")
+    parser.add_argument("--cache-dir", default=PAGE_CACHE_DIR,
+                        help=f"Directory of the page extraction cache (default: {PAGE_CACHE_DIR}).")
+    parser.add_argument("--no-diagnosis-cache", action="store_true",
+                        help="Bypass the persistent diagnosis to ICD-10 code cache.")
+    parser.add_argument("--diagnosis-cache", default=DIAGNOSIS_CACHE_PATH,
+                        help=f"Location of the diagnosis to ICD-10 code cache (default: {DIAGNOSIS_CACHE_PATH}).")
+    parser.add_argument("--icd10-index", default=ICD10_INDEX_PATH,
+                        help=f"Local ICD-10-CM index used before falling back to web search "
+                             f"(default: {ICD10_INDEX_PATH}).")
+    parser.add_argument("--no-icd10-index", action="store_true",
+                        help="Always look up ICD-10 codes with web search.")
+    parser.add_argument("--build-icd10-index", metavar="CMS_CODES_FILE",
+                        help="Build the local ICD-10-CM index from a CMS code description file "
+                             "(e.g. icd10cm_codes_2025.txt) before processing.")
+    args = parser.parse_args(argv)
+    if not (args.build_icd10_index or args.worker or args.serve) and (args.input_folder is None or args.output_folder is None):
+        parser.error("the following arguments are required: input_folder, output_folder")
+    if args.watch and args.batch:
+        parser.error("--watch cannot be combined with --batch")
+    if (args.stream or args.early_exit) and args.batch:
+        parser.error("--stream and --early-exit cannot be combined with --batch")
+    if (args.coordinator or args.worker) and (args.batch or args.watch or args.use_async):
+        parser.error("--coordinator and --worker cannot be combined with --batch, --watch or --async")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    input_folder = args.input_folder
+    output_folder = args.output_folder
+
+    configure_logging()
+
+    if args.serve:
+        # Import the API stack and create the client now rather than in the first run handed over
+        get_client()
+        serve(main, args.serve)
+        return
+
+    if args.build_icd10_index:
+        build_icd10_index(args.build_icd10_index, args.icd10_index)
+        if input_folder is None and not args.worker:
+            return
+
+    if args.worker:
+        run_worker(args.worker, args)
+        return
+
+    metrics = reset_metrics()
+
     # Validate input folder
     if not os.path.exists(input_folder):
         logging.error(f"Input folder '{input_folder}' does not exist.")
@@ -186,24 +883,47 @@ def main():
         os.makedirs(output_folder)
 
     # Get list of PDF files
-    pdf_files = [os.path.join(input_folder, f) for f in os.listdir(input_folder) if f.lower().endswith('.pdf')]
+    pdf_files = list_pdf_files(input_folder)
 
-    if not pdf_files:
+    if not pdf_files and not args.watch:
         logging.warning(f"No PDF files found in the input folder '{input_folder}'.")
         sys.exit(1)
 
-    records = []  # List to store all records
+    if args.clear_cache:
+        clear_caches(args)
 
-    for pdf_file in pdf_files:
-        record = process_pdf_file(pdf_file)
-        if record:
-            records.append(record)
+    store = SummaryStore(os.path.join(output_folder, SUMMARY_STORE_FILENAME))
+    if args.coordinator:
+        store.replace(run_coordinator(pdf_files, output_folder, args))
+    else:
+        # In watch mode the journal is the persistent record set, so it is kept across restarts
+        journal = RunJournal(os.path.join(output_folder, RUN_JOURNAL_FILENAME))
+        if not args.resume and not args.watch:
+            journal.clear()
+
+        options = build_pipeline_options(args, journal)
+        rate_limiter = configure_rate_limiter(
+            requests_per_minute=args.rpm,
+            tokens_per_minute=args.tpm,
+            max_concurrency=args.concurrency,
+        )
+
+        if args.watch:
+            watch_input_folder(input_folder, output_folder, args, options, rate_limiter, store)
+            return
+
+        results = run_pipeline(pdf_files, args, options)
+        store.replace((os.path.abspath(pdf_path), record) for pdf_path, record in zip(pdf_files, results))
 
-    if records:
-        generate_summary_table(records, output_folder)
+        log_run_stats(options, rate_limiter)
+
+    if store.count():
+        generate_summary_table(store, output_folder, args.export)
     else:
         logging.warning("No records to generate summary table.")
 
+    write_run_reports(metrics, args, args.metrics_report or os.path.join(output_folder, RUN_REPORT_FILENAME))
+
 
 if __name__ == "__main__":
     main()
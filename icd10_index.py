@@ -0,0 +1,186 @@
+import difflib
+import logging
+import os
+import re
+import sqlite3
+import threading
+from collections import namedtuple
+
+from config import ICD10_MIN_CONFIDENCE
+
+ICD10Match = namedtuple("ICD10Match", ["code", "description", "confidence"])
+
+# Words that carry no meaning for matching a diagnosis to a code description
+STOPWORDS = {
+    "a", "an", "and", "the", "of", "for", "with", "in", "on", "to", "by", "or",
+    "icd", "icd10", "icd-10", "10", "cm", "code", "codes", "diagnosis", "dx",
+}
+
+# Billable-order file lines: order number, code, header flag, short and long descriptions
+ORDER_LINE_RE = re.compile(r"^\d{5} (\S+)\s+([01]) (.{60}) (.+)$")
+CODE_RE = re.compile(r"^[A-TV-Z][0-9][0-9A-Z](\.?[0-9A-Z]{1,4})?$")
+
+
+def format_code(code):
+    """Format a CMS code such as 'M542' in its dotted form 'M54.2'."""
+    code = code.strip().upper().replace(".", "")
+    return code if len(code) <= 3 else f"{code[:3]}.{code[3:]}"
+
+
+def is_valid_code_format(code):
+    """Return True if the string is shaped like an ICD-10-CM code."""
+    return bool(code) and bool(CODE_RE.match(code.strip().upper()))
+
+
+def tokenize(text):
+    """Split text into lowercase content words."""
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in STOPWORDS]
+
+
+def parse_cms_file(source_path):
+    """Yield (code, description, billable) tuples from a CMS ICD-10-CM code file.
+
+    Both the `icd10cm_codes_YYYY.txt` and `icd10cm_order_YYYY.txt` layouts are
+    supported; the codes file only lists billable codes.
+    """
+    with open(source_path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            match = ORDER_LINE_RE.match(line)
+            if match:
+                code, header_flag, _, description = match.groups()
+                yield code, description.strip(), header_flag == "1"
+                continue
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                yield parts[0], parts[1].strip(), True
+
+
+def build_icd10_index(source_path, index_path):
+    """Build the SQLite/FTS5 index at `index_path` from a CMS ICD-10-CM code file."""
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp_path = f"{index_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.executescript("""
+            CREATE TABLE codes (
+                id INTEGER PRIMARY KEY,
+                code TEXT NOT NULL UNIQUE,
+                description TEXT NOT NULL,
+                billable INTEGER NOT NULL
+            );
+            CREATE VIRTUAL TABLE codes_fts USING fts5(
+                description, content='codes', content_rowid='id', tokenize='porter unicode61'
+            );
+        """)
+        rows = ((format_code(code), description, int(billable))
+                for code, description, billable in parse_cms_file(source_path))
+        connection.executemany("INSERT OR REPLACE INTO codes (code, description, billable) VALUES (?, ?, ?)", rows)
+        connection.execute("INSERT INTO codes_fts (rowid, description) SELECT id, description FROM codes")
+        count = connection.execute("SELECT COUNT(*) FROM codes").fetchone()[0]
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(tmp_path, index_path)
+    logging.info(f"Built ICD-10-CM index '{index_path}' with {count} codes.")
+    return count
+
+
+class ICD10Index:
+    """Read-only, memory-mapped ICD-10-CM code index with fuzzy token search."""
+
+    def __init__(self, index_path, min_confidence=ICD10_MIN_CONFIDENCE):
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f"ICD-10-CM index '{index_path}' does not exist.")
+        self.index_path = index_path
+        self.min_confidence = min_confidence
+        self._local = threading.local()
+
+    def _connection(self):
+        # SQLite connections cannot be shared across threads, so keep one per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True)
+            connection.execute("PRAGMA mmap_size = 268435456")
+            self._local.connection = connection
+        return connection
+
+    def lookup(self, code):
+        """Return (code, description) for an exact code, or None if it does not exist."""
+        row = self._connection().execute(
+            "SELECT code, description FROM codes WHERE code = ?", (format_code(code),)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def search(self, text, limit=10):
+        """Return up to `limit` ICD10Match candidates for free text, best first."""
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        fts_query = " OR ".join(f'"{token}"' for token in dict.fromkeys(tokens))
+        rows = self._connection().execute(
+            """
+            SELECT codes.code, codes.description, codes.billable
+            FROM codes_fts JOIN codes ON codes.id = codes_fts.rowid
+            WHERE codes_fts MATCH ?
+            ORDER BY bm25(codes_fts)
+            LIMIT ?
+            """,
+            (fts_query, limit * 5),
+        ).fetchall()
+
+        matches = []
+        for code, description, billable in rows:
+            confidence = self._confidence(tokens, description)
+            # Prefer billable codes over category headers with the same wording
+            if not billable:
+                confidence *= 0.95
+            matches.append(ICD10Match(code, description, round(confidence, 3)))
+        matches.sort(key=lambda match: match.confidence, reverse=True)
+        return matches[:limit]
+
+    @staticmethod
+    def _confidence(tokens, description):
+        """Score how well a description covers the query tokens, from 0 to 1."""
+        description_tokens = tokenize(description)
+        covered = sum(
+            1 for token in tokens
+            if any(word.startswith(token[:5]) or token.startswith(word[:5]) for word in description_tokens)
+        )
+        coverage = covered / len(tokens)
+        # Penalize long descriptions that only share a few words with the query
+        precision = covered / max(len(description_tokens), 1)
+        similarity = difflib.SequenceMatcher(None, " ".join(tokens), " ".join(description_tokens)).ratio()
+        return 0.5 * coverage + 0.2 * min(1.0, precision) + 0.3 * similarity
+
+    def description_confidence(self, text, description):
+        """Score how well free text matches a code description, from 0 to 1."""
+        tokens = tokenize(text)
+        return self._confidence(tokens, description) if tokens else 0.0
+
+    def resolve(self, diagnosis, query=""):
+        """Return the best ICD10Match for a diagnosis if it meets the confidence threshold."""
+        best = None
+        for text in (diagnosis, query):
+            if not text:
+                continue
+            candidates = self.search(text, limit=1)
+            if candidates and (best is None or candidates[0].confidence > best.confidence):
+                best = candidates[0]
+        if best is None or best.confidence < self.min_confidence:
+            return None
+        return best
+
+
+def load_icd10_index(index_path):
+    """Open the ICD-10-CM index if it has been built, otherwise return None."""
+    if not os.path.exists(index_path):
+        logging.info(f"No ICD-10-CM index at '{index_path}'; ICD-10 codes will be looked up on the web.")
+        return None
+    return ICD10Index(index_path)
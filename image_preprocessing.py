@@ -0,0 +1,178 @@
+import binascii
+import io
+import logging
+import math
+from collections import namedtuple
+from dataclasses import dataclass
+
+from PIL import Image, ImageChops, ImageStat
+
+from config import (
+    IMAGE_GRAYSCALE,
+    IMAGE_CROP_MARGINS,
+    IMAGE_FIT_TILE_GRID,
+    IMAGE_FORMAT,
+    IMAGE_JPEG_QUALITY,
+    IMAGE_JPEG_QUALITY_CANDIDATES,
+    IMAGE_QUALITY_TARGET_PSNR,
+)
+from rate_limiter import model_image_size, estimate_image_tokens
+
+EncodedImage = namedtuple("EncodedImage", ["data", "mime_type", "size"])
+# An encoded page held only as the data URL sent to the model, with its mime type and pixel size
+PageBuffer = namedtuple("PageBuffer", ["data_url", "mime_type", "size"])
+
+# Pixels lighter than this are treated as page background when cropping margins
+BACKGROUND_THRESHOLD = 245
+CROP_PADDING = 16
+
+TILE_SIZE = 512
+
+# Encoded bytes converted per base64 call; a multiple of 3, so chunks encode without padding
+BASE64_CHUNK_BYTES = 3 * 64 * 1024
+
+
+@dataclass(frozen=True)
+class ImageSettings:
+    """How rendered pages are preprocessed and encoded before they are sent to the model."""
+
+    grayscale: bool = IMAGE_GRAYSCALE
+    crop_margins: bool = IMAGE_CROP_MARGINS
+    fit_tile_grid: bool = IMAGE_FIT_TILE_GRID
+    image_format: str = IMAGE_FORMAT
+    jpeg_quality: int = IMAGE_JPEG_QUALITY
+    quality_target_psnr: float = IMAGE_QUALITY_TARGET_PSNR
+    report_savings: bool = False
+
+    def cache_tag(self):
+        """Return a string identifying the settings that change what the model sees."""
+        return (f"gray={self.grayscale},crop={self.crop_margins},fit={self.fit_tile_grid},"
+                f"format={self.image_format},q={self.jpeg_quality},psnr={self.quality_target_psnr}")
+
+
+def find_content_bbox(image, threshold=BACKGROUND_THRESHOLD, padding=CROP_PADDING):
+    """Return the bounding box of non-background content, padded, or None for a blank page."""
+    gray = image if image.mode == "L" else image.convert("L")
+    mask = gray.point(lambda value: 255 if value < threshold else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return None
+    left, top, right, bottom = bbox
+    return (
+        max(0, left - padding),
+        max(0, top - padding),
+        min(image.width, right + padding),
+        min(image.height, bottom + padding),
+    )
+
+
+def tile_count(width, height):
+    """Return the number of 512px tiles the model splits an image of this size into."""
+    width, height = model_image_size(width, height)
+    return math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+
+
+def fit_tile_budget(width, height, max_tiles):
+    """Return the size an image must be scaled to so it uses at most `max_tiles` tiles."""
+    width, height = model_image_size(width, height)
+    while math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE) > max_tiles:
+        # Shrink the longer side down to the previous tile boundary
+        longest = max(width, height)
+        scale = (math.ceil(longest / TILE_SIZE) - 1) * TILE_SIZE / longest
+        width, height = max(1, math.floor(width * scale)), max(1, math.floor(height * scale))
+    return width, height
+
+
+def preprocess_page_image(image, settings):
+    """Apply grayscale conversion, margin cropping and tile-grid downscaling to a page image."""
+    mode = "L" if settings.grayscale else "RGB"
+    # Only convert when needed: converting to the same mode copies the whole page
+    processed = image if image.mode == mode else image.convert(mode)
+    if settings.crop_margins:
+        bbox = find_content_bbox(processed)
+        if bbox is not None:
+            processed = processed.crop(bbox)
+    if settings.fit_tile_grid:
+        # Cropping changes the aspect ratio, so never use more tiles than the uncropped page
+        target_size = fit_tile_budget(*processed.size, max_tiles=tile_count(*image.size))
+        if target_size != processed.size:
+            processed = processed.resize(target_size, Image.LANCZOS)
+    return processed
+
+
+def _save(image, image_format, **params):
+    buffered = io.BytesIO()
+    image.save(buffered, format=image_format, **params)
+    return buffered.getvalue()
+
+
+def psnr(reference, data):
+    """Return the peak signal-to-noise ratio (dB) of encoded `data` against `reference`."""
+    with Image.open(io.BytesIO(data)) as decoded:
+        decoded = decoded.convert(reference.mode)
+        stat = ImageStat.Stat(ImageChops.difference(reference, decoded))
+    mse = sum(rms ** 2 for rms in stat.rms) / len(stat.rms)
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+def encode_preprocessed_image(image, settings):
+    """Encode a preprocessed page, returning (data, mime_type)."""
+    if settings.image_format == "png":
+        return _save(image, "PNG", optimize=True), "image/png"
+    if settings.image_format == "jpeg":
+        return _save(image, "JPEG", quality=settings.jpeg_quality), "image/jpeg"
+
+    # "auto": the lowest JPEG quality that still meets the quality target, unless PNG is smaller
+    best = (_save(image, "PNG", optimize=True), "image/png")
+    for quality in sorted(IMAGE_JPEG_QUALITY_CANDIDATES):
+        data = _save(image, "JPEG", quality=quality)
+        if len(data) >= len(best[0]):
+            # Higher qualities only get larger
+            break
+        if psnr(image, data) >= settings.quality_target_psnr:
+            best = (data, "image/jpeg")
+            break
+    return best
+
+
+def encode_page_image(image, settings=None, page_number=0):
+    """Preprocess and encode a rendered page, returning an EncodedImage."""
+    if settings is None:
+        settings = ImageSettings()
+    processed = preprocess_page_image(image, settings)
+    data, mime_type = encode_preprocessed_image(processed, settings)
+    encoded = EncodedImage(data, mime_type, processed.size)
+
+    if settings.report_savings:
+        # Compare against the original behaviour: the full render as a default-quality JPEG
+        baseline_bytes = len(_save(image.convert("RGB"), "JPEG"))
+        baseline_tokens = estimate_image_tokens(*image.size)
+        tokens = estimate_image_tokens(*processed.size)
+        logging.info(
+            f"Page {page_number}: {len(data) // 1024} KB {mime_type} {processed.size[0]}x{processed.size[1]}, "
+            f"saved {(baseline_bytes - len(data)) // 1024} KB and {baseline_tokens - tokens} image tokens."
+        )
+    return encoded
+
+
+def base64_data_url(data, mime_type):
+    """Return encoded image data as a base64 data URL string.
+
+    The URL is encoded chunk by chunk into a buffer allocated once at its
+    final size and then decoded into the string the JSON request needs, so
+    building it peaks at two full-size copies (the buffer and the string)
+    instead of three (the base64 bytes, their decoded string and the
+    formatted URL), and only the string is kept.
+    """
+    prefix = f"data:{mime_type};base64,".encode("ascii")
+    buffer = bytearray(len(prefix) + 4 * math.ceil(len(data) / 3))
+    buffer[:len(prefix)] = prefix
+    view = memoryview(data)
+    offset = len(prefix)
+    for start in range(0, len(view), BASE64_CHUNK_BYTES):
+        chunk = binascii.b2a_base64(view[start:start + BASE64_CHUNK_BYTES], newline=False)
+        buffer[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return buffer.decode("ascii")
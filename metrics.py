@@ -0,0 +1,371 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from config import MODEL_PRICING, BATCH_PRICE_MULTIPLIER, SERPAPI_COST_PER_SEARCH
+
+# The document and stage the current code runs for. Context variables follow
+# asyncio tasks automatically, and the scheduler copies them into its threads.
+current_document = contextvars.ContextVar("current_document", default=None)
+current_stage = contextvars.ContextVar("current_stage", default=None)
+
+
+def model_price(model):
+    """Return (input, cached input, output) USD prices per million tokens for a model, matching dated model names."""
+    matches = [name for name in MODEL_PRICING if model == name or model.startswith(f"{name}-")]
+    if not matches:
+        return 0.0, 0.0, 0.0
+    return MODEL_PRICING[max(matches, key=len)]
+
+
+def api_cost(model, prompt_tokens, completion_tokens, cached_tokens=0, batch=False):
+    """Return the USD cost of a chat completion, `cached_tokens` of whose prompt tokens hit the prompt cache."""
+    input_price, cached_input_price, output_price = model_price(model)
+    cost = ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_input_price
+            + completion_tokens * output_price) / 1_000_000
+    return cost * BATCH_PRICE_MULTIPLIER if batch else cost
+
+
+def cache_hit_rate(stats):
+    """Return the fraction of prompt tokens served from the prompt cache, or None without prompt tokens."""
+    return stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else None
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of a non-empty list of values."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def _new_api_stats():
+    return {
+        "calls": 0,
+        "prompt_tokens": 0,
+        "cached_tokens": 0,
+        "completion_tokens": 0,
+        "retries": 0,
+        "rate_limited": 0,
+        "errors": 0,
+        "cost_usd": 0.0,
+    }
+
+
+def _new_document_stats():
+    return {"stages": {}, **_new_api_stats(), "searches": 0}
+
+
+class RunMetrics:
+    """Thread-safe aggregation of stage timings, API usage and cost for a run.
+
+    Stage timings are inclusive: an "extract" stage contains the rate
+    limiter wait and retries of the API call made for the page. Encoding
+    is timed separately as the "encode" stage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._durations = {}
+        self._api = {}
+        self._api_latencies = {}
+        self._documents = {}
+        self.searches = 0
+
+    def _document(self):
+        document = current_document.get()
+        if document is None:
+            return None
+        return self._documents.setdefault(document, _new_document_stats())
+
+    def _api_stats(self, model):
+        key = (current_stage.get() or "other", model)
+        return self._api.setdefault(key, _new_api_stats())
+
+    def record_stage(self, stage, seconds):
+        with self._lock:
+            self._durations.setdefault(stage, []).append(seconds)
+            document = self._document()
+            if document is not None:
+                document["stages"][stage] = document["stages"].get(stage, 0.0) + seconds
+
+    def record_api_call(self, model, prompt_tokens, completion_tokens, cached_tokens=0, seconds=None, retries=0,
+                        batch=False):
+        cost = api_cost(model, prompt_tokens, completion_tokens, cached_tokens=cached_tokens, batch=batch)
+        with self._lock:
+            targets = [self._api_stats(model), self._document()]
+            for stats in targets:
+                if stats is None:
+                    continue
+                stats["calls"] += 1
+                stats["prompt_tokens"] += prompt_tokens
+                stats["cached_tokens"] += cached_tokens
+                stats["completion_tokens"] += completion_tokens
+                stats["retries"] += retries
+                stats["cost_usd"] += cost
+            if seconds is not None:
+                key = (current_stage.get() or "other", model)
+                self._api_latencies.setdefault(key, []).append(seconds)
+
+    def record_rate_limited(self, model):
+        with self._lock:
+            self._api_stats(model)["rate_limited"] += 1
+            document = self._document()
+            if document is not None:
+                document["rate_limited"] += 1
+
+    def record_api_error(self, model):
+        with self._lock:
+            self._api_stats(model)["errors"] += 1
+            document = self._document()
+            if document is not None:
+                document["errors"] += 1
+
+    def record_search(self):
+        with self._lock:
+            self.searches += 1
+            document = self._document()
+            if document is not None:
+                document["searches"] += 1
+                document["cost_usd"] += SERPAPI_COST_PER_SEARCH
+
+    def stage_durations(self):
+        """Return {stage: [seconds, ...]} for every recorded stage."""
+        with self._lock:
+            return {stage: list(durations) for stage, durations in self._durations.items()}
+
+    def report(self):
+        """Return the run report as a JSON-serializable dict."""
+        with self._lock:
+            stages = {
+                stage: {
+                    "count": len(durations),
+                    "total_seconds": sum(durations),
+                    "p50_ms": percentile(durations, 0.50) * 1000,
+                    "p95_ms": percentile(durations, 0.95) * 1000,
+                    "max_ms": max(durations) * 1000,
+                }
+                for stage, durations in sorted(self._durations.items())
+            }
+            api = []
+            totals = {**_new_api_stats(), "searches": self.searches}
+            for (stage, model), stats in sorted(self._api.items()):
+                latencies = self._api_latencies.get((stage, model))
+                api.append({
+                    "stage": stage,
+                    "model": model,
+                    **stats,
+                    "cache_hit_rate": cache_hit_rate(stats),
+                    "latency_p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+                    "latency_p95_ms": percentile(latencies, 0.95) * 1000 if latencies else None,
+                })
+                for name, value in stats.items():
+                    totals[name] += value
+            totals["cost_usd"] += self.searches * SERPAPI_COST_PER_SEARCH
+            totals["cache_hit_rate"] = cache_hit_rate(totals)
+            documents = json.loads(json.dumps(self._documents))
+
+        return {
+            "started_at": self.started_at,
+            "elapsed_seconds": time.perf_counter() - self._start,
+            "totals": totals,
+            "stages": stages,
+            "api": api,
+            "documents": documents,
+        }
+
+
+_metrics = RunMetrics()
+
+
+def get_metrics():
+    """Return the process-wide run metrics."""
+    return _metrics
+
+
+def reset_metrics():
+    """Start a new run, discarding everything recorded so far."""
+    global _metrics
+    _metrics = RunMetrics()
+    return _metrics
+
+
+@contextmanager
+def timed_stage(stage):
+    """Time a block as `stage`, attributing API calls made inside it to that stage."""
+    token = current_stage.set(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _metrics.record_stage(stage, time.perf_counter() - start)
+        current_stage.reset(token)
+
+
+def timed(stage):
+    """Decorator that times every call of a function or coroutine function as `stage`."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with timed_stage(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed_stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_document(fn):
+    """Decorator for process_pdf_file: attributes everything inside it to the document at `pdf_path`."""
+    def enter(pdf_path):
+        return current_document.set(os.path.basename(pdf_path))
+
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(pdf_path, *args, **kwargs):
+            token = enter(pdf_path)
+            try:
+                with timed_stage("document"):
+                    return await fn(pdf_path, *args, **kwargs)
+            finally:
+                current_document.reset(token)
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(pdf_path, *args, **kwargs):
+        token = enter(pdf_path)
+        try:
+            with timed_stage("document"):
+                return fn(pdf_path, *args, **kwargs)
+        finally:
+            current_document.reset(token)
+    return wrapper
+
+
+def write_report(report, path):
+    """Write the run report as JSON."""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Run report saved to '{path}'.")
+
+
+def _prometheus_labels(**labels):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+def write_prometheus_textfile(report, path):
+    """Write the run report in the Prometheus text exposition format.
+
+    The file is meant for the node_exporter textfile collector; it is
+    written atomically so a scrape never sees a partial file.
+    """
+    lines = [
+        "# HELP summary_of_injuries_run_seconds Wall time of the last run.",
+        "# TYPE summary_of_injuries_run_seconds gauge",
+        f"summary_of_injuries_run_seconds {report['elapsed_seconds']}",
+        "# HELP summary_of_injuries_stage_seconds Total time spent in each stage in the last run.",
+        "# TYPE summary_of_injuries_stage_seconds gauge",
+    ]
+    for stage, stats in report["stages"].items():
+        lines.append(f"summary_of_injuries_stage_seconds{_prometheus_labels(stage=stage)} {stats['total_seconds']}")
+    lines += [
+        "# HELP summary_of_injuries_stage_calls Number of times each stage ran in the last run.",
+        "# TYPE summary_of_injuries_stage_calls gauge",
+    ]
+    for stage, stats in report["stages"].items():
+        lines.append(f"summary_of_injuries_stage_calls{_prometheus_labels(stage=stage)} {stats['count']}")
+
+    api_metrics = [
+        ("api_calls", "calls", "OpenAI API calls"),
+        ("api_prompt_tokens", "prompt_tokens", "Prompt tokens"),
+        ("api_cached_tokens", "cached_tokens", "Prompt tokens served from the prompt cache"),
+        ("api_completion_tokens", "completion_tokens", "Completion tokens"),
+        ("api_retries", "retries", "Retried OpenAI API calls"),
+        ("api_rate_limited", "rate_limited", "OpenAI API calls answered with a 429"),
+        ("api_cost_usd", "cost_usd", "Estimated OpenAI cost in USD"),
+    ]
+    for metric, field, description in api_metrics:
+        lines += [
+            f"# HELP summary_of_injuries_{metric} {description} in the last run.",
+            f"# TYPE summary_of_injuries_{metric} gauge",
+        ]
+        for stats in report["api"]:
+            labels = _prometheus_labels(stage=stats["stage"], model=stats["model"])
+            lines.append(f"summary_of_injuries_{metric}{labels} {stats[field]}")
+    lines += [
+        "# HELP summary_of_injuries_serpapi_searches SerpAPI searches in the last run.",
+        "# TYPE summary_of_injuries_serpapi_searches gauge",
+        f"summary_of_injuries_serpapi_searches {report['totals']['searches']}",
+        "# HELP summary_of_injuries_documents Documents processed in the last run.",
+        "# TYPE summary_of_injuries_documents gauge",
+        f"summary_of_injuries_documents {len(report['documents'])}",
+    ]
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_path, path)
+    logging.info(f"Prometheus metrics saved to '{path}'.")
+
+
+def export_opentelemetry(metrics, report):
+    """Export the run's metrics through OpenTelemetry.
+
+    Uses the globally configured meter provider (e.g. when run under
+    `opentelemetry-instrument`); otherwise, if the SDK and OTLP exporter are
+    installed, exports to the endpoint in OTEL_EXPORTER_OTLP_ENDPOINT.
+    """
+    try:
+        from opentelemetry import metrics as otel_metrics
+    except ImportError:
+        logging.error("OpenTelemetry export requires the 'opentelemetry-api' package.")
+        return
+
+    provider = otel_metrics.get_meter_provider()
+    if not hasattr(provider, "force_flush"):
+        try:
+            from opentelemetry.sdk.metrics import MeterProvider
+            from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+            from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+        except ImportError:
+            logging.error("No OpenTelemetry meter provider is configured and the SDK/OTLP exporter "
+                          "('opentelemetry-sdk', 'opentelemetry-exporter-otlp-proto-http') is not installed.")
+            return
+        provider = MeterProvider(metric_readers=[PeriodicExportingMetricReader(OTLPMetricExporter())])
+
+    meter = provider.get_meter("summary_of_injuries")
+    stage_duration = meter.create_histogram("summary_of_injuries.stage.duration", unit="s",
+                                            description="Duration of each pipeline stage.")
+    for stage, durations in metrics.stage_durations().items():
+        for seconds in durations:
+            stage_duration.record(seconds, {"stage": stage})
+
+    tokens = meter.create_counter("summary_of_injuries.api.tokens", unit="{token}",
+                                  description="OpenAI tokens used.")
+    calls = meter.create_counter("summary_of_injuries.api.calls", description="OpenAI API calls.")
+    cost = meter.create_counter("summary_of_injuries.api.cost", unit="USD", description="Estimated OpenAI cost.")
+    for stats in report["api"]:
+        attributes = {"stage": stats["stage"], "model": stats["model"]}
+        tokens.add(stats["prompt_tokens"], {**attributes, "type": "prompt"})
+        tokens.add(stats["cached_tokens"], {**attributes, "type": "cached"})
+        tokens.add(stats["completion_tokens"], {**attributes, "type": "completion"})
+        calls.add(stats["calls"], attributes)
+        cost.add(stats["cost_usd"], attributes)
+    meter.create_counter("summary_of_injuries.serpapi.searches", description="SerpAPI searches.").add(
+        report["totals"]["searches"]
+    )
+
+    provider.force_flush()
+    logging.info("Run metrics exported to OpenTelemetry.")
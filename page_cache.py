@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+
+from config import EXTRACTION_MODEL, RENDER_DPI
+from prompts import EXTRACTION_SYSTEM_PROMPT, TEXT_EXTRACTION_SYSTEM_PROMPT
+
+EXTRACTION_PROMPT_HASH = hashlib.sha256(EXTRACTION_SYSTEM_PROMPT.encode('utf-8')).hexdigest()
+TEXT_EXTRACTION_PROMPT_HASH = hashlib.sha256(TEXT_EXTRACTION_SYSTEM_PROMPT.encode('utf-8')).hexdigest()
+
+# Rows of pixels copied out of a page image at a time when hashing it
+CACHE_KEY_STRIP_ROWS = 256
+
+
+class PageCache:
+    """Content-addressed on-disk cache of page extraction results with LRU eviction.
+
+    Entries are keyed by a hash of the rendered page pixels together with the
+    extraction model, the extraction prompt and the render settings, so a
+    change to any of them invalidates the cached result.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_bytes = sum(size for _, size, _ in self._entries())
+
+    def key_for_image(self, image, dpi=RENDER_DPI, image_settings_tag=""):
+        """Return the cache key for a rendered page image."""
+        digest = hashlib.sha256()
+        digest.update(f"{EXTRACTION_MODEL}\0{EXTRACTION_PROMPT_HASH}\0{dpi}\0{image_settings_tag}\0".encode('utf-8'))
+        digest.update(f"{image.mode}\0{image.size[0]}x{image.size[1]}\0".encode('utf-8'))
+        # Hash the pixels in strips of rows rather than copying the whole page out at once
+        width, height = image.size
+        for top in range(0, height, CACHE_KEY_STRIP_ROWS):
+            digest.update(image.crop((0, top, width, min(height, top + CACHE_KEY_STRIP_ROWS))).tobytes())
+        return digest.hexdigest()
+
+    def key_for_text(self, text):
+        """Return the cache key for a page's embedded text layer."""
+        digest = hashlib.sha256()
+        digest.update(f"text\0{EXTRACTION_MODEL}\0{TEXT_EXTRACTION_PROMPT_HASH}\0".encode('utf-8'))
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _entries(self):
+        """Yield (path, size, last_used) for every cache entry."""
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        """Return the cached page result for `key`, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = f.read()
+            # The modification time doubles as the last-used time for LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store a page result and evict least recently used entries if over budget."""
+        path = self._path(key)
+        data = value.encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f"Error writing page cache entry '{path}': {e}")
+            return
+        with self._lock:
+            self._total_bytes += len(data) - previous_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits its budget."""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        # Evict down to 90% of the budget so we do not rescan on every put
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        self._total_bytes = total
+        logging.info(f"Evicted {evicted} entries from page cache '{self.cache_dir}'.")
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self._lock:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._total_bytes = 0
+        logging.info(f"Cleared page cache '{self.cache_dir}'.")
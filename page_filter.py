@@ -0,0 +1,103 @@
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+from PIL import Image, ImageStat
+
+from config import BLANK_PAGE_MAX_BLOCK_INK, PAGE_FILTER_MAX_PAGES
+from metrics import timed
+
+# Pixels darker than this count as ink
+INK_THRESHOLD = 160
+# Width of the ink density thumbnail used for blank page detection
+THUMBNAIL_WIDTH = 512
+# Side of the square thumbnail blocks checked for ink, roughly one character at typical render sizes
+BLOCK_SIZE = 8
+
+PageSignature = namedtuple("PageSignature", ["is_blank", "digest"])
+
+
+def ink_mask(image):
+    """Return a mask that is 255 where a page has ink and 0 elsewhere."""
+    gray = image if image.mode == "L" else image.convert("L")
+    return gray.point(lambda value: 255 if value < INK_THRESHOLD else 0)
+
+
+def density_thumbnail(mask):
+    """Return a THUMBNAIL_WIDTH-wide map of ink density.
+
+    Downscaling the ink mask rather than the page keeps thin strokes
+    visible as partial density instead of fading them into the background.
+    """
+    height = max(1, round(mask.height * THUMBNAIL_WIDTH / mask.width))
+    return mask.resize((THUMBNAIL_WIDTH, height), Image.Resampling.BOX)
+
+
+def max_block_ink(thumbnail):
+    """Return the ink density (0-1) of the most inked BLOCK_SIZE block of a thumbnail.
+
+    A single short line of text still has blocks well above scan speckle,
+    so pages are only treated as blank when every block is nearly empty.
+    """
+    return ImageStat.Stat(thumbnail.reduce(BLOCK_SIZE)).extrema[0][1] / 255
+
+
+def mask_digest(mask):
+    """Return a digest of a full-resolution ink mask and its size.
+
+    Two pages have the same digest only if every pixel has ink in one
+    exactly where it has ink in the other, so a page that differs by a
+    single digit of a date or a ticked checkbox is never a duplicate.
+    """
+    digest = hashlib.blake2b(f"{mask.width}x{mask.height}".encode('ascii'), digest_size=32)
+    digest.update(mask.tobytes())
+    return digest.digest()
+
+
+@timed("page_filter")
+def page_signature(image):
+    """Compute what the page filter needs to know about a rendered page."""
+    mask = ink_mask(image)
+    if max_block_ink(density_thumbnail(mask)) <= BLANK_PAGE_MAX_BLOCK_INK:
+        return PageSignature(True, None)
+    return PageSignature(False, mask_digest(mask))
+
+
+class PageFilter:
+    """Finds blank pages and exact repeats of pages already seen in this run.
+
+    A page is a duplicate only if its full-resolution ink mask is identical
+    to that of an earlier page, as with repeated cover sheets, separator
+    pages and boilerplate printed from the same source; scans that differ
+    anywhere, even in a date, are extracted separately. Each seen page keeps
+    a `handle` to its extraction result (a future, task or batch request
+    id) that duplicates reuse. Up to `max_pages` pages are remembered, least
+    recently matched first out.
+    """
+
+    def __init__(self, max_pages=PAGE_FILTER_MAX_PAGES):
+        self.max_pages = max_pages
+        self.blank_pages = 0
+        self.duplicate_pages = 0
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+
+    def check(self, signature):
+        """Return ("blank", None), ("duplicate", handle of the original) or ("new", None)."""
+        with self._lock:
+            if signature.is_blank:
+                self.blank_pages += 1
+                return "blank", None
+            handle = self._pages.get(signature.digest)
+            if handle is None:
+                return "new", None
+            self.duplicate_pages += 1
+            self._pages.move_to_end(signature.digest)
+            return "duplicate", handle
+
+    def register(self, signature, handle):
+        """Remember a new page and the handle of its extraction result."""
+        with self._lock:
+            self._pages[signature.digest] = handle
+            while len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
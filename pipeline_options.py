@@ -0,0 +1,24 @@
+from dataclasses import dataclass, field
+from typing import Any
+
+from config import COMBINE_MODE, TEXT_LAYER_MODE, RENDER_DPI
+from image_preprocessing import ImageSettings
+
+
+@dataclass
+class PipelineOptions:
+    """Run-wide settings and shared resources used by the document pipelines."""
+
+    page_cache: Any = None
+    icd10_index: Any = None
+    diagnosis_cache: Any = None
+    journal: Any = None
+    page_filter: Any = None
+    combine_mode: str = COMBINE_MODE
+    text_layer_mode: str = TEXT_LAYER_MODE
+    dpi: int = RENDER_DPI
+    image_settings: ImageSettings = field(default_factory=ImageSettings)
+    fast_icd: bool = False
+    stream: bool = False
+    markdown_dir: str = None
+    early_exit: bool = False
@@ -0,0 +1,190 @@
+import collections
+import concurrent.futures
+import contextvars
+import logging
+import os
+import tempfile
+import threading
+
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image
+
+from config import RENDER_DPI, RENDER_WORKERS, RENDER_CHUNK_PAGES, RENDER_TEMP_DIR, RENDER_AHEAD_MAX_PAGES
+from metrics import timed
+
+
+def count_pdf_pages(pdf_path):
+    """Return the number of pages in a PDF without rendering it."""
+    info = pdfinfo_from_path(pdf_path)
+    return int(info["Pages"])
+
+
+@timed("render")
+def render_page_range(pdf_path, first_page, last_page, output_dir, dpi=RENDER_DPI):
+    """Render 0-based pages `first_page`..`last_page` into `output_dir` with one pdftoppm call.
+
+    Pages are written as uncompressed PPM files rather than returned as PIL
+    images, so nothing is decoded or copied in this process until the page
+    is used. Returns a list of (page_number, path) tuples.
+    """
+    prefix = f"p{first_page:06d}"
+    paths = convert_from_path(
+        pdf_path,
+        dpi=dpi,
+        first_page=first_page + 1,
+        last_page=last_page + 1,
+        output_folder=output_dir,
+        output_file=prefix,
+        paths_only=True,
+    )
+    # pdftoppm names each file <prefix>-<1-based page number>.ppm
+    return [(int(os.path.splitext(path)[0].rsplit("-", 1)[1]) - 1, path) for path in paths]
+
+
+def split_page_ranges(page_numbers, chunk_pages=RENDER_CHUNK_PAGES):
+    """Group sorted page numbers into contiguous (first, last) ranges of at most `chunk_pages` pages."""
+    ranges = []
+    for page_number in sorted(page_numbers):
+        if ranges and page_number == ranges[-1][1] + 1 and page_number - ranges[-1][0] < chunk_pages:
+            ranges[-1] = (ranges[-1][0], page_number)
+        else:
+            ranges.append((page_number, page_number))
+    return ranges
+
+
+def load_rendered_page(path):
+    """Load a rendered page file and delete it; the file's data stays mapped until the image is closed."""
+    image = Image.open(path)
+    image.load()
+    os.remove(path)
+    return image
+
+
+class PageBudget:
+    """Counting semaphore for rendered pages that have not been loaded yet.
+
+    A range of pages reserves one permit per page before it is rendered,
+    and each permit is returned once its page is loaded (and its file
+    removed) or the page is abandoned.
+    """
+
+    def __init__(self, max_pages=RENDER_AHEAD_MAX_PAGES):
+        self.max_pages = max_pages
+        self.available = max_pages
+        self._condition = threading.Condition()
+
+    def acquire(self, pages, blocking=True):
+        """Reserve `pages` permits; return False if not blocking and they are not all available."""
+        with self._condition:
+            while self.available < pages:
+                if not blocking:
+                    return False
+                self._condition.wait()
+            self.available -= pages
+            return True
+
+    def release(self, pages=1):
+        with self._condition:
+            self.available += pages
+            self._condition.notify_all()
+
+
+_render_executor = None
+_render_budget = None
+_render_executor_lock = threading.Lock()
+
+
+def get_render_executor():
+    """Return the process-wide rasterization pool shared by every document."""
+    global _render_executor
+    with _render_executor_lock:
+        if _render_executor is None:
+            _render_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=RENDER_WORKERS, thread_name_prefix="render"
+            )
+        return _render_executor
+
+
+def get_render_budget():
+    """Return the process-wide budget of rendered pages waiting to be loaded, shared by every document."""
+    global _render_budget
+    with _render_executor_lock:
+        if _render_budget is None:
+            _render_budget = PageBudget()
+        return _render_budget
+
+
+def iter_pdf_pages(pdf_path, page_numbers, slots=None, dpi=RENDER_DPI, executor=None, workers=RENDER_WORKERS,
+                   chunk_pages=RENDER_CHUNK_PAGES, budget=None):
+    """Render the given pages of a PDF, yielding (page_number, image) tuples in page order.
+
+    Page numbers are 0-based. Contiguous ranges of up to `chunk_pages` pages
+    are rendered in parallel on the shared render pool (pdftoppm runs as a
+    subprocess, so threads use every core). Rendered pages go to a temporary
+    directory, in shared memory where available. At most `workers` ranges
+    per document are rendered ahead of the consumer, and only while the
+    shared `budget` of rendered pages waiting to be loaded allows. A
+    document only waits for the budget once it has no pages of its own
+    pending, so documents never wait on each other's reservations. If
+    `slots` is a semaphore, a slot is acquired before each page is loaded;
+    the consumer releases it once it is done with the image, which bounds
+    the number of pages held in memory.
+    """
+    if executor is None:
+        executor = get_render_executor()
+    if budget is None:
+        budget = get_render_budget()
+    # A range never needs more permits than the whole budget
+    ranges = iter(split_page_ranges(page_numbers, min(chunk_pages, budget.max_pages)))
+    next_range = next(ranges, None)
+    pending = collections.deque()
+    # Permits of the range being loaded whose pages have not been loaded yet
+    held = 0
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="soi_render_", dir=RENDER_TEMP_DIR) as output_dir:
+            def submit_next_range(blocking):
+                nonlocal next_range
+                if next_range is None or not budget.acquire(next_range[1] - next_range[0] + 1, blocking):
+                    return False
+                context = contextvars.copy_context()
+                future = executor.submit(context.run, render_page_range, pdf_path, *next_range, output_dir, dpi)
+                pending.append((next_range, future))
+                next_range = next(ranges, None)
+                return True
+
+            try:
+                while True:
+                    # Block for the budget only when nothing of this document is pending
+                    while len(pending) < max(1, workers) and submit_next_range(blocking=not pending):
+                        pass
+                    if not pending:
+                        break
+                    (first_page, last_page), future = pending.popleft()
+                    held = last_page - first_page + 1
+                    rendered = dict(future.result())
+                    for page_number in range(first_page, last_page + 1):
+                        if page_number not in rendered:
+                            logging.warning(f"No image rendered for page {page_number + 1} of '{pdf_path}'.")
+                            held -= 1
+                            budget.release()
+                            continue
+                        if slots is not None:
+                            slots.acquire()
+                        try:
+                            image = load_rendered_page(rendered[page_number])
+                        except Exception:
+                            if slots is not None:
+                                slots.release()
+                            raise
+                        held -= 1
+                        budget.release()
+                        yield page_number, image
+            finally:
+                # Stop rendering ahead and let running pdftoppm calls finish before the directory is removed
+                for _, future in pending:
+                    future.cancel()
+                concurrent.futures.wait([future for _, future in pending])
+    finally:
+        # Rendered files are gone once the directory is removed
+        budget.release(held + sum(last_page - first_page + 1 for (first_page, last_page), _ in pending))
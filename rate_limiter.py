@@ -0,0 +1,200 @@
+import asyncio
+import email.utils
+import math
+import random
+import threading
+import time
+
+from config import (
+    RATE_LIMIT_REQUESTS_PER_MINUTE,
+    RATE_LIMIT_TOKENS_PER_MINUTE,
+    MAX_CONCURRENCY,
+    RETRY_BASE_DELAY,
+    RETRY_MAX_DELAY,
+)
+
+# Rough characters-per-token ratio used to estimate prompt size before sending
+CHARS_PER_TOKEN = 4
+
+
+def model_image_size(width, height):
+    """Return the size a high-detail image is scaled to by the model before tiling."""
+    # Images are scaled to fit in 2048x2048, then so the shortest side is 768
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def estimate_image_tokens(width, height):
+    """Estimate the tokens a high-detail image costs, following OpenAI's tiling rules."""
+    width, height = model_image_size(width, height)
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def estimate_request_tokens(request, image_sizes=()):
+    """Estimate the tokens a chat completion request counts against the TPM budget.
+
+    OpenAI counts `max_tokens` against the limit up front, so it is included.
+    """
+    text_chars = 0
+    for message in request["messages"]:
+        content = message["content"]
+        if isinstance(content, str):
+            text_chars += len(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                text_chars += len(part["text"])
+    image_tokens = sum(estimate_image_tokens(width, height) for width, height in image_sizes)
+    return text_chars // CHARS_PER_TOKEN + image_tokens + request.get("max_tokens", 0)
+
+
+def parse_retry_after(headers):
+    """Return the delay in seconds requested by Retry-After headers, or None."""
+    if headers is None:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, retry_date.timestamp() - time.time())
+    return None
+
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, maximum=RETRY_MAX_DELAY):
+    """Return a full-jitter exponential backoff delay for the given retry attempt."""
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
+
+class RateLimiter:
+    """Shared request/token budget with adaptive concurrency for OpenAI calls.
+
+    Requests-per-minute and tokens-per-minute are tracked as continuously
+    refilling buckets. Concurrency follows additive-increase/multiplicative-
+    decrease: a 429 halves the number of requests allowed in flight and pauses
+    all callers for the Retry-After period, and each window of successful
+    requests grows it by one again.
+    """
+
+    def __init__(self, requests_per_minute=RATE_LIMIT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=RATE_LIMIT_TOKENS_PER_MINUTE, max_concurrency=MAX_CONCURRENCY):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = max_concurrency
+        self.in_flight = 0
+        self.rate_limited_count = 0
+        self._request_budget = float(requests_per_minute)
+        self._token_budget = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_budget = min(
+            self.requests_per_minute, self._request_budget + elapsed * self.requests_per_minute / 60
+        )
+        self._token_budget = min(
+            self.tokens_per_minute, self._token_budget + elapsed * self.tokens_per_minute / 60
+        )
+
+    def _try_acquire(self, tokens):
+        """Reserve budget for one request; return 0 on success or the seconds to wait."""
+        # A single request larger than the whole budget would never fit
+        tokens = min(tokens, self.tokens_per_minute)
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.in_flight >= self.concurrency_limit:
+                return 0.05
+            self._refill(now)
+            if self._request_budget < 1:
+                return (1 - self._request_budget) * 60 / self.requests_per_minute
+            if self._token_budget < tokens:
+                return (tokens - self._token_budget) * 60 / self.tokens_per_minute
+            self._request_budget -= 1
+            self._token_budget -= tokens
+            self.in_flight += 1
+            return 0
+
+    def acquire(self, tokens):
+        """Block until a request estimated at `tokens` may be sent."""
+        while True:
+            wait = self._try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens):
+        """Wait on the event loop until a request estimated at `tokens` may be sent."""
+        while True:
+            wait = self._try_acquire(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, reserved_tokens, used_tokens=None):
+        """Finish a successful request, refunding budget reserved beyond actual usage."""
+        with self._lock:
+            self.in_flight -= 1
+            if used_tokens is not None:
+                self._token_budget = min(
+                    self.tokens_per_minute, self._token_budget + max(0, reserved_tokens - used_tokens)
+                )
+            self._successes += 1
+            if self._successes >= self.concurrency_limit and self.concurrency_limit < self.max_concurrency:
+                self.concurrency_limit += 1
+                self._successes = 0
+
+    def release_failed(self):
+        """Finish a request that failed for a reason other than rate limiting."""
+        with self._lock:
+            self.in_flight -= 1
+
+    def release_rate_limited(self, retry_after):
+        """Finish a rate limited request, shrinking concurrency and pausing all callers."""
+        with self._lock:
+            self.in_flight -= 1
+            self.rate_limited_count += 1
+            self.concurrency_limit = max(1, self.concurrency_limit // 2)
+            self._successes = 0
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the process-wide rate limiter, creating it on first use."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
+
+
+def configure_rate_limiter(**kwargs):
+    """Replace the process-wide rate limiter, e.g. with limits taken from the CLI."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = RateLimiter(**kwargs)
+        return _rate_limiter
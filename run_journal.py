@@ -0,0 +1,164 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+def file_fingerprint(path):
+    """Return a SHA-256 of a file's contents, used to detect changed documents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RunJournal:
+    """Durable per-document, per-stage record of a batch run, stored in SQLite.
+
+    Each stage output (page JSON, combined markdown, extracted information,
+    ICD-10 code and the final record) is committed as soon as it completes,
+    so a rerun with --resume only repeats the work that is missing. A
+    document whose file contents changed since it was journaled starts over.
+    Batches submitted to the Batch API are journaled too, so a resumed batch
+    run waits for them instead of submitting and paying for them again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS documents (
+                path TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                record TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS stages (
+                path TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                output TEXT NOT NULL,
+                PRIMARY KEY (path, stage)
+            );
+            CREATE TABLE IF NOT EXISTS pages (
+                path TEXT NOT NULL,
+                page_number INTEGER NOT NULL,
+                result TEXT NOT NULL,
+                PRIMARY KEY (path, page_number)
+            );
+            CREATE TABLE IF NOT EXISTS batches (
+                input_path TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                batch_id TEXT NOT NULL
+            );
+        """)
+        self._connection.commit()
+
+    def _execute(self, sql, parameters=(), fetch=None):
+        with self._lock:
+            cursor = self._connection.execute(sql, parameters)
+            if fetch == "one":
+                return cursor.fetchone()
+            if fetch == "all":
+                return cursor.fetchall()
+            self._connection.commit()
+
+    def forget(self, path):
+        """Discard everything journaled for a document."""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._connection.execute("DELETE FROM stages WHERE path = ?", (path,))
+            self._connection.execute("DELETE FROM pages WHERE path = ?", (path,))
+            self._connection.execute("DELETE FROM documents WHERE path = ?", (path,))
+            self._connection.commit()
+
+    def begin_document(self, path):
+        """Register a document, discarding its journal entries if the file has changed."""
+        path = os.path.abspath(path)
+        fingerprint = file_fingerprint(path)
+        row = self._execute("SELECT fingerprint FROM documents WHERE path = ?", (path,), fetch="one")
+        if row is not None and row[0] == fingerprint:
+            return
+        if row is not None:
+            logging.info(f"'{path}' changed since it was journaled; reprocessing it from the start.")
+            self.forget(path)
+        self._execute(
+            "INSERT INTO documents (path, fingerprint, record, updated_at) VALUES (?, ?, NULL, ?)",
+            (path, fingerprint, time.time()),
+        )
+
+    def completed_record(self, path):
+        """Return the final record of a finished document, or None."""
+        row = self._execute(
+            "SELECT record FROM documents WHERE path = ?", (os.path.abspath(path),), fetch="one"
+        )
+        return json.loads(row[0]) if row and row[0] else None
+
+    def load_pages(self, path):
+        """Return {page_number: page result} for the pages already extracted."""
+        rows = self._execute(
+            "SELECT page_number, result FROM pages WHERE path = ?", (os.path.abspath(path),), fetch="all"
+        )
+        return dict(rows)
+
+    def save_page(self, path, page_number, result):
+        self._execute(
+            "INSERT OR REPLACE INTO pages (path, page_number, result) VALUES (?, ?, ?)",
+            (os.path.abspath(path), page_number, result),
+        )
+
+    def load_stage(self, path, stage):
+        """Return the saved output of a stage, or None if it has not completed."""
+        row = self._execute(
+            "SELECT output FROM stages WHERE path = ? AND stage = ?", (os.path.abspath(path), stage), fetch="one"
+        )
+        return json.loads(row[0]) if row else None
+
+    def save_stage(self, path, stage, output):
+        self._execute(
+            "INSERT OR REPLACE INTO stages (path, stage, output) VALUES (?, ?, ?)",
+            (os.path.abspath(path), stage, json.dumps(output)),
+        )
+
+    def finish_document(self, path, record):
+        self._execute(
+            "UPDATE documents SET record = ?, updated_at = ? WHERE path = ?",
+            (json.dumps(record), time.time(), os.path.abspath(path)),
+        )
+
+    def load_batch(self, input_path, fingerprint):
+        """Return the id of the batch submitted for a batch input file with these contents, or None."""
+        row = self._execute(
+            "SELECT batch_id FROM batches WHERE input_path = ? AND fingerprint = ?",
+            (os.path.abspath(input_path), fingerprint), fetch="one"
+        )
+        return row[0] if row else None
+
+    def save_batch(self, input_path, fingerprint, batch_id):
+        self._execute(
+            "INSERT OR REPLACE INTO batches (input_path, fingerprint, batch_id) VALUES (?, ?, ?)",
+            (os.path.abspath(input_path), fingerprint, batch_id),
+        )
+
+    def forget_batch(self, input_path):
+        self._execute("DELETE FROM batches WHERE input_path = ?", (os.path.abspath(input_path),))
+
+    def records(self):
+        """Return the records of every finished document."""
+        rows = self._execute("SELECT record FROM documents WHERE record IS NOT NULL ORDER BY path", fetch="all")
+        return [json.loads(row[0]) for row in rows]
+
+    def paths(self):
+        """Return the paths of every journaled document."""
+        return [row[0] for row in self._execute("SELECT path FROM documents ORDER BY path", fetch="all")]
+
+    def clear(self):
+        with self._lock:
+            for table in ("stages", "pages", "documents", "batches"):
+                self._connection.execute(f"DELETE FROM {table}")
+            self._connection.commit()
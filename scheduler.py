@@ -0,0 +1,101 @@
+import contextvars
+import heapq
+import itertools
+import threading
+import concurrent.futures
+
+from config import MAX_CONCURRENCY, MAX_CONCURRENT_DOCUMENTS
+
+# Page task priorities; pending page tasks start lowest value first, then in submission order
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+
+class Scheduler:
+    """Shared executors that run many documents under one global concurrency limit.
+
+    Page extraction tasks from every document share a single page pool, and
+    each API call (page or document stage) holds one of `max_concurrency`
+    slots, so the number of requests in flight never exceeds the limit while
+    pages of one document overlap with the combine/ICD stages of another.
+    Pending page tasks are started in priority order, so pages a document
+    needs first can overtake pages queued earlier by other documents.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, max_documents=MAX_CONCURRENT_DOCUMENTS):
+        self.max_concurrency = max_concurrency
+        self.max_documents = max_documents
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.page_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="page"
+        )
+        self.document_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_documents, thread_name_prefix="document"
+        )
+        self.speculation_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_documents, thread_name_prefix="speculation"
+        )
+        self._pending_pages = []
+        self._pending_lock = threading.Lock()
+        self._sequence = itertools.count()
+
+    def call(self, fn, *args, **kwargs):
+        """Run `fn` in the calling thread while holding a global concurrency slot."""
+        with self._slots:
+            return fn(*args, **kwargs)
+
+    def submit_page(self, fn, *args, priority=PRIORITY_NORMAL, **kwargs):
+        """Submit a page task to the shared page pool, carrying over the caller's context variables."""
+        future = concurrent.futures.Future()
+        with self._pending_lock:
+            heapq.heappush(
+                self._pending_pages,
+                (priority, next(self._sequence), contextvars.copy_context(), future, fn, args, kwargs),
+            )
+        # Each pool job runs whichever pending task comes first when a thread picks it up
+        self.page_executor.submit(self._run_next_page)
+        return future
+
+    def _run_next_page(self):
+        with self._pending_lock:
+            _, _, context, future, fn, args, kwargs = heapq.heappop(self._pending_pages)
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = context.run(self.call, fn, *args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def submit_document(self, fn, *args, **kwargs):
+        """Submit a whole-document task to the document pool, carrying over the caller's context variables."""
+        context = contextvars.copy_context()
+        return self.document_executor.submit(context.run, fn, *args, **kwargs)
+
+    def submit_speculative(self, fn, *args, **kwargs):
+        """Submit a speculative task that makes its own API calls through `call`, carrying over context variables.
+
+        Such tasks run on their own pool: they wait for API slots, so running
+        them on the page pool while holding a slot could deadlock.
+        """
+        context = contextvars.copy_context()
+        return self.speculation_executor.submit(context.run, fn, *args, **kwargs)
+
+    def shutdown(self):
+        self.document_executor.shutdown(wait=True)
+        self.speculation_executor.shutdown(wait=True)
+        self.page_executor.shutdown(wait=True)
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler():
+    """Return the process-wide scheduler, creating it on first use."""
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = Scheduler()
+        return _default_scheduler
@@ -0,0 +1,269 @@
+import json
+import os
+import re
+
+# Opening of a combine response up to the start of its markdown string, e.g. '{"markdown": "'
+MARKDOWN_FIELD_START_RE = re.compile(r'\s*\{\s*"markdown"\s*:\s*"')
+MARKDOWN_FIELD_START = '{"markdown":"'
+# Characters that end a plain run of a JSON string
+STRING_SPECIAL_RE = re.compile(r'["\\]')
+
+# A markdown heading, e.g. "## Diagnosis"
+HEADING_RE = re.compile(r"^(#{1,6})\s")
+# An unindented label line, e.g. "Plan: physical therapy" or "**Assessment:**"
+LABEL_RE = re.compile(r"^\*{0,2}[A-Za-z][A-Za-z /&()-]{0,40}:")
+# Headings and labels that open the assessment of a visit, e.g. "## Final Diagnosis" or "Assessment: ..."
+DIAGNOSIS_RE = re.compile(
+    r"^(?:#{1,6}\s+|\*{0,2})(?:[A-Za-z]+\s+){0,2}(?:assessment|diagnos[ie]s|impression)\b", re.IGNORECASE
+)
+
+
+class MarkdownFieldDecoder:
+    """Decodes the "markdown" string of a streamed combine response as its characters arrive.
+
+    Only a response that starts with the markdown field is decoded
+    incrementally. Anything else marks the decoder `failed`, and callers
+    rely on parsing the complete response instead.
+    """
+
+    def __init__(self):
+        self.failed = False
+        self.done = False
+        self._started = False
+        self._raw = ""
+
+    def _decodable_length(self):
+        """Return how much of the raw string decodes on its own, and whether the closing quote was reached."""
+        position = 0
+        while True:
+            match = STRING_SPECIAL_RE.search(self._raw, position)
+            if match is None:
+                return len(self._raw), False
+            position = match.start()
+            if self._raw[position] == '"':
+                return position, True
+            escape = self._raw[position + 1:position + 2]
+            if not escape:
+                return position, False
+            if escape != "u":
+                position += 2
+                continue
+            if position + 6 > len(self._raw):
+                return position, False
+            # A high surrogate only decodes together with the low surrogate escape after it
+            if 0xD800 <= int(self._raw[position + 2:position + 6], 16) < 0xDC00:
+                if position + 12 > len(self._raw):
+                    return position, False
+                position += 12
+            else:
+                position += 6
+
+    def feed(self, text):
+        """Add response text; return the markdown that can now be decoded."""
+        if self.failed or self.done:
+            return ""
+        self._raw += text
+        if not self._started:
+            match = MARKDOWN_FIELD_START_RE.match(self._raw)
+            if match is None:
+                if not MARKDOWN_FIELD_START.startswith("".join(self._raw.split())):
+                    self.failed = True
+                return ""
+            self._started = True
+            self._raw = self._raw[match.end():]
+        try:
+            length, self.done = self._decodable_length()
+            decoded = json.loads(f'"{self._raw[:length]}"')
+        except ValueError:
+            self.failed = True
+            return ""
+        self._raw = self._raw[length:]
+        return decoded
+
+
+class DiagnosisSectionScanner:
+    """Finds diagnosis sections (Assessment, Diagnosis, Impression) in markdown fed one line at a time.
+
+    A section opened by a heading ends at the next heading of the same or a
+    higher level; one opened by a label line ends at the next heading or
+    label line. Page indicators do not end a section, since diagnoses are
+    often continued on the next page.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self._start = None
+        self._level = None
+
+    def feed(self, line):
+        """Consume one line, including its newline; return the (start, end) of a section it closes, or None."""
+        closed = None
+        heading = HEADING_RE.match(line)
+        if self._start is not None:
+            if heading:
+                ends_section = self._level is None or len(heading.group(1)) <= self._level
+            else:
+                ends_section = self._level is None and LABEL_RE.match(line) is not None
+            if ends_section:
+                closed = (self._start, self.offset)
+                self._start = None
+        if self._start is None and DIAGNOSIS_RE.match(line):
+            self._start = self.offset
+            self._level = len(heading.group(1)) if heading else None
+        self.offset += len(line)
+        return closed
+
+    def finish(self):
+        """Return the (start, end) of the section still open at the end of the markdown, or None."""
+        return (self._start, self.offset) if self._start is not None else None
+
+
+def diagnosis_sections(markdown):
+    """Return (start offset, normalized text) of every diagnosis section in the markdown."""
+    scanner = DiagnosisSectionScanner()
+    spans = [scanner.feed(line) for line in markdown.splitlines(keepends=True)] + [scanner.finish()]
+    return [(start, " ".join(markdown[start:end].split()).lower()) for start, end in filter(None, spans)]
+
+
+def is_early_extraction_valid(prefix, markdown):
+    """Return True if information extracted from `prefix` also holds for the complete markdown.
+
+    That is the case when the markdown continues the prefix and every
+    diagnosis section after the prefix repeats one already in it, as
+    copied-forward assessments on later pages do.
+    """
+    if not markdown.startswith(prefix):
+        return False
+    sections = diagnosis_sections(markdown)
+    seen = {text for start, text in sections if start < len(prefix)}
+    return all(text in seen for start, text in sections if start >= len(prefix))
+
+
+class MarkdownStream:
+    """Consumer of a streamed combine response.
+
+    The markdown is decoded as it arrives and appended to `<path>.partial`,
+    which is renamed to `path` once the response is complete. As soon as
+    the first diagnosis section is complete, `on_diagnosis_section` is
+    called once with the markdown up to there, so the visit details can be
+    extracted while the rest of the document is still being generated.
+    Its return value (a future or task) is kept as `early_result`.
+    """
+
+    def __init__(self, path=None, on_diagnosis_section=None):
+        self.path = path
+        self.on_diagnosis_section = on_diagnosis_section
+        self.early_prefix = None
+        self.early_result = None
+        self._file = None
+        self.reset()
+
+    def reset(self):
+        """Start over, as when the request is retried.
+
+        The early extraction from an earlier attempt is cancelled, since its
+        markdown may differ from the new attempt's, and scanning starts again.
+        """
+        if self.early_result is not None:
+            self.early_result.cancel()
+        self.early_prefix = None
+        self.early_result = None
+        self._decoder = MarkdownFieldDecoder()
+        self._parts = []
+        self._scanner = DiagnosisSectionScanner()
+        self._unscanned = ""
+        if self._file is not None:
+            self._file.seek(0)
+            self._file.truncate()
+
+    @property
+    def markdown(self):
+        return "".join(self._parts)
+
+    def feed(self, text):
+        """Add a content delta of the response."""
+        decoded = self._decoder.feed(text)
+        if not decoded:
+            return
+        self._parts.append(decoded)
+        if self.path is not None:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(f"{self.path}.partial", 'w', encoding='utf-8')
+            self._file.write(decoded)
+            self._file.flush()
+        if self.on_diagnosis_section is not None and self.early_prefix is None:
+            self._scan(decoded)
+
+    def _scan(self, decoded):
+        """Look for the end of the first diagnosis section in the complete lines decoded so far."""
+        self._unscanned += decoded
+        lines_end = self._unscanned.rfind("\n") + 1
+        for line in self._unscanned[:lines_end].splitlines(keepends=True):
+            if self._scanner.feed(line) is not None:
+                self.early_prefix = self.markdown[:self._scanner.offset - len(line)]
+                self.early_result = self.on_diagnosis_section(self.early_prefix)
+                return
+        self._unscanned = self._unscanned[lines_end:]
+
+    def finish(self, markdown):
+        """Save the complete markdown parsed from the response to `path`."""
+        if self.path is None:
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(f"{self.path}.partial", 'w', encoding='utf-8')
+        if markdown != self.markdown:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(markdown)
+        self._file.close()
+        self._file = None
+        os.replace(f"{self.path}.partial", self.path)
+
+    def discard(self):
+        """Remove the partial markdown of a response that failed."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(f"{self.path}.partial")
+
+
+class StreamedCompletion:
+    """Collects the chunks of a streamed chat completion into a ChatCompletion, feeding content to a consumer."""
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self._content = []
+        self._last_chunk = None
+        self._finish_reason = None
+        self.usage = None
+
+    def add(self, chunk):
+        self._last_chunk = chunk
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        for choice in chunk.choices:
+            if choice.delta.content:
+                self._content.append(choice.delta.content)
+                self.consumer.feed(choice.delta.content)
+            if choice.finish_reason:
+                self._finish_reason = choice.finish_reason
+
+    def completion(self):
+        """Return the assembled response, shaped like a non-streamed one."""
+        from openai.types.chat import ChatCompletion
+
+        chunk = self._last_chunk
+        return ChatCompletion(
+            id=chunk.id if chunk else "",
+            object="chat.completion",
+            created=chunk.created if chunk else 0,
+            model=chunk.model if chunk else "",
+            choices=[{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(self._content)},
+                "finish_reason": self._finish_reason or "stop",
+            }],
+            usage=self.usage,
+        )
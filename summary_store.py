@@ -0,0 +1,140 @@
+import csv
+import datetime
+import json
+import re
+import sqlite3
+import threading
+
+from config import SUMMARY_STORE_FETCH_ROWS
+
+# Formats a model may write the date of visit in; month-first dates are read the US way
+VISIT_DATE_FORMATS = (
+    "%Y-%m-%d", "%m/%d/%Y", "%m/%d/%y", "%m-%d-%Y", "%Y/%m/%d",
+    "%B %d, %Y", "%b %d, %Y", "%d %B %Y", "%d %b %Y",
+)
+# A date inside longer text, e.g. "03/15/2023 (follow-up)"
+EMBEDDED_DATE_RE = re.compile(r"\b(?:\d{4}-\d{1,2}-\d{1,2}|\d{1,2}/\d{1,2}/\d{2,4})\b")
+
+SUMMARY_FIELDS = ("date_of_visit", "diagnosis", "icd10_code", "reference")
+SUMMARY_HEADER = (
+    "| Date of Visit | Diagnosis | ICD-10 Code | Reference |\n"
+    "|---------------|-----------|-------------|-----------|"
+)
+
+
+def parse_visit_date(text):
+    """Return a date of visit as YYYY-MM-DD, or None if no date can be read from it."""
+    text = " ".join(str(text or "").replace(".", " ").split())
+    for candidate in [text] + EMBEDDED_DATE_RE.findall(text):
+        for date_format in VISIT_DATE_FORMATS:
+            try:
+                return datetime.datetime.strptime(candidate, date_format).date().isoformat()
+            except ValueError:
+                continue
+    return None
+
+
+class SummaryStore:
+    """The summary's records in SQLite, indexed in summary order (latest visit first).
+
+    Each document's date of visit is parsed into YYYY-MM-DD once, when its
+    record is stored, so dates sort correctly whatever format the model
+    wrote them in; records whose date cannot be read come last. Records are
+    keyed by document, so a changed or removed document updates the summary
+    without re-sorting it, and the summary is written by streaming the
+    index rather than loading every record.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS records (
+                path TEXT PRIMARY KEY,
+                visit_date TEXT,
+                record TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS records_order ON records (visit_date DESC, path);
+        """)
+        self._connection.commit()
+
+    def _row(self, path, record):
+        visit_date = parse_visit_date(record.get("date_of_visit"))
+        if visit_date is not None:
+            record = {**record, "date_of_visit": visit_date}
+        return path, visit_date, json.dumps(record)
+
+    def put(self, path, record):
+        """Store a document's record, or remove the document if `record` is None."""
+        with self._lock:
+            if record is None:
+                self._connection.execute("DELETE FROM records WHERE path = ?", (path,))
+            else:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO records (path, visit_date, record) VALUES (?, ?, ?)",
+                    self._row(path, record),
+                )
+            self._connection.commit()
+
+    def replace(self, path_records):
+        """Replace every record with the (path, record) pairs given; None records are skipped."""
+        with self._lock:
+            self._connection.execute("DELETE FROM records")
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO records (path, visit_date, record) VALUES (?, ?, ?)",
+                (self._row(path, record) for path, record in path_records if record),
+            )
+            self._connection.commit()
+
+    def clear(self):
+        self.replace([])
+
+    def count(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def paths(self):
+        """Return the paths of every document with a record."""
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT path FROM records ORDER BY path")]
+
+    def iter_records(self, fetch_rows=SUMMARY_STORE_FETCH_ROWS):
+        """Yield every record in summary order, reading `fetch_rows` rows at a time."""
+        with self._lock:
+            cursor = self._connection.execute("SELECT record FROM records ORDER BY visit_date DESC, path")
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(fetch_rows)
+            if not rows:
+                return
+            for row in rows:
+                yield json.loads(row[0])
+
+
+def write_markdown(records, f):
+    """Write records as the summary's markdown table."""
+    f.write(SUMMARY_HEADER)
+    for record in records:
+        f.write(f"\n| {record['date_of_visit']} | {record['diagnosis']} | {record['icd10_code']} "
+                f"| {record['reference']} |")
+
+
+def write_csv(records, f):
+    """Write records as CSV with a header row; `f` must be opened with newline=''."""
+    writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+
+
+def write_json(records, f):
+    """Write records as a JSON array, one record per line."""
+    f.write("[")
+    for index, record in enumerate(records):
+        f.write(("," if index else "") + "\n  " + json.dumps(record))
+    f.write("\n]\n")
+
+
+# Summary writers by file extension
+SUMMARY_WRITERS = {"md": write_markdown, "csv": write_csv, "json": write_json}
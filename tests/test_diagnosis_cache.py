@@ -0,0 +1,12 @@
+from diagnosis_cache import normalize_diagnosis
+
+
+def test_equivalent_wordings_share_a_key():
+    assert normalize_diagnosis("Cervicalgia.") == normalize_diagnosis("ICD-10 code for cervicalgia")
+
+
+def test_mirrored_sides_get_different_keys():
+    assert (normalize_diagnosis("Sprain of left knee and right ankle")
+            != normalize_diagnosis("Sprain of right knee and left ankle"))
+    assert (normalize_diagnosis("Fracture of left femur, contusion of right hip")
+            != normalize_diagnosis("Fracture of right hip, contusion of left femur"))
@@ -0,0 +1,55 @@
+from PIL import Image, ImageDraw, ImageFont
+
+from page_filter import PageFilter, page_signature
+
+# A letter page at the 200 DPI default with 26 px (about 9-10 pt) text
+PAGE_SIZE = (1700, 2200)
+FONT = ImageFont.load_default(size=26)
+
+
+def render_form(date="03/15/2023", checked=False):
+    """Return a rendered visit form that only varies in its date of service and one checkbox."""
+    page = Image.new("L", PAGE_SIZE, 255)
+    draw = ImageDraw.Draw(page)
+    draw.text((80, 80), "Riverside Orthopedics - Visit Note", fill=0, font=FONT)
+    draw.text((80, 140), f"Date of service: {date}", fill=0, font=FONT)
+    draw.text((80, 200), "Patient: Jane Doe    DOB: 01/02/1980", fill=0, font=FONT)
+    for line in range(12):
+        draw.text((80, 280 + line * 40), f"Exam finding {line}: within normal limits.", fill=0, font=FONT)
+    draw.rectangle((80, 800, 104, 824), outline=0, width=2)
+    if checked:
+        draw.line((84, 812, 92, 820, 102, 802), fill=0, width=3)
+    draw.text((120, 798), "Follow-up required", fill=0, font=FONT)
+    return page
+
+
+def check_after(first, second):
+    page_filter = PageFilter()
+    page_filter.register(page_signature(first), "original")
+    return page_filter.check(page_signature(second))
+
+
+def test_identical_page_is_duplicate():
+    assert check_after(render_form(), render_form()) == ("duplicate", "original")
+
+
+def test_pages_differing_only_in_date_are_not_duplicates():
+    for date in ("03/16/2023", "05/15/2023", "03/15/2022"):
+        assert check_after(render_form(), render_form(date=date)) == ("new", None)
+
+
+def test_pages_differing_only_in_checkbox_are_not_duplicates():
+    assert check_after(render_form(), render_form(checked=True)) == ("new", None)
+
+
+def test_blank_page_is_skipped():
+    page_filter = PageFilter()
+    assert page_filter.check(page_signature(Image.new("L", PAGE_SIZE, 255))) == ("blank", None)
+    assert page_filter.blank_pages == 1
+
+
+def test_oldest_page_is_forgotten():
+    page_filter = PageFilter(max_pages=1)
+    page_filter.register(page_signature(render_form()), "first")
+    page_filter.register(page_signature(render_form(date="03/16/2023")), "second")
+    assert page_filter.check(page_signature(render_form())) == ("new", None)
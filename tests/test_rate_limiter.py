@@ -0,0 +1,20 @@
+import email.utils
+import time
+
+from rate_limiter import parse_retry_after
+
+
+def test_retry_after_seconds_and_milliseconds():
+    assert parse_retry_after({"retry-after": "2"}) == 2.0
+    assert parse_retry_after({"retry-after-ms": "1500", "retry-after": "9"}) == 1.5
+
+
+def test_retry_after_http_date():
+    header = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < parse_retry_after({"retry-after": header}) <= 30
+
+
+def test_unreadable_retry_after_is_ignored():
+    assert parse_retry_after({"retry-after": "soon"}) is None
+    assert parse_retry_after({"retry-after-ms": "soon", "retry-after": "later"}) is None
+    assert parse_retry_after(None) is None
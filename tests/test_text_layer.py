@@ -0,0 +1,26 @@
+import json
+
+from text_layer import text_layer_to_page_json
+
+
+def content_of(text):
+    return json.loads(text_layer_to_page_json(text))["content"].splitlines()
+
+
+def test_indentation_is_relative_to_the_page_margin():
+    assert content_of("    Assessment:\n        Cervicalgia\n") == ["Assessment:", "- Cervicalgia"]
+
+
+def test_layout_indentation_is_bucketed_and_centered_text_is_not_indented():
+    text = ("                         RIVERSIDE ORTHOPEDICS\n"
+            "  Patient: Jane Doe      DOB: 01/02/1980\n"
+            "   Date of service: 03/15/2023\n"
+            "      Cervicalgia\n"
+            "           Neck pain since the accident\n")
+    assert content_of(text) == [
+        "RIVERSIDE ORTHOPEDICS",
+        "Patient: Jane Doe DOB: 01/02/1980",
+        "Date of service: 03/15/2023",
+        "- Cervicalgia",
+        "-- Neck pain since the accident",
+    ]
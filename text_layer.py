@@ -0,0 +1,67 @@
+import json
+import logging
+import subprocess
+
+from config import (TEXT_LAYER_MIN_CHARS, TEXT_LAYER_MIN_ALNUM_RATIO, TEXT_LAYER_INDENT_COLUMNS,
+                    TEXT_LAYER_MAX_INDENT_LEVEL)
+from metrics import timed
+
+
+def extract_text_layer(pdf_path):
+    """Return the embedded text of every page of a PDF using poppler's pdftotext."""
+    result = subprocess.run(
+        ["pdftotext", "-layout", "-enc", "UTF-8", pdf_path, "-"],
+        capture_output=True,
+        check=True,
+    )
+    # pdftotext ends every page with a form feed
+    pages = result.stdout.decode("utf-8", errors="replace").split("\f")
+    if pages and not pages[-1].strip():
+        pages.pop()
+    return pages
+
+
+def has_usable_text(text, min_chars=TEXT_LAYER_MIN_CHARS, min_alnum_ratio=TEXT_LAYER_MIN_ALNUM_RATIO):
+    """Return True if a page's embedded text is substantial enough to skip vision extraction."""
+    characters = "".join(text.split())
+    if len(characters) < min_chars:
+        return False
+    alnum = sum(1 for character in characters if character.isalnum())
+    return alnum / len(characters) >= min_alnum_ratio
+
+
+@timed("text_layer")
+def read_text_layer(pdf_path, page_count):
+    """Return {page_number: text} for the 0-based pages that have a usable text layer."""
+    try:
+        pages = extract_text_layer(pdf_path)
+    except FileNotFoundError:
+        logging.warning("pdftotext is not installed; all pages will use vision extraction.")
+        return {}
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"Could not read the text layer of '{pdf_path}': {e.stderr.decode(errors='replace')}")
+        return {}
+
+    if len(pages) != page_count:
+        logging.warning(f"Text layer of '{pdf_path}' has {len(pages)} pages, expected {page_count}; ignoring it.")
+        return {}
+    return {page_number: text for page_number, text in enumerate(pages) if has_usable_text(text)}
+
+
+def text_layer_to_page_json(text, indent_columns=TEXT_LAYER_INDENT_COLUMNS, max_level=TEXT_LAYER_MAX_INDENT_LEVEL):
+    """Build the page JSON shape directly from layout text, mapping coarse indentation to dashes."""
+    lines = [line.rstrip() for line in text.splitlines()]
+    lines = [line for line in lines if line.strip()]
+    margin = min((len(line) - len(line.lstrip()) for line in lines), default=0)
+
+    content_lines = []
+    for line in lines:
+        indent = len(line) - len(line.lstrip()) - margin
+        level = indent // indent_columns
+        # Lines indented past the deepest level are centered or right-aligned text, not list items
+        if level > max_level:
+            level = 0
+        prefix = f"{'-' * level} " if level else ""
+        # Collapse the runs of spaces pdftotext uses to lay out columns
+        content_lines.append(prefix + " ".join(line.split()))
+    return json.dumps({"content": "\n".join(content_lines)})
@@ -1,12 +1,11 @@
-import io
-import base64
+import functools
+import importlib
 import json
 import logging
 import os
-
-import openai
-from openai import OpenAI
-from serpapi import GoogleSearch
+import re
+import threading
+import time
 
 from config import (
     EXTRACTION_MODEL,
@@ -14,33 +13,236 @@ from config import (
     GPT4O_MAX_OUTPUT_TOKENS,
     TEMPERATURE,
     RESPONSE_FORMAT,
+    MAX_API_RETRIES,
+    COMBINE_CHUNK_PAGES,
+    COMBINE_CHUNK_OVERLAP,
+    CODE_DIAGNOSIS_RESPONSE_FORMAT,
+    ICD10_CANDIDATE_MIN_CONFIDENCE,
 )
+from icd10_index import is_valid_code_format
+from image_preprocessing import PageBuffer, base64_data_url, encode_page_image
+from metrics import get_metrics, timed
+from streaming import StreamedCompletion
+from rate_limiter import get_rate_limiter, estimate_request_tokens, parse_retry_after, backoff_delay, CHARS_PER_TOKEN
+
+from prompts import EXTRACTION_SYSTEM_PROMPT, COMBINE_SYSTEM_PROMPT, GENERATE_QUERY_SYSTEM_PROMPT, PARSE_WEB_RESULTS_SYSTEM_PROMPT, \
+    TEXT_EXTRACTION_SYSTEM_PROMPT, CODE_DIAGNOSIS_SYSTEM_PROMPT
+
+
+class _DeferredModule:
+    """Stands in for a module that is only imported when one of its attributes is first used."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        # import_module holds the module's import lock, so concurrent first uses import it once
+        return getattr(importlib.import_module(self._name), attribute)
+
+
+# openai, httpx, serpapi and dotenv are imported on first use and the client is
+# created on first use, so importing this module (and starting the CLI) does
+# not pay for them until a request is made
+openai = _DeferredModule("openai")
+httpx = _DeferredModule("httpx")
+serpapi = _DeferredModule("serpapi")
+dotenv = _DeferredModule("dotenv")
+
+_client = None
+_client_lock = threading.Lock()
+
+
+@functools.cache
+def load_environment():
+    """Load environment variables from a .env file, once."""
+    dotenv.load_dotenv()
+
+
+def get_client():
+    """Return the shared OpenAI client, creating it on first use.
+
+    Retries are handled by create_chat_completion so the shared rate
+    limiter sees every attempt.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            load_environment()
+            _client = openai.OpenAI(max_retries=0)
+        return _client
+
+
+# Leading messages shared by every request of a kind. Requests are built by
+# appending their variable content to these, never by editing them, so every
+# request of a kind starts with a byte-identical prefix that OpenAI's automatic
+# prompt caching can reuse once it is at least 1024 tokens long.
+PROMPT_PREFIXES = {
+    "extract": (
+        {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
+    ),
+    "extract_text": (
+        {"role": "system", "content": TEXT_EXTRACTION_SYSTEM_PROMPT},
+    ),
+    "combine": (
+        {"role": "system", "content": COMBINE_SYSTEM_PROMPT},
+        {"role": "user", "content": "Please combine the following page contents into a JSON output:"},
+    ),
+    "query": (
+        {"role": "system", "content": GENERATE_QUERY_SYSTEM_PROMPT},
+    ),
+    "icd10": (
+        {"role": "system", "content": PARSE_WEB_RESULTS_SYSTEM_PROMPT},
+    ),
+    "code_diagnosis": (
+        {"role": "system", "content": CODE_DIAGNOSIS_SYSTEM_PROMPT},
+    ),
+}
+
+
+def build_messages(kind, *messages):
+    """Return the cacheable prefix of a kind of request followed by its variable messages."""
+    return [*PROMPT_PREFIXES[kind], *messages]
+
+
+def prompt_prefix_tokens():
+    """Return the estimated length in tokens of each kind of request's cacheable prefix."""
+    return {
+        kind: sum(len(message["content"]) for message in prefix) // CHARS_PER_TOKEN
+        for kind, prefix in PROMPT_PREFIXES.items()
+    }
 
-from prompts import EXTRACTION_SYSTEM_PROMPT, COMBINE_SYSTEM_PROMPT, GENERATE_QUERY_SYSTEM_PROMPT, PARSE_WEB_RESULTS_SYSTEM_PROMPT
-
-from dotenv import load_dotenv
-load_dotenv()  # Load environment variables
-
-# Initialize OpenAI client
-client = OpenAI()
-
-
-def encode_image_to_base64(image):
-    """Encode a PIL Image to a base64 string."""
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
 
+def is_quota_error(error):
+    """Return True for a 429 caused by an exhausted quota, which retrying cannot fix."""
+    return getattr(error, "code", None) == "insufficient_quota"
+
+
+def stream_chat_completion(request, consumer):
+    """Send a streaming chat completion request, feeding content deltas to `consumer` as they arrive.
+
+    Returns the assembled response, shaped like a non-streamed one.
+    """
+    consumer.reset()
+    collected = StreamedCompletion(consumer)
+    with get_client().chat.completions.create(**request, stream=True, stream_options={"include_usage": True}) as chunks:
+        try:
+            for chunk in chunks:
+                collected.add(chunk)
+        except httpx.TransportError as e:
+            # A connection dropped mid-stream is retried like one that failed before the response
+            raise openai.APIConnectionError(message=f"Stream interrupted: {e}", request=chunks.response.request) from e
+    return collected.completion()
+
+
+class ChatCompletionAttempts:
+    """Retry policy of a chat completion request, shared by the sync and async transports.
+
+    The caller acquires the shared rate limiter for `tokens` before each
+    attempt, then reports the attempt's outcome with `succeeded` or
+    `retry_delay`. Rate limited requests are retried after the Retry-After
+    delay (or a jittered exponential backoff when the header is missing),
+    which pauses every caller through the limiter, and transient
+    connection/server errors are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, request, image_sizes=()):
+        self.limiter = get_rate_limiter()
+        self.tokens = estimate_request_tokens(request, image_sizes)
+        self.model = request["model"]
+        self.attempt = 0
+        self._start = time.perf_counter()
+
+    def succeeded(self, response):
+        """Release the attempt's budget, record its usage and return the response."""
+        usage = getattr(response, "usage", None)
+        self.limiter.release(self.tokens, used_tokens=usage.total_tokens if usage else None)
+        record_api_usage(self.model, usage, time.perf_counter() - self._start, retries=self.attempt)
+        return response
+
+    def retry_delay(self, error):
+        """Release a failed attempt; return the seconds to sleep before retrying, or None to give up."""
+        attempt, self.attempt = self.attempt, self.attempt + 1
+        if isinstance(error, openai.RateLimitError):
+            get_metrics().record_rate_limited(self.model)
+            if not is_quota_error(error) and attempt < MAX_API_RETRIES:
+                delay = parse_retry_after(error.response.headers) or backoff_delay(attempt)
+                self.limiter.release_rate_limited(delay)
+                logging.warning(f"Rate limited by OpenAI; retrying in {delay:.1f}s "
+                                f"(attempt {attempt + 1} of {MAX_API_RETRIES}).")
+                # The limiter holds every caller back for the delay
+                return 0
+        elif isinstance(error, (openai.APIConnectionError, openai.InternalServerError)) and attempt < MAX_API_RETRIES:
+            self.limiter.release_failed()
+            delay = backoff_delay(attempt)
+            logging.warning(f"Transient OpenAI error ({error}); retrying in {delay:.1f}s "
+                            f"(attempt {attempt + 1} of {MAX_API_RETRIES}).")
+            return delay
+        self.limiter.release_failed()
+        get_metrics().record_api_error(self.model)
+        return None
 
-def extract_text_from_image(image, page_number=0):
-    """Extract text from an image using the OpenAI API."""
-    base64_image = encode_image_to_base64(image)
 
-    messages = [
-        {
-            "role": "system",
-            "content": EXTRACTION_SYSTEM_PROMPT,
-        },
+def create_chat_completion(request, image_sizes=(), stream=None):
+    """Send a chat completion request through the shared rate limiter, retrying as ChatCompletionAttempts decides.
+
+    With a `stream` consumer (see streaming.MarkdownStream), the response is
+    streamed into it and it is reset before every attempt.
+    """
+    attempts = ChatCompletionAttempts(request, image_sizes)
+    while True:
+        attempts.limiter.acquire(attempts.tokens)
+        try:
+            if stream is None:
+                response = get_client().chat.completions.create(**request)
+            else:
+                response = stream_chat_completion(request, stream)
+        except Exception as e:
+            delay = attempts.retry_delay(e)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        except BaseException:
+            # A cancelled or interrupted attempt gives back its budget but is not an API error
+            attempts.limiter.release_failed()
+            raise
+        return attempts.succeeded(response)
+
+
+def cached_prompt_tokens(usage):
+    """Return the prompt tokens of a response that were served from OpenAI's prompt cache."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+
+def record_api_usage(model, usage, seconds, retries=0):
+    """Record a completed API call's tokens, latency and retries in the run metrics."""
+    get_metrics().record_api_call(
+        model,
+        usage.prompt_tokens if usage else 0,
+        usage.completion_tokens if usage else 0,
+        cached_tokens=cached_prompt_tokens(usage),
+        seconds=seconds,
+        retries=retries,
+    )
+
+
+@timed("encode")
+def encode_page(image, settings=None, page_number=0):
+    """Preprocess and encode a PIL Image into a PageBuffer holding its data URL.
+
+    The encoded bytes are not kept, and callers close the image as soon as
+    this returns, so only the data URL is held while its request is queued
+    and in flight.
+    """
+    encoded = encode_page_image(image, settings, page_number=page_number)
+    return PageBuffer(base64_data_url(encoded.data, encoded.mime_type), encoded.mime_type, encoded.size)
+
+
+def build_extraction_request(image_url):
+    """Build the chat completion request for extracting text from a page image."""
+    messages = build_messages(
+        "extract",
         {
             "role": "user",
             "content": [
@@ -51,60 +253,99 @@ def extract_text_from_image(image, page_number=0):
                 {
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}"
+                        "url": image_url
                     },
                 },
             ],
         },
-    ]
+    )
+
+    return {
+        "model": EXTRACTION_MODEL,
+        "messages": messages,
+        "response_format": RESPONSE_FORMAT,
+        "temperature": TEMPERATURE,
+        "max_tokens": GPT4O_MAX_OUTPUT_TOKENS,
+    }
+
+
+@timed("extract")
+def extract_text_from_image(page, page_number=0):
+    """Extract text from an encoded page image (a PageBuffer) using the OpenAI API."""
+    request = build_extraction_request(page.data_url)
 
     try:
-        response = client.chat.completions.create(
-            model=EXTRACTION_MODEL,
-            messages=messages,
-            response_format=RESPONSE_FORMAT,
-            temperature=TEMPERATURE,
-            max_tokens=GPT4O_MAX_OUTPUT_TOKENS,
-        )
+        response = create_chat_completion(request, image_sizes=[page.size])
         assistant_message = response.choices[0].message.content.strip()
         return assistant_message
     except openai.APIConnectionError as e:
-        print("The server could not be reached")
-        print(e.__cause__)
+        logging.error(f"The server could not be reached while extracting page {page_number}: {e.__cause__}")
     except openai.RateLimitError as e:
-        print("A 429 status code was received; we should back off a bit.")
+        logging.error(f"Rate limit retries exhausted while extracting page {page_number}: {e}")
     except openai.APIStatusError as e:
-        print("Another non-200-range status code was received")
-        print(e.status_code)
-        print(e.response)
+        logging.error(f"OpenAI API returned status {e.status_code} while extracting page {page_number}: {e.response}")
     return None
 
 
-def combine_page_contents(page_contents):
-    """Combine extracted page contents into a single markdown output."""
-    combine_messages = [
-        {
-            "role": "system",
-            "content": COMBINE_SYSTEM_PROMPT,
-        },
+def build_text_extraction_request(page_text):
+    """Build the chat completion request for structuring a page's embedded text layer."""
+    messages = build_messages(
+        "extract_text",
         {
             "role": "user",
-            "content": "Please combine the following page contents into a JSON output:",
+            "content": f"Please process the following page text:\n{page_text}",
         },
+    )
+
+    return {
+        "model": EXTRACTION_MODEL,
+        "messages": messages,
+        "response_format": RESPONSE_FORMAT,
+        "temperature": TEMPERATURE,
+        "max_tokens": GPT4O_MAX_OUTPUT_TOKENS,
+    }
+
+
+@timed("extract_text")
+def extract_text_from_text_layer(page_text, page_number=0):
+    """Structure a page's embedded text into the page JSON shape without sending an image."""
+    request = build_text_extraction_request(page_text)
+
+    try:
+        response = create_chat_completion(request)
+        assistant_message = response.choices[0].message.content.strip()
+        return assistant_message
+    except openai.OpenAIError as e:
+        logging.error(f"OpenAI API error during text layer extraction of page {page_number}: {e}")
+        return None
+
+
+def build_combine_request(page_contents):
+    """Build the chat completion request for combining page contents."""
+    combine_messages = build_messages(
+        "combine",
         {
             "role": "user",
             "content": json.dumps(page_contents),
         },
-    ]
+    )
+
+    return {
+        "model": COMBINATION_MODEL,
+        "messages": combine_messages,
+        "response_format": RESPONSE_FORMAT,
+        "temperature": TEMPERATURE,
+        "max_tokens": GPT4O_MAX_OUTPUT_TOKENS,
+    }
+
+
+@timed("combine")
+def combine_page_contents(page_contents, stream=None):
+    """Combine extracted page contents into a single markdown output, optionally streaming it into `stream`."""
+    request = build_combine_request(page_contents)
 
     try:
-        response = client.chat.completions.create(
-            model=COMBINATION_MODEL,
-            messages=combine_messages,
-            response_format=RESPONSE_FORMAT,
-            temperature=TEMPERATURE,
-            max_tokens=GPT4O_MAX_OUTPUT_TOKENS,
-        )
+        response = create_chat_completion(request, stream=stream)
         assistant_message = response.choices[0].message.content.strip()
         return assistant_message
     except openai.OpenAIError as e:
@@ -112,9 +353,190 @@ def combine_page_contents(page_contents):
         return None
 
 
+# Page indicator inserted by the combine model at the start of each page
+PAGE_MARKER_RE = re.compile(r"<!--\s*BEGIN PAGE:\s*p\.\s*(\d+)\s*-->")
+
+
+def split_combine_windows(page_contents, chunk_pages=COMBINE_CHUNK_PAGES, overlap=COMBINE_CHUNK_OVERLAP):
+    """Split page contents into windows that can be combined independently.
+
+    Returns a list of (window_pages, owned_page_numbers). Each window also
+    repeats the last `overlap` pages of the previous window so the model sees
+    how the hierarchy continues across the boundary; those repeated pages are
+    dropped again when the chunks are stitched.
+    """
+    windows = []
+    for start in range(0, len(page_contents), chunk_pages):
+        owned = page_contents[start:start + chunk_pages]
+        context = page_contents[max(0, start - overlap):start]
+        windows.append((context + owned, {page["page_number"] for page in owned}))
+    return windows
+
+
+def _owned_pages_markdown(markdown, owned_page_numbers, keep_preamble):
+    """Return only the sections of a chunk's markdown that belong to its owned pages."""
+    markers = list(PAGE_MARKER_RE.finditer(markdown))
+    if not markers:
+        logging.warning("Combined chunk has no page indicators; keeping it whole.")
+        return markdown
+
+    sections = [markdown[:markers[0].start()]] if keep_preamble else []
+    for index, marker in enumerate(markers):
+        end = markers[index + 1].start() if index + 1 < len(markers) else len(markdown)
+        if int(marker.group(1)) in owned_page_numbers:
+            sections.append(markdown[marker.start():end])
+    return "".join(sections)
+
+
+def stitch_combined_chunks(chunk_messages, windows):
+    """Stitch per-window combine responses into a single combine response.
+
+    Returns a JSON string in the same shape as combine_page_contents, or None
+    if any chunk failed.
+    """
+    sections = []
+    for index, (chunk_message, (_, owned_page_numbers)) in enumerate(zip(chunk_messages, windows)):
+        if not chunk_message:
+            logging.error(f"Content combination failed for chunk {index + 1} of {len(windows)}.")
+            return None
+        try:
+            markdown = json.loads(chunk_message)["markdown"]
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            logging.error(f"Error parsing combined JSON for chunk {index + 1} of {len(windows)}: {e}")
+            return None
+        section = _owned_pages_markdown(markdown, owned_page_numbers, keep_preamble=index == 0)
+        if section.strip():
+            sections.append(section.strip())
+    return json.dumps({"markdown": "\n\n".join(sections)})
+
+
+def should_chunk_combine(page_contents, combine_mode, chunk_pages=COMBINE_CHUNK_PAGES):
+    """Return True if the document should be combined in chunks."""
+    if combine_mode == "chunked":
+        return True
+    return combine_mode == "auto" and len(page_contents) > chunk_pages
+
+
+def parse_page_results(page_results, pdf_file):
+    """Parse (page_number, assistant_message) tuples into page JSON objects."""
+    # Ensure page_results is sorted by page_number
+    page_results = sorted(page_results, key=lambda x: x[0])
+
+    # Now, process each page_result along with its page_number
+    page_contents = []
+    for page_number, page_result in page_results:
+        try:
+            page_json = json.loads(page_result)
+            page_json["page_number"] = page_number + 1  # Adjust for 1-based page numbers
+            page_contents.append(page_json)
+        except json.JSONDecodeError as e:
+            logging.error(f"Error parsing JSON on page {page_number + 1} of '{pdf_file}': {e}")
+            continue
+    return page_contents
+
+
+def parse_combined_markdown(combined_message, pdf_file):
+    """Return the markdown from a combine response, or None if it is unusable."""
+    if not combined_message:
+        logging.error(f"Content combination failed for '{pdf_file}'.")
+        return None
+    try:
+        combined_json = json.loads(combined_message)
+    except json.JSONDecodeError as e:
+        logging.error(f"Error parsing combined JSON for '{pdf_file}': {e}")
+        return None
+    if "markdown" not in combined_json:
+        logging.error(f"No 'markdown' key found in combined response for '{pdf_file}'.")
+        return None
+    return combined_json["markdown"]
+
+
+def log_extracted_info(extracted_info):
+    logging.info(f"Extracted Date of Visit: {extracted_info['date_of_visit']}")
+    logging.info(f"Extracted Diagnosis: {extracted_info['diagnosis']}")
+    logging.info(f"Extracted Reference: {extracted_info['reference']}")
+    logging.info(f"Generated Search Query: {extracted_info['query']}")
+    if "icd10_candidates" in extracted_info:
+        candidates = ", ".join(candidate["code"] for candidate in extracted_info["icd10_candidates"]) or "none"
+        logging.info(f"Candidate ICD-10 codes: {candidates}")
+
+
+def build_record(extracted_info, icd10_code):
+    """Collect the summary table record for a document."""
+    return {
+        "date_of_visit": extracted_info["date_of_visit"],
+        "diagnosis": extracted_info["diagnosis"],
+        "icd10_code": icd10_code,
+        "reference": extracted_info["reference"],
+    }
+
+
+def is_valid_json(message):
+    """Return True if the message is a parseable JSON document."""
+    if not message:
+        return False
+    try:
+        json.loads(message)
+        return True
+    except json.JSONDecodeError:
+        return False
+
+
+def resolve_icd10_code_locally(icd10_index, extracted_info):
+    """Resolve the ICD-10 code from the local index, or return None to fall back to web search."""
+    if icd10_index is None:
+        return None
+    diagnosis = extracted_info["diagnosis"]
+    match = icd10_index.resolve(diagnosis, extracted_info["query"])
+    if match is None:
+        logging.info(f"No confident local ICD-10 match for '{diagnosis}'; falling back to web search.")
+        return None
+    logging.info(f"Matched '{diagnosis}' to {match.code} ({match.description}) locally "
+                 f"with confidence {match.confidence}.")
+    return match.code
+
+
+def validate_icd10_candidates(icd10_index, extracted_info):
+    """Return the first candidate ICD-10 code from the model that passes local checks, or None.
+
+    A candidate must be shaped like an ICD-10-CM code, exist in the local
+    index and have an index description that matches the description the
+    model gave, which catches codes that exist but were confused with
+    another condition. Without the index a candidate cannot be verified, so
+    none is accepted and the code is resolved from the search query instead.
+    """
+    if icd10_index is None:
+        return None
+    for candidate in extracted_info.get("icd10_candidates") or []:
+        code = candidate.get("code", "")
+        if not is_valid_code_format(code):
+            logging.info(f"Rejected candidate ICD-10 code '{code}': not a valid code.")
+            continue
+        entry = icd10_index.lookup(code)
+        if entry is None:
+            logging.info(f"Rejected candidate ICD-10 code '{code}': not in the ICD-10-CM index.")
+            continue
+        confidence = icd10_index.description_confidence(candidate.get("description", ""), entry[1])
+        if confidence < ICD10_CANDIDATE_MIN_CONFIDENCE:
+            logging.info(f"Rejected candidate ICD-10 code {entry[0]}: its description ({entry[1]}) does not match "
+                         f"'{candidate.get('description', '')}' (confidence {confidence:.2f}).")
+            continue
+        logging.info(f"Accepted candidate ICD-10 code {entry[0]} ({entry[1]}).")
+        return entry[0]
+    return None
+
+
+def markdown_output_path(markdown_dir, pdf_file):
+    """Return where a document's combined markdown is saved, or None if it is not saved."""
+    if markdown_dir is None:
+        return None
+    return os.path.join(markdown_dir, f"{os.path.splitext(pdf_file)[0]}.md")
+
+
 def save_markdown(output_path, markdown_content):
     """Save the markdown content to a file."""
     try:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
         with open(output_path, 'w', encoding='utf-8') as f:
             f.write(markdown_content)
         logging.info(f"Markdown output saved to '{output_path}'.")
@@ -122,42 +544,99 @@ def save_markdown(output_path, markdown_content):
         logging.error(f"Error saving markdown file '{output_path}': {e}")
 
 
-def generate_search_query(markdown_content, document_name):
-    """Generate search query and extract information from markdown content using OpenAI GPT-4o."""
-    messages = [
+def build_query_request(markdown_content, document_name):
+    """Build the chat completion request for generating the ICD-10 search query."""
+    messages = build_messages(
+        "query",
         {
-            "role": "system",
-            "content": GENERATE_QUERY_SYSTEM_PROMPT,
+            "role": "user",
+            "content": f"Notes:\n{markdown_content}\n\nDocument Name: {document_name}",
         },
+    )
+
+    return {
+        "model": COMBINATION_MODEL,  # Use GPT-4o model
+        "messages": messages,
+        "response_format": {"type": "json_object"},
+        "temperature": TEMPERATURE,
+        "max_tokens": 512,  # Adjust as needed
+    }
+
+
+def parse_query_result(assistant_message):
+    """Parse the query generation response into the extracted information dict."""
+    result = json.loads(assistant_message)
+
+    # Extract the required information
+    date_of_visit = result.get("date_of_visit", "")
+    diagnosis = result.get("diagnosis", "")
+    reference = result.get("reference", "")
+    query = result.get("query", "")
+
+    return {
+        "date_of_visit": date_of_visit,
+        "diagnosis": diagnosis,
+        "reference": reference,
+        "query": query,
+    }
+
+
+def build_code_diagnosis_request(markdown_content, document_name):
+    """Build the structured-output request for the visit details and candidate ICD-10 codes of a document."""
+    messages = build_messages(
+        "code_diagnosis",
         {
             "role": "user",
             "content": f"Notes:\n{markdown_content}\n\nDocument Name: {document_name}",
         },
+    )
+
+    return {
+        "model": COMBINATION_MODEL,
+        "messages": messages,
+        "response_format": CODE_DIAGNOSIS_RESPONSE_FORMAT,
+        "temperature": TEMPERATURE,
+        "max_tokens": 768,
+    }
+
+
+def parse_code_diagnosis_result(assistant_message):
+    """Parse the structured-output response into the extracted information dict with ICD-10 candidates."""
+    result = json.loads(assistant_message)
+    extracted_info = parse_query_result(assistant_message)
+    extracted_info["icd10_candidates"] = [
+        {"code": candidate.get("code", ""), "description": candidate.get("description", "")}
+        for candidate in result.get("icd10_candidates") or []
+        if isinstance(candidate, dict)
     ]
+    return extracted_info
+
+
+@timed("code_diagnosis")
+def code_diagnosis(markdown_content, document_name):
+    """Extract the visit details, search query and candidate ICD-10 codes of a document in one call."""
+    request = build_code_diagnosis_request(markdown_content, document_name)
 
     try:
-        response = client.chat.completions.create(
-            model=COMBINATION_MODEL,  # Use GPT-4o model
-            messages=messages,
-            response_format={"type": "json_object"},
-            temperature=TEMPERATURE,
-            max_tokens=512,  # Adjust as needed
-        )
+        response = create_chat_completion(request)
         assistant_message = response.choices[0].message.content.strip()
-        result = json.loads(assistant_message)
-
-        # Extract the required information
-        date_of_visit = result.get("date_of_visit", "")
-        diagnosis = result.get("diagnosis", "")
-        reference = result.get("reference", "")
-        query = result.get("query", "")
-
-        return {
-            "date_of_visit": date_of_visit,
-            "diagnosis": diagnosis,
-            "reference": reference,
-            "query": query,
-        }
+        return parse_code_diagnosis_result(assistant_message)
+    except openai.OpenAIError as e:
+        logging.error(f"OpenAI API error during diagnosis coding: {e}")
+    except json.JSONDecodeError as e:
+        logging.error(f"Error parsing JSON in diagnosis coding: {e}")
+    return None
+
+
+@timed("query")
+def generate_search_query(markdown_content, document_name):
+    """Generate search query and extract information from markdown content using OpenAI GPT-4o."""
+    request = build_query_request(markdown_content, document_name)
+
+    try:
+        response = create_chat_completion(request)
+        assistant_message = response.choices[0].message.content.strip()
+        return parse_query_result(assistant_message)
     except openai.OpenAIError as e:
         logging.error(f"OpenAI API error during query generation: {e}")
     except json.JSONDecodeError as e:
@@ -165,71 +644,95 @@ def generate_search_query(markdown_content, document_name):
     return None
 
 
-def search_icd10_code(query):
-    """Search for ICD-10 code using SerpAPI."""
-    params = {
+def build_search_params(query):
+    """Build the SerpAPI parameters for an ICD-10 code search."""
+    load_environment()
+    return {
         "q": query,
         "num": 10,  # Number of results
         "api_key": os.getenv("SERPAPI_API_KEY"),
     }
 
-    try:
-        search = GoogleSearch(params)
-        results = search.get_dict()
 
-        # Create a filtered results dictionary
-        filtered_results = {}
+def filter_search_results(results):
+    """Keep only the parts of a SerpAPI response that are useful for finding the code."""
+    # Create a filtered results dictionary
+    filtered_results = {}
+
+    # Include the entire 'answer_box' if present
+    if 'answer_box' in results:
+        filtered_results['answer_box'] = results['answer_box']
+
+    # Include selected fields from 'organic_results'
+    if 'organic_results' in results:
+        filtered_organic_results = []
+        for result in results['organic_results']:
+            filtered_result = {}
+            for key in ['position', 'title', 'link', 'snippet', 'snippet_highlighted_words', 'cached_page_link', 'source']:
+                if key in result:
+                    filtered_result[key] = result[key]
+            filtered_organic_results.append(filtered_result)
+        filtered_results['organic_results'] = filtered_organic_results
 
-        # Include the entire 'answer_box' if present
-        if 'answer_box' in results:
-            filtered_results['answer_box'] = results['answer_box']
+    return filtered_results
 
-        # Include selected fields from 'organic_results'
-        if 'organic_results' in results:
-            filtered_organic_results = []
-            for result in results['organic_results']:
-                filtered_result = {}
-                for key in ['position', 'title', 'link', 'snippet', 'snippet_highlighted_words', 'cached_page_link', 'source']:
-                    if key in result:
-                        filtered_result[key] = result[key]
-                filtered_organic_results.append(filtered_result)
-            filtered_results['organic_results'] = filtered_organic_results
 
-        return filtered_results
+def google_search(params):
+    """Run a SerpAPI Google search and return its results."""
+    return serpapi.GoogleSearch(params).get_dict()
+
+
+@timed("search")
+def search_icd10_code(query):
+    """Search for ICD-10 code using SerpAPI."""
+    params = build_search_params(query)
+    get_metrics().record_search()
+
+    try:
+        return filter_search_results(google_search(params))
 
     except Exception as e:
         logging.error(f"Error during SerpAPI search: {e}")
         return None
 
 
-def extract_icd10_code_from_results(results):
-    """Extract ICD-10 code from search results using OpenAI GPT-4o."""
+def build_icd10_request(results):
+    """Build the chat completion request for picking the ICD-10 code from search results."""
     # Convert search results to a string
     results_text = json.dumps(results, indent=2)
 
-    messages = [
-        {
-            "role": "system",
-            "content": PARSE_WEB_RESULTS_SYSTEM_PROMPT,
-        },
+    messages = build_messages(
+        "icd10",
         {
             "role": "user",
             "content": f"Web Search Results:\n{results_text}",
         },
-    ]
+    )
+
+    return {
+        "model": COMBINATION_MODEL,  # Use GPT-4o model
+        "messages": messages,
+        "response_format": {"type": "json_object"},
+        "temperature": TEMPERATURE,
+        "max_tokens": 256,  # Adjust as needed
+    }
+
+
+def parse_icd10_result(assistant_message):
+    """Parse the ICD-10 extraction response into the code string."""
+    result = json.loads(assistant_message)
+    return result.get("code", "")
+
+
+@timed("icd10")
+def extract_icd10_code_from_results(results):
+    """Extract ICD-10 code from search results using OpenAI GPT-4o."""
+    request = build_icd10_request(results)
 
     try:
-        response = client.chat.completions.create(
-            model=COMBINATION_MODEL,  # Use GPT-4o model
-            messages=messages,
-            response_format={"type": "json_object"},
-            temperature=TEMPERATURE,
-            max_tokens=256,  # Adjust as needed
-        )
+        response = create_chat_completion(request)
         assistant_message = response.choices[0].message.content.strip()
-        result = json.loads(assistant_message)
-        code = result.get("code", "")
-        return code
+        return parse_icd10_result(assistant_message)
     except openai.OpenAIError as e:
         logging.error(f"OpenAI API error during ICD-10 code extraction: {e}")
     except json.JSONDecodeError as e:
@@ -0,0 +1,188 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+
+from config import WARM_WORKER_SOCKET
+
+# Options that keep a run going indefinitely, so such runs are never handed to a warm worker
+LONG_RUNNING_OPTIONS = ("--watch", "--serve", "--worker")
+
+
+class _Client:
+    """Connection to the client of a handed-over run; messages are JSON lines."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        # Pipeline threads log concurrently, and a client that went away must not fail the run
+        with self._lock:
+            try:
+                self.connection.sendall((json.dumps(message) + "\n").encode('utf-8'))
+            except OSError:
+                pass
+
+
+class _RelayHandler(logging.Handler):
+    """Sends the log records of a handed-over run to its client."""
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+
+    def emit(self, record):
+        self.client.send({"log": self.format(record)})
+
+
+class _RelayStream(io.TextIOBase):
+    """Sends each line printed during a handed-over run, such as argparse usage, to its client."""
+
+    def __init__(self, client):
+        self.client = client
+        self._partial = ""
+
+    def write(self, text):
+        *lines, self._partial = (self._partial + text).split("\n")
+        for line in lines:
+            self.client.send({"log": line})
+        return len(text)
+
+    def close(self):
+        if self._partial:
+            self.client.send({"log": self._partial})
+            self._partial = ""
+
+
+def _run_request(connection, run):
+    """Run one handed-over invocation with `run`, relaying its output and exit status to the client."""
+    client = _Client(connection)
+    try:
+        request = json.loads(connection.makefile('rb').readline())
+        argv, cwd = request["argv"], request["cwd"]
+    except (ValueError, KeyError, OSError) as e:
+        logging.error(f"Ignoring an invalid warm worker request: {e}")
+        return
+
+    root = logging.getLogger()
+    handler = _RelayHandler(client)
+    if root.handlers:
+        handler.setFormatter(root.handlers[0].formatter)
+    stream = _RelayStream(client)
+    previous_cwd = os.getcwd()
+    root.addHandler(handler)
+    status = 0
+    try:
+        if any(option in argv for option in LONG_RUNNING_OPTIONS):
+            logging.error(f"{', '.join(LONG_RUNNING_OPTIONS)} cannot be handed to a warm worker.")
+            status = 2
+        else:
+            logging.info(f"Warm worker running: {' '.join(argv)}")
+            # Relative paths in the arguments are relative to the client's working directory
+            os.chdir(cwd)
+            with contextlib.redirect_stdout(stream), contextlib.redirect_stderr(stream):
+                run(argv)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        logging.exception("Run failed in the warm worker.")
+        status = 1
+    finally:
+        stream.close()
+        root.removeHandler(handler)
+        os.chdir(previous_cwd)
+    client.send({"exit": status})
+
+
+def serve(run, socket_path=WARM_WORKER_SOCKET):
+    """Run CLI invocations handed over by warm_worker.py, one at a time, until interrupted.
+
+    `run` is the CLI's main function; it is called with each invocation's
+    arguments in this process, so modules, the API client and its pooled
+    connections stay loaded between runs. Runs use this process's
+    environment (API keys and .env file), not the client's.
+    """
+    os.makedirs(os.path.dirname(socket_path) or ".", exist_ok=True)
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            logging.error(f"A warm worker is already listening on '{socket_path}'.")
+            return
+        except OSError:
+            # Left behind by a worker that was killed
+            os.remove(socket_path)
+        finally:
+            probe.close()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the owner may hand over runs, since they use this process's API keys
+    previous_umask = os.umask(0o177)
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(previous_umask)
+    listener.listen()
+    # Stop cleanly when a service manager sends SIGTERM
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logging.info(f"Warm worker listening on '{socket_path}'.")
+    try:
+        while True:
+            connection, _ = listener.accept()
+            with connection:
+                _run_request(connection, run)
+    except KeyboardInterrupt:
+        logging.info("Warm worker stopped.")
+    finally:
+        listener.close()
+        os.remove(socket_path)
+
+
+def submit(argv, socket_path=WARM_WORKER_SOCKET):
+    """Hand a CLI invocation to the warm worker, relaying its output; return its exit status.
+
+    Returns None if no warm worker is listening on `socket_path`.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        connection.close()
+        return None
+    with connection:
+        connection.sendall((json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n").encode('utf-8'))
+        for line in connection.makefile('r', encoding='utf-8'):
+            message = json.loads(line)
+            if "exit" in message:
+                return message["exit"]
+            print(message["log"], file=sys.stderr)
+    print("The warm worker closed the connection before the run finished.", file=sys.stderr)
+    return 1
+
+
+def main():
+    """Hand this invocation to the warm worker, or run it in this process if none is listening."""
+    argv = sys.argv[1:]
+    socket_path = WARM_WORKER_SOCKET
+    if argv[:1] == ["--socket"] and len(argv) > 1:
+        socket_path, argv = argv[1], argv[2:]
+
+    status = None
+    if not any(option in argv for option in LONG_RUNNING_OPTIONS):
+        status = submit(argv, socket_path)
+    if status is None:
+        # No warm worker to hand over to, so this process pays for startup
+        from generate_summary_of_injuries import main as run
+        run(argv)
+        status = 0
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from config import QUEUE_LEASE_SECONDS, QUEUE_MAX_ATTEMPTS
+
+
+class WorkQueue:
+    """SQLite-backed queue of documents shared by a coordinator and its workers.
+
+    Workers lease a job for `lease_seconds` and renew the lease while they
+    work on it. A job whose lease expires, because its worker crashed or
+    lost its connection, is handed to the next worker that asks, up to
+    `max_attempts` times. Finished jobs keep their record until the
+    coordinator reduces them into the summary. Every process opens the
+    queue file itself. SQLite's locking is not reliable on network file
+    systems, so the queue must be on a local file system and every worker
+    on the coordinator's host.
+    """
+
+    def __init__(self, path, lease_seconds=QUEUE_LEASE_SECONDS, max_attempts=QUEUE_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # isolation_level=None: transactions are explicit, so leasing can take the write lock up front
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                state TEXT NOT NULL,
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                record TEXT,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires);
+            CREATE TABLE IF NOT EXISTS queue (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+
+    def _transaction(self, sql_statements):
+        """Run (sql, parameters) pairs in one write transaction, returning the last cursor's rows."""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = None
+                for sql, parameters in sql_statements:
+                    rows = self._connection.execute(sql, parameters).fetchall()
+                self._connection.execute("COMMIT")
+                return rows
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def open(self, paths):
+        """Start a new run: replace all jobs with one pending job per path."""
+        statements = [
+            ("DELETE FROM jobs", ()),
+            ("INSERT OR REPLACE INTO queue (key, value) VALUES ('state', 'open')", ()),
+        ]
+        statements += [("INSERT INTO jobs (path, state) VALUES (?, 'pending')", (os.path.abspath(path),))
+                       for path in paths]
+        self._transaction(statements)
+
+    def close(self):
+        """Mark the run finished so idle workers exit."""
+        self._transaction([("INSERT OR REPLACE INTO queue (key, value) VALUES ('state', 'closed')", ())])
+
+    def is_open(self):
+        rows = self._query("SELECT value FROM queue WHERE key = 'state'")
+        return bool(rows) and rows[0][0] == "open"
+
+    def expire_leases(self):
+        """Return jobs whose lease expired to the queue, or give up on them after their last attempt."""
+        self._transaction([(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "error = 'lease expired', worker = NULL, lease_expires = NULL "
+            "WHERE state = 'leased' AND lease_expires < ?",
+            (self.max_attempts, time.time()),
+        )])
+
+    def lease(self, worker):
+        """Lease the next pending job to `worker`; return (job_id, path) or None."""
+        self.expire_leases()
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    "SELECT id, path FROM jobs WHERE state = 'pending' ORDER BY id LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        "UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                        "WHERE id = ?",
+                        (worker, now + self.lease_seconds, row[0]),
+                    )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return tuple(row) if row is not None else None
+
+    def renew(self, job_ids, worker):
+        """Extend the leases `worker` holds on `job_ids`."""
+        expires = time.time() + self.lease_seconds
+        self._transaction([
+            ("UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+             (expires, job_id, worker))
+            for job_id in job_ids
+        ])
+
+    def complete(self, job_id, worker, record):
+        """Store a job's record (None if the document produced none); return False if the lease was lost."""
+        rows = self._transaction([(
+            "UPDATE jobs SET state = 'done', record = ?, lease_expires = NULL "
+            "WHERE id = ? AND worker = ? AND state = 'leased' RETURNING id",
+            (json.dumps(record) if record else None, job_id, worker),
+        )])
+        return bool(rows)
+
+    def fail(self, job_id, worker, error):
+        """Return a job to the queue after an error, or mark it failed after its last attempt."""
+        self._transaction([(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "error = ?, worker = NULL, lease_expires = NULL WHERE id = ? AND worker = ? AND state = 'leased'",
+            (self.max_attempts, error, job_id, worker),
+        )])
+
+    def counts(self):
+        """Return the number of jobs in each state."""
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update(dict(self._query("SELECT state, COUNT(*) FROM jobs GROUP BY state")))
+        return counts
+
+    def failures(self):
+        """Return (path, error) for every job that was given up on."""
+        return self._query("SELECT path, error FROM jobs WHERE state = 'failed' ORDER BY id")
+
+    def path_records(self):
+        """Return (path, record) for every finished job with a record, in enqueue order."""
+        rows = self._query("SELECT path, record FROM jobs WHERE state = 'done' AND record IS NOT NULL ORDER BY id")
+        return [(path, json.loads(record)) for path, record in rows]